@@ -1,19 +1,35 @@
 import dropbox
 import logging
 import os
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
 
 from tools.notifier import Notifier
 
 class Dropbox_Dropper(Notifier):
 
+	# files_upload only accepts files up to 150 MB, bigger ones need an upload session
+	MAX_SINGLE_UPLOAD = 150 * 1024 * 1024
+
 	def __init__(self, id, params):
 		super(Dropbox_Dropper, self).__init__(id, params)
 		try:
 			self.access_token = params["access_token"]
+			self.data_dir = params.get("data_dir", "/var/tmp/secpi/alarms")
+			self.upload_threads = int(params.get("upload_threads", 4))
+			# files bigger than this are uploaded in chunks of this size with an upload session
+			self.chunk_size = min(int(params.get("chunk_size", 8 * 1024 * 1024)), self.MAX_SINGLE_UPLOAD)
+			self.retries = int(params.get("retries", 3))
 		except KeyError as k: # if config parameters are missing
 			logging.error("Dropxbox: Error while trying to initialize notifier, it seems there is a config parameter missing: %s" % k)
 			self.corrupted = True
 			return
+		except ValueError as ve: # if one configuration parameter can't be parsed as int
+			logging.error("Dropbox: Wasn't able to initialize the notifier, please check your configuration: %s" % ve)
+			self.corrupted = True
+			return
 
 		try:
 			self.dbx = dropbox.Dropbox(self.access_token)
@@ -22,7 +38,9 @@ class Dropbox_Dropper(Notifier):
 			self.corrupted = True
 			return
 
-		self.data_dir = "/var/tmp/secpi/alarms/" #change this maybe?
+		self.pool = ThreadPool(self.upload_threads)
+		self.uploaded = set() # files which were already uploaded while the alarm was still running
+		self.uploaded_lock = threading.Lock()
 
 		logging.info("Dropbox initialized")
 
@@ -30,26 +48,127 @@ class Dropbox_Dropper(Notifier):
 	def notify(self, info):
 		if not self.corrupted:
 			#info_str = "Recieved alarm on sensor %s from worker %s: %s"%(info['sensor'], info['worker'], info['message'])
-			latest_subdir = self.get_latest_subdir()
+			files = self.get_alarm_files(info)
+			if files is None:
+				raise Exception("No alarm folder found")
 
-			dropbox_dir = "/%s" % latest_subdir.split("/")[-1] #pfui
-			#self.dbx.files_create_folder(dropbox_dir) # shouldn't be necessary, automatically created 
-			for file in os.listdir(latest_subdir):
-				if os.path.isfile("%s/%s" % (latest_subdir, file)):
-					f = open("%s/%s" % (latest_subdir, file), "rb")
-					data = f.read()
-					try:
-						logging.info("Dropbox: Trying to upload file %s to %s" % (file, dropbox_dir))
-						res = self.dbx.files_upload(data, "%s/%s" % (dropbox_dir, file))
-						logging.info("Dropbox: Upload of file %s succeeded" % file)
-					except dropbox.exceptions.ApiError as d:
-						logging.error("Dropbox: API error: %s" % d)
-					except Exception as e: # currently this catches wrong authorization, we should change this
-						logging.error("Dropbox: Wasn't able to upload file: %s" % e)
-					f.close()
+			#self.dbx.files_create_folder(dropbox_dir) # shouldn't be necessary, automatically created
+			paths = []
+			for path in files:
+				if os.path.isfile(path):
+					with self.uploaded_lock:
+						if path in self.uploaded: # already uploaded by notify_artifact
+							self.uploaded.discard(path)
+							continue
+					paths.append(path)
+
+			# the files are uploaded in parallel, we wait for all of them so the manager knows when we're done
+			results = self.pool.map(self.upload_file, paths)
+			failed = len(results) - sum(results)
+			if failed:
+				raise Exception("Wasn't able to upload %d of %d files" % (failed, len(results)))
 		else:
-			logging.error("Dropbox: Wasn't able to notify because there was an initialization error")
+			raise Exception("Dropbox: Wasn't able to notify because there was an initialization error")
+
+	# upload files of the workers right away while the alarm is still running
+	def notify_artifact(self, info, path):
+		if not self.corrupted:
+			if self.upload_file(path):
+				with self.uploaded_lock:
+					self.uploaded.add(path)
+		else:
+			logging.error("Dropbox: Wasn't able to upload file because there was an initialization error")
+
+	# uploads a file into a folder named after its alarm directory, returns True if the upload succeeded
+	def upload_file(self, path):
+		file = os.path.basename(path)
+		dropbox_path = "/%s/%s" % (os.path.basename(os.path.dirname(path)), file)
+		size = os.path.getsize(path)
+		logging.info("Dropbox: Trying to upload file %s to %s" % (file, dropbox_path))
+		start = time.time()
+		try:
+			if size <= self.chunk_size:
+				with open(path, "rb") as f:
+					data = f.read()
+				self.with_retries(self.dbx.files_upload, data, dropbox_path, mode=dropbox.files.WriteMode.overwrite)
+			else:
+				self.upload_session(path, dropbox_path, size)
+			logging.info("Dropbox: Upload of file %s succeeded (%d bytes in %.2fs)" % (file, size, time.time() - start))
+			return True
+		except dropbox.exceptions.ApiError as d:
+			logging.error("Dropbox: API error: %s" % d)
+		except Exception as e: # currently this catches wrong authorization, we should change this
+			logging.error("Dropbox: Wasn't able to upload file: %s" % e)
+		return False
+
+	# uploads a big file in chunks, a chunk which failed is resent from the offset the server expects
+	def upload_session(self, path, dropbox_path, size):
+		with open(path, "rb") as f:
+			data = f.read(self.chunk_size)
+			session = self.with_retries(self.dbx.files_upload_session_start, data)
+			cursor = dropbox.files.UploadSessionCursor(session_id=session.session_id, offset=len(data))
+			commit = dropbox.files.CommitInfo(path=dropbox_path, mode=dropbox.files.WriteMode.overwrite)
+			logging.debug("Dropbox: Started upload session for %s (%d bytes)" % (dropbox_path, size))
+
+			while size - cursor.offset > self.chunk_size:
+				f.seek(cursor.offset)
+				data = f.read(self.chunk_size)
+				try:
+					self.with_retries(self.dbx.files_upload_session_append_v2, data, cursor)
+					cursor.offset += len(data)
+				except dropbox.exceptions.ApiError as e:
+					cursor.offset = self.correct_offset(e) # raises the error again if it isn't about the offset
+
+			while True:
+				f.seek(cursor.offset)
+				data = f.read()
+				try:
+					return self.with_retries(self.dbx.files_upload_session_finish, data, cursor, commit)
+				except dropbox.exceptions.ApiError as e:
+					cursor.offset = self.correct_offset(e)
 
+	# a chunk may have arrived although we got an error, in this case dropbox tells us where to continue
+	def correct_offset(self, api_error):
+		error = api_error.error
+		if hasattr(error, "is_lookup_failed") and error.is_lookup_failed(): # error of files_upload_session_finish
+			error = error.get_lookup_failed()
+		if hasattr(error, "is_incorrect_offset") and error.is_incorrect_offset():
+			offset = error.get_incorrect_offset().correct_offset
+			logging.info("Dropbox: Resuming upload session at offset %d" % offset)
+			return offset
+		raise api_error
+
+	# calls the given dropbox function and retries with exponential backoff if the error is only temporary
+	def with_retries(self, func, *args, **kwargs):
+		for attempt in range(0, self.retries + 1):
+			try:
+				return func(*args, **kwargs)
+			except (dropbox.exceptions.ApiError, dropbox.exceptions.AuthError, dropbox.exceptions.BadInputError):
+				raise # retrying won't help
+			except Exception as e: # rate limits, server errors and connection problems
+				if attempt >= self.retries:
+					raise
+				delay = getattr(e, "backoff", None) or 2 ** attempt
+				logging.info("Dropbox: Upload failed (%s), retrying in %d seconds" % (e, delay))
+				time.sleep(delay)
+
+	# returns the files of the alarm, the manager passes them in the info
+	def get_alarm_files(self, info):
+		if info.get('files') is not None:
+			return info['files']
+
+		alarm_dir = self.get_alarm_dir(info)
+		if alarm_dir is None:
+			return None
+		return [os.path.join(alarm_dir, f) for f in os.listdir(alarm_dir)]
+
+	# the directory of the alarm is named after its id, older alarms fall back to the latest alarm folder
+	def get_alarm_dir(self, info):
+		if info.get('alarm_id'):
+			alarm_dir = os.path.join(self.data_dir, info['alarm_id'])
+			if os.path.isdir(alarm_dir):
+				return alarm_dir
+		return self.get_latest_subdir()
 
 	def get_latest_subdir(self):
 		subdirs = []
@@ -57,9 +176,12 @@ class Dropbox_Dropper(Notifier):
 			full_path = os.path.join(self.data_dir, directory)
 			if os.path.isdir(full_path):
 				subdirs.append(full_path)
-		# TODO: check if subdirs is empty
+		if not subdirs:
+			return None
 		latest_subdir = max(subdirs, key=os.path.getmtime)
 		return latest_subdir
 
 	def cleanup(self):
-		logging.debug("Dropbox: No cleanup necessary at the moment")
\ No newline at end of file
+		if not self.corrupted:
+			self.pool.terminate()
+		logging.debug("Dropbox: Cleaned up")
@@ -1,17 +1,29 @@
+import io
 import logging
 import os
 import smtplib
+import socket
+import threading
+import zipfile
 
 from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from tools.notifier import Notifier
 
+try:
+	from PIL import Image
+except ImportError: # without pillow images are attached as they are
+	Image = None
+
 class Mailer(Notifier):
 
+	SECURITY_MODES = ["STARTTLS", "SSL", "NOSSL", "NOAUTH_NOSSL", "NOAUTH_SSL", "NOAUTH_STARTTLS"]
+
 	def __init__(self, id, params):
 		super(Mailer, self).__init__(id, params)
-		
+
 		try:
 			# SMTP Server config + data dir
 			self.data_dir = params.get("data_dir", "/var/tmp/secpi/alarms")
@@ -20,6 +32,19 @@ class Mailer(Notifier):
 			self.smtp_user = params["smtp_user"]
 			self.smtp_pass = params["smtp_pass"]
 			self.smtp_security = params["smtp_security"]
+			# seconds until connecting to or talking with the SMTP server is given up
+			self.smtp_timeout = int(params.get("smtp_timeout", 30))
+			# alarms within this number of seconds are sent together in one mail, 0 disables it
+			self.digest_window = int(params.get("digest_window", 0))
+			# attachments of one mail won't exceed this size, further files are sent in additional mails
+			self.max_mail_size = int(params.get("max_mail_size", 7 * 1024 * 1024))
+			self.max_mails = int(params.get("max_mails", 3))
+			self.extract_zips = params.get("extract_zips", "true").lower() == "true"
+			# images are scaled down so their longer side has at most this many pixels, 0 disables it
+			self.max_image_size = int(params.get("max_image_size", 1280))
+			self.jpeg_quality = int(params.get("jpeg_quality", 75))
+			# files which can't be attached are listed in the mail, with a link if this is set (e.g. https://secpi:8443)
+			self.link_base = params.get("link_base")
 		except KeyError as ke: # if config parameters are missing
 			logging.error("Mailer: Wasn't able to initialize the notifier, it seems there is a config parameter missing: %s" % ke)
 			self.corrupted = True
@@ -29,142 +54,256 @@ class Mailer(Notifier):
 			self.corrupted = True
 			return
 
+		if self.smtp_security not in self.SECURITY_MODES:
+			logging.error("Mailer: Wasn't able to initialize the notifier, unknown smtp_security: %s" % self.smtp_security)
+			self.corrupted = True
+			return
+
+		# the connection to the SMTP server is kept open and shared by all notify calls
+		self.smtp = None
+		self.smtp_lock = threading.Lock()
+
+		self.digest_infos = []
+		self.digest_timer = None
+		self.digest_lock = threading.Lock()
+
 		logging.info("Mailer: Notifier initialized")
-	
+
 	def notify(self, info):
 		if not self.corrupted:
-			# Mail setup
-			self.message = MIMEMultipart()
-			self.message["From"] = self.params["sender"]
-			self.message["To"] = self.params["recipient"]
-			self.message["Subject"] = self.params.get("subject", "SecPi Alarm")
-			self.message.attach(MIMEText(self.params.get("text", "Your SecPi raised an alarm. Please check the attached files."), "plain"))
+			if self.digest_window > 0:
+				self.add_to_digest(info)
+				return "queued"
+			else:
+				for message in self.create_messages([info]):
+					self.send_message(message)
+		else:
+			raise Exception("Mailer: Wasn't able to notify because there was an initialization error")
+
+	# collects alarms and sends them in one mail after the digest window is over
+	def add_to_digest(self, info):
+		with self.digest_lock:
+			self.digest_infos.append(info)
+			if self.digest_timer is None:
+				self.digest_timer = threading.Timer(self.digest_window, self.send_digest)
+				self.digest_timer.daemon = True
+				self.digest_timer.start()
+				logging.debug("Mailer: Waiting %d seconds for further alarms" % self.digest_window)
+
+	def send_digest(self):
+		with self.digest_lock:
+			infos = self.digest_infos
+			self.digest_infos = []
+			self.digest_timer = None
+
+		if infos:
+			logging.info("Mailer: Sending digest of %d alarms" % len(infos))
+			try:
+				for message in self.create_messages(infos):
+					self.send_message(message)
+			except Exception as e: # nobody waits for the result of the timer thread
+				logging.error("Mailer: Wasn't able to send digest: %s" % e)
+
+	def new_message(self, infos, part):
+		# Mail setup
+		message = MIMEMultipart()
+		message["From"] = self.params["sender"]
+		message["To"] = self.params["recipient"]
+		subject = self.params.get("subject", "SecPi Alarm")
+		if len(infos) > 1:
+			subject = "%s (%d alarms)" % (subject, len(infos))
+		if part > 1:
+			subject = "%s - part %d" % (subject, part)
+			message["Subject"] = subject
+			message.attach(MIMEText("Further files of the alarm.", "plain"))
+			return message
+
+		message["Subject"] = subject
+		message.attach(MIMEText(self.params.get("text", "Your SecPi raised an alarm. Please check the attached files."), "plain"))
+		for info in infos:
 			info_str = "Recieved alarm on sensor %s from worker %s: %s"%(info['sensor'], info['worker'], info['message'])
-			self.message.attach(MIMEText(info_str, "plain"))
-			
-			self.prepare_mail_attachments()
-			
-			if self.smtp_security == "STARTTLS":
-				self.send_mail_starttls()
-			elif self.smtp_security == "SSL":
-				self.send_mail_ssl()
-			elif self.smtp_security == "NOSSL":
-				self.send_mail_nossl()
-			elif self.smtp_security == "NOAUTH_NOSSL":
-				self.send_mail_noauth_nossl()
-			elif self.smtp_security == "NOAUTH_SSL":
-				self.send_mail_noauth_ssl()
-			elif self.smtp_security == "NOAUTH_STARTTLS":
-				self.send_mail_noauth_starttls()
+			message.attach(MIMEText(info_str, "plain"))
+		return message
+
+	# generator for the mails of the given alarms, the attachments are split across several mails
+	# so none exceeds the size budget. Only the attachments of one mail are held in memory at a time.
+	def create_messages(self, infos):
+		part = 1
+		message = self.new_message(infos, part)
+		message_size = 0
+		not_attached = []
+
+		attached_dirs = set()
+		for info in infos:
+			alarm_dir, files = self.get_alarm_files(info)
+			if not alarm_dir or alarm_dir in attached_dirs:
+				continue
+			attached_dirs.add(alarm_dir)
+			logging.debug("Mailer: Attaching %d files of %s" % (len(files), alarm_dir))
+
+			for name, data in self.iter_attachments(files):
+				if len(data) > self.max_mail_size or (message_size + len(data) > self.max_mail_size and part >= self.max_mails):
+					not_attached.append((alarm_dir, name))
+					logging.debug("Mailer: Not attaching '%s', size budget exceeded" % name)
+					continue
+
+				if message_size + len(data) > self.max_mail_size: # current mail is full
+					yield message
+					part += 1
+					message = self.new_message(infos, part)
+					message_size = 0
+
+				message.attach(self.create_attachment(name, data))
+				message_size += len(data)
+				logging.debug("Mailer: Attached file '%s' to message" % name)
+
+		if not_attached:
+			message.attach(MIMEText(self.not_attached_text(not_attached), "plain"))
+		yield message
+
+	# generator for the name and content of every file of an alarm, the zips of the workers are extracted
+	def iter_attachments(self, files):
+		for path in files:
+			file = os.path.basename(path)
+			if not os.path.isfile(path):
+				logging.debug("Mailer: %s is not a file" % file)
+				continue
+
+			if self.extract_zips and zipfile.is_zipfile(path):
+				prefix = os.path.splitext(file)[0][:8]
+				with zipfile.ZipFile(path, "r") as z:
+					for member in z.infolist():
+						if member.filename.endswith("/"): # directory
+							continue
+						name = "%s_%s" % (prefix, os.path.basename(member.filename))
+						yield name, self.shrink_image(name, z.read(member))
+			else:
+				with open(path, "rb") as f:
+					yield file, self.shrink_image(file, f.read())
+
+	# scales jpegs down to max_image_size, returns the data unchanged if it isn't possible
+	def shrink_image(self, name, data):
+		if Image is None or self.max_image_size <= 0 or not name.lower().endswith((".jpg", ".jpeg")):
+			return data
+
+		try:
+			img = Image.open(io.BytesIO(data))
+			if max(img.size) <= self.max_image_size:
+				return data
+			img.thumbnail((self.max_image_size, self.max_image_size))
+			out = io.BytesIO()
+			img.save(out, "JPEG", quality=self.jpeg_quality)
+			logging.debug("Mailer: Scaled down %s from %d to %d bytes" % (name, len(data), out.tell()))
+			return out.getvalue()
+		except Exception as e: # e.g. a broken image
+			logging.debug("Mailer: Wasn't able to scale down %s: %s" % (name, e))
+			return data
+
+	def create_attachment(self, name, data):
+		if name.lower().endswith((".jpg", ".jpeg")):
+			att = MIMEImage(data, "jpeg")
 		else:
-			logging.error("Mailer: Wasn't able to notify because there was an initialization error")
-		
+			att = MIMEApplication(data)
+		att.add_header('Content-Disposition','attachment; filename="%s"' % name)
+		return att
+
+	def not_attached_text(self, not_attached):
+		lines = ["The following files were too big to be attached:"]
+		for alarm_dir, name in not_attached:
+			if self.link_base:
+				# zips are extracted for the mail, so we link the folder of the alarm instead of the file
+				lines.append("%s: %s/alarmdata" % (name, self.link_base.rstrip("/")))
+			else:
+				lines.append("%s/%s" % (os.path.basename(alarm_dir), name))
+		return "\n".join(lines)
+
+	# returns the directory and the files of the alarm, the manager passes them in the info
+	def get_alarm_files(self, info):
+		if info.get('alarm_dir') is not None and info.get('files') is not None:
+			return info['alarm_dir'], info['files']
+
+		alarm_dir = self.get_alarm_dir(info)
+		if not alarm_dir:
+			return None, []
+		return alarm_dir, [os.path.join(alarm_dir, f) for f in sorted(os.listdir(alarm_dir))]
+
+	# the directory of the alarm is named after its id, older alarms fall back to the latest alarm folder
+	def get_alarm_dir(self, info):
+		if info.get('alarm_id'):
+			alarm_dir = os.path.join(self.data_dir, info['alarm_id'])
+			if os.path.isdir(alarm_dir):
+				return alarm_dir
 
-	# Search for the latest alarm folder and attach all files within it to the mail
-	def prepare_mail_attachments(self):
-		# first find the latest alarm folder
 		subdirs = []
 		for directory in os.listdir(self.data_dir):
 			full_path = os.path.join(self.data_dir, directory)
 			if os.path.isdir(full_path):
 				subdirs.append(full_path)
-		# TODO: check if subdirs is empty
-		latest_subdir = max(subdirs, key=os.path.getmtime)
-		logging.debug("Mailer: Will look into %s for data" % latest_subdir)
-		#then iterate through it and attach all the files to the mail
-		for file in os.listdir(latest_subdir):
-			# check if it really is a file
-			if os.path.isfile("%s/%s" % (latest_subdir, file)):
-				f = open("%s/%s" % (latest_subdir, file), "rb")
-				att = MIMEApplication(f.read())
-				att.add_header('Content-Disposition','attachment; filename="%s"' % file)
-				f.close()
-				self.message.attach(att)
-				logging.debug("Mailer: Attached file '%s' to message" % file)
-			else:
-				logging.debug("Mailer: %s is not a file" % file)
-		# TODO: maybe log something if there are no files?
+		if not subdirs:
+			logging.debug("Mailer: No alarm folder found")
+			return None
+		return max(subdirs, key=os.path.getmtime)
 
-	def send_mail_starttls(self):
-		logging.debug("Mailer: Trying to send mail with STARTTLS")
-		try:
-			logging.debug("Mailer: Establishing connection to SMTP server...")
-			smtp = smtplib.SMTP(self.smtp_address, self.smtp_port)
-			smtp.ehlo()
+	# sends a message over the shared connection, reconnects once if the connection was lost
+	def send_message(self, message):
+		with self.smtp_lock:
+			for attempt in range(0, 2):
+				try:
+					smtp = self.get_connection()
+					smtp.sendmail(message["From"], message["To"].split(','), message.as_string())
+					logging.info("Mailer: Mail sent")
+					return
+				except (smtplib.SMTPServerDisconnected, socket.error) as e:
+					logging.info("Mailer: Connection to SMTP server was lost: %s" % e)
+					self.close_connection()
+					if attempt > 0:
+						raise
+				except Exception as e:
+					logging.error("Mailer: Unknown error: %s" % e)
+					self.close_connection()
+					raise
+
+	# returns an open connection to the SMTP server, a new one is only established if the old one doesn't respond
+	def get_connection(self):
+		if self.smtp is not None:
+			try:
+				if self.smtp.noop()[0] == 250:
+					return self.smtp
+			except (smtplib.SMTPException, socket.error) as e:
+				logging.debug("Mailer: Health check of SMTP connection failed: %s" % e)
+			self.close_connection()
+
+		logging.debug("Mailer: Establishing connection to SMTP server with %s..." % self.smtp_security)
+		if self.smtp_security in ("SSL", "NOAUTH_SSL"):
+			smtp = smtplib.SMTP_SSL(self.smtp_address, self.smtp_port, timeout=self.smtp_timeout)
+		else:
+			smtp = smtplib.SMTP(self.smtp_address, self.smtp_port, timeout=self.smtp_timeout)
+		smtp.ehlo()
+		if self.smtp_security in ("STARTTLS", "NOAUTH_STARTTLS"):
 			smtp.starttls()
-			logging.debug("Mailer: Logging in...")
-			smtp.login(self.smtp_user, self.smtp_pass)
-			smtp.sendmail(self.message["From"], self.message["To"].split(','), self.message.as_string())
-			logging.info("Mailer: Mail sent")
-			smtp.quit()
-		except Exception as e:
-			logging.error("Mailer: Unknown error: %s" % e)
-
-	def send_mail_ssl(self):
-		logging.debug("Mailer: Trying to send mail with SSL")
-		try:
-			logging.debug("Mailer: Establishing connection to SMTP server...")
-			smtp = smtplib.SMTP_SSL(self.smtp_address, self.smtp_port)
 			smtp.ehlo()
+		if not self.smtp_security.startswith("NOAUTH"):
 			logging.debug("Mailer: Logging in...")
 			smtp.login(self.smtp_user, self.smtp_pass)
-			smtp.sendmail(self.message["From"], self.message["To"].split(','), self.message.as_string())
-			logging.info("Mailer: Mail sent")
-			smtp.quit()
-		except Exception as e:
-			logging.error("Mailer: Unknown error: %s" % e)
-
-	def send_mail_nossl(self):
-		logging.debug("Mailer: Trying to send mail without SSL")
-		try:
-			logging.debug("Mailer: Establishing connection to SMTP server...")
-			smtp = smtplib.SMTP(self.smtp_address, self.smtp_port)
-			smtp.ehlo()
-			logging.debug("Mailer: Logging in...")
-			smtp.login(self.smtp_user, self.smtp_pass)
-			smtp.sendmail(self.message["From"], self.message["To"].split(','), self.message.as_string())
-			logging.info("Mailer: Mail sent")
-			smtp.quit()
-		except Exception as e:
-			logging.error("Mailer: Unknown error: %s" % e)
-
-	def send_mail_noauth_nossl(self):
-		logging.debug("Mailer: Trying to send mail without authentication")
-		try:
-			logging.debug("Mailer: Establishing connection to SMTP server...")
-			smtp = smtplib.SMTP(self.smtp_address, self.smtp_port)
-			smtp.ehlo()
-			smtp.sendmail(self.message["From"], self.message["To"].split(','), self.message.as_string())
-			logging.info("Mailer: Mail sent")
-			smtp.quit()
-		except Exception as e:
-			logging.error("Mailer: Unknown error: %s" % e)
-	
-	def send_mail_noauth_ssl(self):
-		logging.debug("Mailer: Trying to send mail without authentication")
-		try:
-			logging.debug("Mailer: Establishing connection to SMTP server...")
-			smtp = smtplib.SMTP_SSL(self.smtp_address, self.smtp_port)
-			smtp.ehlo()
-			smtp.sendmail(self.message["From"], self.message["To"].split(','), self.message.as_string())
-			logging.info("Mailer: Mail sent")
-			smtp.quit()
-		except Exception as e:
-			logging.error("Mailer: Unknown error: %s" % e)
-	
-	def send_mail_noauth_starttls(self):
-		logging.debug("Mailer: Trying to send mail with STARTTLS")
-		try:
-			logging.debug("Mailer: Establishing connection to SMTP server...")
-			smtp = smtplib.SMTP(self.smtp_address, self.smtp_port)
-			smtp.ehlo()
-			smtp.starttls()
-			smtp.sendmail(self.message["From"], self.message["To"].split(','), self.message.as_string())
-			logging.info("Mailer: Mail sent")
-			smtp.quit()
-		except Exception as e:
-			logging.error("Mailer: Unknown error: %s" % e)
 
-	def cleanup(self):
-		logging.debug("Mailer: No cleanup necessary at the moment")
+		self.smtp = smtp
+		return smtp
 
+	def close_connection(self):
+		if self.smtp is not None:
+			try:
+				self.smtp.quit()
+			except (smtplib.SMTPException, socket.error):
+				pass
+			self.smtp = None
+
+	def cleanup(self):
+		if not self.corrupted:
+			with self.digest_lock:
+				timer = self.digest_timer
+			if timer is not None: # don't lose the collected alarms
+				timer.cancel()
+				self.send_digest()
+			with self.smtp_lock:
+				self.close_connection()
+		logging.debug("Mailer: Cleaned up")
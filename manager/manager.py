@@ -15,15 +15,93 @@ import importlib
 import json
 import logging
 import logging.config
+import multiprocessing
 import os
 import pika
 import threading
 import time
 
+from multiprocessing.pool import ThreadPool
+
+try:
+	import queue
+except ImportError: # python 2
+	import Queue as queue
+
+from tools import amqp
 from tools import config
 from tools import utils
+from tools.alarmindex import AlarmIndex
+from tools.configcache import ConfigCache
 from tools.db import database as db
+from tools.logbuffer import LogBuffer
+from tools.retention import Retention
+from tools.transfer import TransferAssembler, TransferError
 from sqlalchemy import text
+from sqlalchemy.orm import subqueryload
+
+
+# keeps track of the data replies of the workers for a single alarm
+class AlarmState(object):
+
+	def __init__(self, alarm_id, alarm_dir, num_of_workers, info):
+		self.alarm_id = alarm_id
+		self.alarm_dir = alarm_dir
+		self.num_of_workers = num_of_workers
+		self.info = info # information about the alarm which is passed to the notifiers
+		self.notify_results = {} # result records of the notifiers, keyed by notifier id
+		self.received_data_counter = 0
+		self.received_time = time.time()
+		self.data_complete = threading.Condition()
+
+	# called for every data message of a worker, wakes up the waiting notify thread
+	def data_received(self):
+		with self.data_complete:
+			self.received_data_counter += 1
+			self.data_complete.notify_all()
+
+	# blocks until all workers replied or the timeout is over, returns True if all data arrived
+	def wait_for_data(self, timeout):
+		deadline = time.time() + timeout
+		with self.data_complete:
+			while self.received_data_counter < self.num_of_workers:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					break
+				self.data_complete.wait(remaining)
+
+			return self.received_data_counter >= self.num_of_workers
+
+
+# runs the callbacks of one or more queues on its own thread, so slow callbacks (e.g. database commits)
+# neither block the connection nor hold up the deliveries of the other queues
+class DeliveryLane(threading.Thread):
+
+	def __init__(self, name, max_size=1000, max_delay=2):
+		super(DeliveryLane, self).__init__(name="thread-lane-%s" % name)
+		self.daemon = True
+		# when the lane is full the connection thread blocks, which stops reading from the socket (backpressure)
+		self.deliveries = queue.Queue(max_size)
+		self.max_delay = max_delay
+
+	# returns a callback for basic_consume which hands the delivery over to this lane
+	def wrap(self, callback):
+		def enqueue(ch, method, properties, body):
+			self.deliveries.put((callback, time.time(), ch, method, properties, body))
+		return enqueue
+
+	def run(self):
+		while True:
+			callback, received, ch, method, properties, body = self.deliveries.get()
+			delay = time.time() - received
+			if delay > self.max_delay:
+				logging.warning("Lane %s is falling behind, message waited %.3f seconds (%d queued)" % (self.name, delay, self.deliveries.qsize()))
+			try:
+				callback(ch, method, properties, body)
+			except Exception as e:
+				logging.exception("Error while processing message in %s: %s" % (self.name, e))
+			finally:
+				db.session.remove() # every message is a unit of work with its own session
 
 
 class Manager:
@@ -49,10 +127,18 @@ class Manager:
 			logging.exception("Couldn't connect to database!")
 			quit()
 		
-		self.notifiers = []
-		self.received_data_counter = 0
+		self.notifiers = {} # long-lived notifier instances, keyed by notifier id
+		self.notifier_hashes = {} # hash of module, class and params the instances were created with
 		self.alarm_dir = "/var/tmp/secpi/alarms"
-		self.current_alarm_dir = "/var/tmp/secpi/alarms"
+		try: # the alarm index and the retention need it before the first alarm
+			if not os.path.isdir(self.alarm_dir):
+				os.makedirs(self.alarm_dir)
+		except OSError as oe:
+			logging.error("Wasn't able to create alarm directory %s: %s" % (self.alarm_dir, oe))
+		self.alarm_index = AlarmIndex(self.alarm_dir) # alarm directories and their files, shared with the webinterface
+		self.alarms = {} # AlarmState objects of the alarms which are still waiting for data, keyed by alarm id
+		self.alarms_lock = threading.Lock()
+		self.offline_data_done = set() # offline alarms whose data arrived before the alarm message
 		
 		try:
 			self.data_timeout = int(config.get("data_timeout"))
@@ -66,80 +152,113 @@ class Manager:
 			self.holddown_timer = 210
 			logging.debug("Couldn't find or use config parameter for holddown timer in manager config file. Setting default value: %d" % self.holddown_timer)
 
+		try:
+			self.notify_timeout = int(config.get("notify_timeout"))
+		except Exception: # if not specified in the config file we set a default value
+			self.notify_timeout = 120
+			logging.debug("Couldn't find or use config parameter for notify timeout in manager config file. Setting default value: %d" % self.notify_timeout)
+
+		try:
+			self.notify_retries = int(config.get("notify_retries"))
+		except Exception: # if not specified in the config file we set a default value
+			self.notify_retries = 1
+			logging.debug("Couldn't find or use config parameter for notify retries in manager config file. Setting default value: %d" % self.notify_retries)
+
+		try:
+			self.notify_threads = max(1, int(config.get("notify_threads", 4)))
+		except ValueError:
+			self.notify_threads = 4
+			logging.error("Invalid value for config parameter notify_threads in manager config file. Setting default value: %d" % self.notify_threads)
+
+		# notifiers run in parallel, so a slow one doesn't delay the others
+		self.notify_pool = ThreadPool(self.notify_threads)
+		self.notify_lock = threading.Lock()
+		self.notify_stuck = {} # notifier id -> (pool, result) of a call which timed out but is still running
+		self.notifier_calls = {} # notifier -> number of its calls which are still running
+		self.retired_notifiers = set() # replaced notifiers which are cleaned up once their calls are done
+
+		# workers send the files of their actions as soon as they are created, which are then forwarded to the notifiers
+		self.incremental_data = str(config.get("incremental_data", False)).lower() == "true"
+
 		self.holddown_state = False
 		self.num_of_workers = 0
+		self.transfers = TransferAssembler(self.data_timeout) # reassembles the chunked data of the workers
+		self.worker_configs = ConfigCache()
 
+		# old alarm data is deleted so the disk doesn't fill up
+		retention_settings = {}
+		for key, default in (("max_bytes", 1024 * 1024 * 1024), ("max_age", 0), ("keep_last", 10), ("interval", 300)):
+			try:
+				retention_settings[key] = int(config.get("retention_%s" % key, default))
+			except ValueError:
+				retention_settings[key] = default
+				logging.error("Invalid value for config parameter retention_%s in manager config file. Setting default value: %d" % (key, default))
+		self.retention = Retention(self.alarm_index, pin_acked=str(config.get("retention_pin_acked", True)).lower() == "true", is_active=self.is_alarm_active, **retention_settings)
+		self.retention.start()
+
+		# log entries are written to the database in batches
+		self.log_buffer = LogBuffer()
+		self.log_buffer.start()
+
+		# messages are only published by the connection thread, other threads put them into this queue
+		self.outgoing = queue.Queue()
+		# alarms have their own lane so they never wait for log or data messages
+		self.lanes = {
+			"alarm": DeliveryLane("alarm"),
+			"log": DeliveryLane("log"),
+			"data": DeliveryLane("data")
+		}
+		for lane in self.lanes.values():
+			lane.start()
+
+		self.setup_topology()
 		self.connect()
 
 		# debug output, setups & state
-		setups = db.session.query(db.objects.Setup).all()
-		rebooted = False
-		for setup in setups:
-			logging.debug("name: %s active:%s" % (setup.name, setup.active_state))
-			if setup.active_state:
-				rebooted = True
-
-		if rebooted:
-			self.setup_notifiers()
-			self.num_of_workers = db.session.query(db.objects.Worker).join((db.objects.Action, db.objects.Worker.actions)).filter(db.objects.Worker.active_state == True).filter(db.objects.Action.active_state == True).count()
+		with db.session_scope() as session:
+			setups = session.query(db.objects.Setup).all()
+			rebooted = False
+			for setup in setups:
+				logging.debug("name: %s active:%s" % (setup.name, setup.active_state))
+				if setup.active_state:
+					rebooted = True
+
+			if rebooted:
+				self.setup_notifiers()
+				self.num_of_workers = session.query(db.objects.Worker).join((db.objects.Action, db.objects.Worker.actions)).filter(db.objects.Worker.active_state == True).filter(db.objects.Action.active_state == True).count()
 
 		logging.info("Setup done!")
 
-	def connect(self):
-		logging.debug("Initializing connection to rabbitmq service")
-		credentials = pika.PlainCredentials(config.get('rabbitmq')['user'], config.get('rabbitmq')['password'])
-		parameters = pika.ConnectionParameters(credentials=credentials,
-			host=config.get('rabbitmq')['master_ip'],
-			port=5671,
-			ssl=True,
-			socket_timeout=10,
-			ssl_options = {
-				"ca_certs":PROJECT_PATH+"/certs/"+config.get('rabbitmq')['cacert'],
-				"certfile":PROJECT_PATH+"/certs/"+config.get('rabbitmq')['certfile'],
-				"keyfile":PROJECT_PATH+"/certs/"+config.get('rabbitmq')['keyfile']
-			}
-		)
-		
-		connected = False
-		while not connected: #retry if establishing a connection fails
-			try:
-				self.connection = pika.BlockingConnection(parameters=parameters)
-				self.channel = self.connection.channel()
-				connected = True
-				logging.info("Connection to rabbitmq service established")
-			except pika.exceptions.AMQPConnectionError as pe: # if connection can't be established
-				logging.error("Wasn't able to connect to rabbitmq service: %s" % pe)
-				time.sleep(30)
-
-		#define exchange
-		self.channel.exchange_declare(exchange=utils.EXCHANGE, exchange_type='direct')
+	def setup_topology(self):
+		self.topology = amqp.Topology(utils.EXCHANGE)
 
 		#define queues: data, alarm and action & config for every pi
-		self.channel.queue_declare(queue=utils.QUEUE_DATA)
-		self.channel.queue_declare(queue=utils.QUEUE_ALARM)
-		self.channel.queue_declare(queue=utils.QUEUE_ON_OFF)
-		self.channel.queue_declare(queue=utils.QUEUE_LOG)
-		self.channel.queue_declare(queue=utils.QUEUE_INIT_CONFIG)
-		self.channel.queue_bind(exchange=utils.EXCHANGE, queue=utils.QUEUE_ON_OFF)
-		self.channel.queue_bind(exchange=utils.EXCHANGE, queue=utils.QUEUE_DATA)
-		self.channel.queue_bind(exchange=utils.EXCHANGE, queue=utils.QUEUE_ALARM)
-		self.channel.queue_bind(exchange=utils.EXCHANGE, queue=utils.QUEUE_LOG)
-		self.channel.queue_bind(exchange=utils.EXCHANGE, queue=utils.QUEUE_INIT_CONFIG)
-		
-		# load workers from db
-		workers = db.session.query(db.objects.Worker).all()
-		for pi in workers:
-			self.channel.queue_declare(queue=utils.QUEUE_ACTION+str(pi.id))
-			self.channel.queue_declare(queue=utils.QUEUE_CONFIG+str(pi.id))
-			self.channel.queue_bind(exchange=utils.EXCHANGE, queue=utils.QUEUE_ACTION+str(pi.id))
-			self.channel.queue_bind(exchange=utils.EXCHANGE, queue=utils.QUEUE_CONFIG+str(pi.id))
+		for name in (utils.QUEUE_ON_OFF, utils.QUEUE_DATA, utils.QUEUE_ALARM, utils.QUEUE_LOG, utils.QUEUE_INIT_CONFIG, utils.QUEUE_CONFIG_CHANGED):
+			self.topology.add_queue(name)
 
 		#define callbacks for alarm and data queues
-		self.channel.basic_consume(self.got_alarm, queue=utils.QUEUE_ALARM, no_ack=True)
-		self.channel.basic_consume(self.got_on_off, queue=utils.QUEUE_ON_OFF, no_ack=True)
-		self.channel.basic_consume(self.got_data, queue=utils.QUEUE_DATA, no_ack=True)
-		self.channel.basic_consume(self.got_log, queue=utils.QUEUE_LOG, no_ack=True)
-		self.channel.basic_consume(self.got_config_request, queue=utils.QUEUE_INIT_CONFIG, no_ack=True)
+		self.topology.add_consumer(utils.QUEUE_ALARM, self.lanes["alarm"].wrap(self.got_alarm))
+		self.topology.add_consumer(utils.QUEUE_ON_OFF, self.lanes["alarm"].wrap(self.got_on_off))
+		self.topology.add_consumer(utils.QUEUE_DATA, self.lanes["data"].wrap(self.got_data))
+		self.topology.add_consumer(utils.QUEUE_LOG, self.lanes["log"].wrap(self.got_log))
+		self.topology.add_consumer(utils.QUEUE_INIT_CONFIG, self.lanes["alarm"].wrap(self.got_config_request))
+		self.topology.add_consumer(utils.QUEUE_CONFIG_CHANGED, self.lanes["alarm"].wrap(self.got_config_changed))
+
+		self.amqp = amqp.Connection(PROJECT_PATH, self.topology)
+
+	def connect(self):
+		logging.debug("Initializing connection to rabbitmq service")
+
+		# load workers from db, there might be new ones since the last connect
+		with db.session_scope() as session:
+			worker_ids = [pi.id for pi in session.query(db.objects.Worker.id)]
+		for pi_id in worker_ids:
+			self.topology.add_queue(utils.QUEUE_ACTION+str(pi_id))
+			self.topology.add_queue(utils.QUEUE_CONFIG+str(pi_id))
+
+		self.amqp.connect()
+		self.connection = self.amqp.connection
+		self.channel = self.amqp.channel
 
 	
 	def start(self):
@@ -147,11 +266,13 @@ class Manager:
 		while disconnected:
 			try:
 				disconnected = False
-				self.channel.start_consuming() # blocking call
-			except pika.exceptions.ConnectionClosed: # when connection is lost, e.g. rabbitmq not running
+				# event loop: receive deliveries and hand them to the lanes, publish the queued messages
+				while True:
+					self.connection.process_data_events(time_limit=0.05)
+					self.publish_outgoing()
+			except (pika.exceptions.ConnectionClosed, pika.exceptions.ChannelClosed): # when connection is lost, e.g. rabbitmq not running
 				logging.error("Lost connection to rabbitmq service")
 				disconnected = True
-				time.sleep(10) # reconnect timer
 				logging.info("Trying to reconnect...")
 				self.connect()
 	
@@ -177,40 +298,43 @@ class Manager:
 			self.log_err("Couldn't find class %s: %s"%(class_name, ae))
 	
 
-	# this method is used to send messages to a queue
+	# this method is used to send messages to a queue, it is safe to call it from any thread
 	def send_message(self, rk, body, **kwargs):
-		try:
-			self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=rk, body=body, **kwargs)
-			logging.info("Sending data to %s" % rk)
-			return True
-		except Exception as e:
-			logging.exception("Error while sending data to queue:\n%s" % e)
-			return False
+		self.outgoing.put((rk, body, kwargs))
+		logging.info("Queued data for %s" % rk)
+		return True
 	
 	# this method is used to send json messages to a queue
 	def send_json_message(self, rk, body, **kwargs):
-		try:
-			properties = pika.BasicProperties(content_type='application/json')
-			self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=rk, body=json.dumps(body), properties=properties, **kwargs)
-			logging.info("Sending json data to %s" % rk)
-			return True
-		except Exception as e:
-			logging.exception("Error while sending json data to queue:\n%s" % e)
-			return False
+		properties = pika.BasicProperties(content_type='application/json')
+		return self.send_message(rk, json.dumps(body), properties=properties, **kwargs)
+
+	# publishes the queued messages, must only be called by the connection thread
+	def publish_outgoing(self):
+		while True:
+			try:
+				rk, body, kwargs = self.outgoing.get_nowait()
+			except queue.Empty:
+				return
+
+			try:
+				self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=rk, body=body, **kwargs)
+				logging.debug("Sent data to %s" % rk)
+			except pika.exceptions.ConnectionClosed: # keep the message and send it after the reconnect
+				self.outgoing.put((rk, body, kwargs))
+				raise
+			except Exception as e:
+				logging.exception("Error while sending data to queue:\n%s" % e)
 	
 	# helper method to create error log entry
 	def log_err(self, msg):
 		logging.exception(msg)
-		log_entry = db.objects.LogEntry(level=utils.LEVEL_ERR, message=str(msg), sender="Manager")
-		db.session.add(log_entry)
-		db.session.commit()
+		self.log_buffer.add(utils.LEVEL_ERR, str(msg), "Manager")
 	
 	# helper method to create error log entry
 	def log_msg(self, msg, level):
 		logging.info(msg)
-		log_entry = db.objects.LogEntry(level=level, message=str(msg), sender="Manager")
-		db.session.add(log_entry)
-		db.session.commit()
+		self.log_buffer.add(level, str(msg), "Manager")
 	
 	
 	def got_config_request(self, ch, method, properties, body):
@@ -218,59 +342,134 @@ class Manager:
 		logging.info("Got config request with following IP addresses: %s" % ip_addresses)
 
 		pi_id = None
-		worker = db.session.query(db.objects.Worker).filter(db.objects.Worker.address.in_(ip_addresses)).first()
+		with db.session_scope() as session:
+			worker = session.query(db.objects.Worker.id, db.objects.Worker.address).filter(db.objects.Worker.address.in_(ip_addresses)).first()
 		if worker:
 			pi_id = worker.id
 			logging.debug("Found worker id %s for IP address %s" % (pi_id, worker.address))
 		else: # wasn't able to find worker with given ip address(es)
 			logging.error("Wasn't able to find worker for given IP adress(es)")
 			reply_properties = pika.BasicProperties(correlation_id=properties.correlation_id)
-			self.channel.basic_publish(exchange=utils.EXCHANGE, properties=reply_properties, routing_key=properties.reply_to, body="")
+			self.send_message(properties.reply_to, "", properties=reply_properties)
 			return
 		
 		config = self.prepare_config(pi_id)
 		logging.info("Sending intial config to worker with id %s" % pi_id)
 		reply_properties = pika.BasicProperties(correlation_id=properties.correlation_id, content_type='application/json')
-		self.channel.basic_publish(exchange=utils.EXCHANGE, properties=reply_properties, routing_key=properties.reply_to, body=json.dumps(config))
+		self.send_message(properties.reply_to, json.dumps(config), properties=reply_properties)
 
 	# callback method for when the manager recieves data after a worker executed its actions
 	def got_data(self, ch, method, properties, body):
-		logging.info("Got data")
-		newFile_bytes = bytearray(body)
-		if newFile_bytes: #only write data when body is not empty
+		alarm_id = properties.correlation_id
+		logging.debug("Got data for alarm %s" % alarm_id)
+
+		with self.alarms_lock:
+			if alarm_id is None and self.alarms: # reply of a worker which doesn't send alarm ids yet, assign it to the latest alarm
+				alarm_id = max(self.alarms)
+				logging.warning("Got data without alarm id, assuming it belongs to alarm %s" % alarm_id)
+			alarm = self.alarms.get(alarm_id)
+
+		headers = properties.headers or {}
+		if alarm:
+			alarm_dir = alarm.alarm_dir
+		elif utils.is_alarm_id(alarm_id) and os.path.isdir("%s/%s" % (self.alarm_dir, alarm_id)):
+			# the alarm isn't waiting anymore, but we still store the data in the right place
+			alarm_dir = "%s/%s" % (self.alarm_dir, alarm_id)
+			logging.info("Received late data for alarm %s" % alarm_id)
+		elif utils.is_alarm_id(alarm_id) and headers.get("offline"):
+			# data of an offline alarm of a worker, the alarm message is handled by another lane and might not be there yet
+			alarm_dir = "%s/%s" % (self.alarm_dir, alarm_id)
+			try:
+				os.makedirs(alarm_dir)
+			except OSError as oe:
+				if not os.path.isdir(alarm_dir):
+					logging.exception("Wasn't able to create directory for alarm %s: %s" % (alarm_id, oe))
+					return
+			logging.info("Received data of offline alarm %s" % alarm_id)
+		else:
+			logging.error("Received data for unknown alarm %s, discarding it" % alarm_id)
+			return
+
+		if "transfer_id" in headers: # chunked transfer, the file is reassembled on disk
+			try:
+				path = self.transfers.add_chunk(alarm_dir, headers, body)
+			except TransferError as te: # the data isn't counted as received, the alarm waits for the data timeout
+				self.log_err("Wasn't able to receive data of alarm %s: %s" % (alarm_id, te))
+				return
+			except (IOError, OSError) as e: # File can't be written, e.g. permissions wrong, directory doesn't exist
+				logging.exception("Wasn't able to write received data: %s" % e)
+				return
+			else:
+				if path is None: # wait for the remaining chunks
+					return
+				logging.info("Data written to %s" % path)
+				self.index_file(alarm_id, path)
+				if headers.get("artifact"): # file of an action which is still running, more data will follow
+					if alarm:
+						self.forward_artifact(alarm, path)
+					return
+		elif body: # data sent in one message by an older worker
+			newFile_bytes = bytearray(body)
+			path = "%s/%s.zip" % (alarm_dir, hashlib.md5(newFile_bytes).hexdigest())
 			try:
-				newFile = open("%s/%s.zip" % (self.current_alarm_dir, hashlib.md5(newFile_bytes).hexdigest()), "wb")
+				newFile = open(path, "wb")
 				newFile.write(newFile_bytes)
+				newFile.close()
 				logging.info("Data written")
+				self.index_file(alarm_id, path)
 			except IOError as ie: # File can't be written, e.g. permissions wrong, directory doesn't exist
 				logging.exception("Wasn't able to write received data: %s" % ie)
-		self.received_data_counter += 1
+
+		# the alarm is looked up again, an offline alarm might have arrived in the meantime
+		with self.alarms_lock:
+			alarm = self.alarms.get(alarm_id)
+			if alarm:
+				alarm.data_received()
+			elif headers.get("offline"):
+				self.offline_data_done.add(alarm_id)
+
+	def is_alarm_active(self, alarm_id):
+		with self.alarms_lock:
+			return alarm_id in self.alarms
+
+	# adds a received file to the alarm index, the data is kept even if the index can't be written
+	def index_file(self, alarm_id, path):
+		try:
+			self.alarm_index.add_file(alarm_id, path)
+		except (IOError, OSError) as e:
+			logging.error("Wasn't able to add %s to the alarm index: %s" % (path, e))
 
 	# callback for log messages
 	def got_log(self, ch, method, properties, body):
 		log = json.loads(body)
 		logging.debug("Got log message from %s: %s"%(log['sender'], log['msg']))
-		log_entry = db.objects.LogEntry(level=log['level'], message=str(log['msg']), sender=log['sender'], logtime=utils.str_to_value(log['datetime']))
-		db.session.add(log_entry)
-		db.session.commit()
+		self.log_buffer.add(log['level'], str(log['msg']), log['sender'], utils.str_to_value(log['datetime']))
+
+	# callback for when the webinterface changed sensors, actions, zones, setups or params
+	def got_config_changed(self, ch, method, properties, body):
+		logging.info("Worker configuration was changed")
+		self.worker_configs.invalidate()
 
 	# callback for when a setup gets activated/deactivated
 	def got_on_off(self, ch, method, properties, body):
 		msg = json.loads(body)
 		
-		self.cleanup_notifiers()
+		self.worker_configs.invalidate() # the active state of the setup changed
+		# notifiers stay warm while setups are toggled, only changed notifiers are recreated
+		self.setup_notifiers()
 		
 		if(msg['active_state'] == True):
-			self.setup_notifiers()
 			logging.info("Activating setup: %s" % msg['setup_name'])
 		
 		
-		workers = db.session.query(db.objects.Worker).filter(db.objects.Worker.active_state == True).all()
+		with db.session_scope() as session:
+			workers = session.query(db.objects.Worker.id, db.objects.Worker.name).filter(db.objects.Worker.active_state == True).all()
 		for pi in workers:
 			config = self.prepare_config(pi.id)
 			# check if we are deactivating --> worker should be deactivated!
 			if(msg['active_state'] == False):
 				config["active"] = False
+				config["version"] = self.worker_configs.config_hash(config)
 				logging.info("Deactivating setup: %s" % msg['setup_name'])
 				
 			self.send_json_message(utils.QUEUE_CONFIG+str(pi.id), config)
@@ -279,6 +478,10 @@ class Manager:
 	# callback method which gets called when a worker raises an alarm
 	def got_alarm(self, ch, method, properties, body):
 		msg = json.loads(body)
+		if msg.get("offline") and utils.is_alarm_id(msg.get("alarm_id")):
+			self.got_offline_alarm(msg)
+			return
+
 		late_arrival = utils.check_late_arrival(datetime.datetime.strptime(msg["datetime"], "%Y-%m-%d %H:%M:%S"))
 
 		if not late_arrival:
@@ -286,94 +489,323 @@ class Manager:
 		else:
 			logging.info("Received old alarm: %s"%body)
 
-		if not self.holddown_state:
-			# put into holddown
-			holddown_thread = threading.Thread(name="thread-holddown", target=self.holddown)
-			holddown_thread.start()
-
-			self.current_alarm_dir = "%s/%s" % (self.alarm_dir, time.strftime("/%Y%m%d_%H%M%S"))
-			try:
-				os.makedirs(self.current_alarm_dir)
-				logging.debug("Created directory for alarm: %s" % self.current_alarm_dir)
-			except OSError as oe: # directory can't be created, e.g. permissions wrong, or already exists
-				logging.exception("Wasn't able to create directory for current alarm: %s" % oe)
-			self.received_data_counter = 0
-
-			# iterate over workers and send "execute"
-			workers = db.session.query(db.objects.Worker).join((db.objects.Action, db.objects.Worker.actions)).filter(db.objects.Worker.active_state == True).filter(db.objects.Action.active_state == True).all()
-			self.num_of_workers = len(workers)
-			action_message = { "msg": "execute",
-								"datetime": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-								"late_arrival":late_arrival}
-			for pi in workers:
-				self.send_json_message(utils.QUEUE_ACTION+str(pi.id), action_message)
-			
-			worker = db.session.query(db.objects.Worker).filter(db.objects.Worker.id == msg['pi_id']).first()
-			sensor = db.session.query(db.objects.Sensor).filter(db.objects.Sensor.id == msg['sensor_id']).first()
-			
-			# create log entry for db
-			if not late_arrival:
-				al = db.objects.Alarm(sensor_id=msg['sensor_id'], message=msg['message'])
-				self.log_msg("New alarm from %s on sensor %s: %s"%( (worker.name if worker else msg['pi_id']) , (sensor.name if sensor else msg['sensor_id']) , msg['message']), utils.LEVEL_WARN)
-			else:
-				al = db.objects.Alarm(sensor_id=msg['sensor_id'], message="Late Alarm: %s" %msg['message'])
-				self.log_msg("Old alarm from %s on sensor %s: %s"%( (worker.name if worker else msg['pi_id']) , (sensor.name if sensor else msg['sensor_id']) , msg['message']), utils.LEVEL_WARN)
+		with db.session_scope() as session:
+			if not self.holddown_state:
+				# put into holddown
+				holddown_thread = threading.Thread(name="thread-holddown", target=self.holddown)
+				holddown_thread.start()
+
+				alarm_id = utils.create_alarm_id()
+				alarm_dir = "%s/%s" % (self.alarm_dir, alarm_id)
+				try:
+					os.makedirs(alarm_dir)
+					logging.debug("Created directory for alarm %s: %s" % (alarm_id, alarm_dir))
+				except (IOError, OSError) as oe: # directory can't be created, e.g. permissions wrong, or already exists
+					logging.exception("Wasn't able to create directory for alarm %s: %s" % (alarm_id, oe))
+
+				worker = session.query(db.objects.Worker).filter(db.objects.Worker.id == msg['pi_id']).first()
+				sensor = session.query(db.objects.Sensor).filter(db.objects.Sensor.id == msg['sensor_id']).first()
+
+				# TODO: add information about late arrival of alarm
+				notif_info = {
+					"alarm_id": alarm_id,
+					"alarm_dir": alarm_dir,
+					"files": [], # filled in once the data of the workers arrived
+					"message": msg['message'],
+					"sensor": (sensor.name if sensor else msg['sensor_id']),
+					"sensor_id": msg['sensor_id'],
+					"worker": (worker.name if worker else msg['pi_id']),
+					"worker_id": msg['pi_id']
+				}
+
+				# iterate over workers and send "execute"
+				workers = session.query(db.objects.Worker).join((db.objects.Action, db.objects.Worker.actions)).filter(db.objects.Worker.active_state == True).filter(db.objects.Action.active_state == True).all()
+				self.num_of_workers = len(workers)
+				alarm = AlarmState(alarm_id, alarm_dir, self.num_of_workers, notif_info)
+				with self.alarms_lock:
+					self.alarms[alarm_id] = alarm
+				action_message = { "msg": "execute",
+									"alarm_id": alarm_id,
+									"incremental": self.incremental_data,
+									"datetime": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+									"late_arrival":late_arrival}
+				for pi in workers:
+					self.send_json_message(utils.QUEUE_ACTION+str(pi.id), action_message)
 			
-			db.session.add(al)
-			db.session.commit()
+				# create log entry for db
+				if not late_arrival:
+					al = db.objects.Alarm(sensor_id=msg['sensor_id'], message=msg['message'])
+					self.log_msg("New alarm %s from %s on sensor %s: %s"%(alarm_id, (worker.name if worker else msg['pi_id']) , (sensor.name if sensor else msg['sensor_id']) , msg['message']), utils.LEVEL_WARN)
+				else:
+					al = db.objects.Alarm(sensor_id=msg['sensor_id'], message="Late Alarm: %s" %msg['message'])
+					self.log_msg("Old alarm %s from %s on sensor %s: %s"%(alarm_id, (worker.name if worker else msg['pi_id']) , (sensor.name if sensor else msg['sensor_id']) , msg['message']), utils.LEVEL_WARN)
 			
-			# TODO: add information about late arrival of alarm
+				session.add(al)
+				session.commit() # the alarm is stored right away, the id is needed for the alarm index
+				try: # acknowledged alarms are kept by the retention
+					self.alarm_index.add_alarm(alarm_id, db_id=al.id)
+				except (IOError, OSError) as e:
+					logging.error("Wasn't able to add alarm %s to the alarm index: %s" % (alarm_id, e))
+				self.retention.trigger()
+
+				# start timeout thread for workers to reply
+				timeout_thread = threading.Thread(name="thread-timeout", target=self.notify, args=[alarm])
+				timeout_thread.start()
+			else: # --> holddown state
+				self.log_msg("Alarm during holddown state from %s on sensor %s: %s"%(msg['pi_id'], msg['sensor_id'], msg['message']), utils.LEVEL_INFO)
+				al = db.objects.Alarm(sensor_id=msg['sensor_id'], message="Alarm during holddown state: %s" % msg['message'])
+				session.add(al)
+
+	# alarm which a worker handled on its own while it had no connection: it executed its actions right away and
+	# sends their data under the alarm id it created, so it's accepted no matter how late it arrives,
+	# the other workers aren't asked to execute their actions since the alarm is over already
+	def got_offline_alarm(self, msg):
+		alarm_id = msg["alarm_id"]
+		alarm_dir = "%s/%s" % (self.alarm_dir, alarm_id)
+		alarm_time = datetime.datetime.strptime(msg["datetime"], "%Y-%m-%d %H:%M:%S")
+		logging.info("Received offline alarm: %s" % msg)
+
+		try:
+			entry = self.alarm_index.get(alarm_id)
+		except (IOError, OSError) as e:
+			logging.error("Wasn't able to read the alarm index: %s" % e)
+			entry = None
+
+		with db.session_scope() as session:
+			worker = session.query(db.objects.Worker).filter(db.objects.Worker.id == msg['pi_id']).first()
+			sensor = session.query(db.objects.Sensor).filter(db.objects.Sensor.id == msg['sensor_id']).first()
+			worker_name = worker.name if worker else msg['pi_id']
+			sensor_name = sensor.name if sensor else msg['sensor_id']
+
+			if entry and entry.get("db_id") is not None: # the worker was still busy with the actions of this alarm
+				self.log_msg("Offline alarm during holddown state from %s on sensor %s at %s: %s" % (worker_name, sensor_name, msg['datetime'], msg['message']), utils.LEVEL_INFO)
+				session.add(db.objects.Alarm(sensor_id=msg['sensor_id'], alarmtime=alarm_time, message="Offline alarm during holddown state: %s" % msg['message']))
+				return
+
+			try:
+				os.makedirs(alarm_dir)
+			except OSError as oe:
+				if not os.path.isdir(alarm_dir): # it already exists if the data was faster
+					logging.exception("Wasn't able to create directory for alarm %s: %s" % (alarm_id, oe))
+
 			notif_info = {
-				"message": msg['message'],
-				"sensor": (sensor.name if sensor else msg['sensor_id']),
+				"alarm_id": alarm_id,
+				"alarm_dir": alarm_dir,
+				"files": [], # filled in once the data of the worker arrived
+				"message": "Offline alarm at %s: %s" % (msg['datetime'], msg['message']),
+				"sensor": sensor_name,
 				"sensor_id": msg['sensor_id'],
-				"worker": (worker.name if worker else msg['pi_id']),
+				"worker": worker_name,
 				"worker_id": msg['pi_id']
 			}
 
-			# start timeout thread for workers to reply
-			timeout_thread = threading.Thread(name="thread-timeout", target=self.notify, args=[notif_info])
-			timeout_thread.start()
-		else: # --> holddown state
-			self.log_msg("Alarm during holddown state from %s on sensor %s: %s"%(msg['pi_id'], msg['sensor_id'], msg['message']), utils.LEVEL_INFO)
-			al = db.objects.Alarm(sensor_id=msg['sensor_id'], message="Alarm during holddown state: %s" % msg['message'])
-			db.session.add(al)
-			db.session.commit()
+			# only the worker which raised the alarm sends data
+			alarm = AlarmState(alarm_id, alarm_dir, 1, notif_info)
+			with self.alarms_lock:
+				self.alarms[alarm_id] = alarm
+				if alarm_id in self.offline_data_done:
+					self.offline_data_done.discard(alarm_id)
+					alarm.data_received()
+
+			al = db.objects.Alarm(sensor_id=msg['sensor_id'], alarmtime=alarm_time, message="Offline alarm: %s" % msg['message'])
+			self.log_msg("Offline alarm %s from %s on sensor %s at %s: %s" % (alarm_id, worker_name, sensor_name, msg['datetime'], msg['message']), utils.LEVEL_WARN)
+			session.add(al)
+			session.commit() # the alarm is stored right away, the id is needed for the alarm index
+			try:
+				self.alarm_index.add_alarm(alarm_id, created=time.mktime(alarm_time.timetuple()), db_id=al.id)
+			except (IOError, OSError) as e:
+				logging.error("Wasn't able to add alarm %s to the alarm index: %s" % (alarm_id, e))
+			self.retention.trigger()
+
+		timeout_thread = threading.Thread(name="thread-timeout", target=self.notify, args=[alarm])
+		timeout_thread.start()
 
-	# initialize the notifiers
+	# initialize the notifiers, instances whose configuration didn't change are kept
 	def setup_notifiers(self):
-		notifiers = db.session.query(db.objects.Notifier).filter(db.objects.Notifier.active_state == True).all()
+		pool = {}
+		hashes = {}
+		with db.session_scope() as session:
+			notifiers = []
+			for notifier in session.query(db.objects.Notifier).filter(db.objects.Notifier.active_state == True).options(subqueryload(db.objects.Notifier.params)):
+				notifiers.append((notifier.id, notifier.module, notifier.cl, dict((p.key, p.value) for p in notifier.params)))
 		
-		for notifier in notifiers:
-			params = {}
-			for p in notifier.params:
-				params[p.key] = p.value
-				
-			n = self.class_for_name(notifier.module, notifier.cl)
-			noti = n(notifier.id, params)
-			self.notifiers.append(noti)
-			logging.info("Set up notifier %s" % notifier.cl)
-
-	# timeout thread which sends the received data from workers
-	def notify(self, info):
-		for i in range(0, self.data_timeout):
-			if self.received_data_counter < self.num_of_workers: #not all data here yet
-				logging.debug("Waiting for data from workers: data counter: %d, #workers: %d" % (self.received_data_counter, self.num_of_workers))
-				time.sleep(1)
-			else:
-				logging.debug("Received all data from workers, canceling the timeout")
-				break
-		# continue code execution
-		if self.received_data_counter < self.num_of_workers:
-			self.log_msg("TIMEOUT: Only %d out of %d workers replied with data"%(self.received_data_counter, self.num_of_workers), utils.LEVEL_INFO)
+		for notifier_id, module, cl, params in notifiers:
+			notifier_hash = hashlib.md5(json.dumps([module, cl, params], sort_keys=True).encode("utf-8")).hexdigest()
+			# corrupted instances are recreated, e.g. the modem might be plugged in by now
+			if self.notifier_hashes.get(notifier_id) == notifier_hash and not self.notifiers[notifier_id].corrupted:
+				pool[notifier_id] = self.notifiers[notifier_id]
+				hashes[notifier_id] = notifier_hash
+				logging.debug("Notifier %s didn't change" % cl)
+				continue
+			
+			try:
+				n = self.class_for_name(module, cl)
+				noti = n(notifier_id, params)
+			except Exception as e:
+				self.log_err("Wasn't able to set up notifier %s: %s" % (cl, e))
+				continue
+			
+			pool[notifier_id] = noti
+			hashes[notifier_id] = notifier_hash
+			logging.info("Set up notifier %s" % cl)
 		
-		# let the notifiers do their work
-		for notifier in self.notifiers:
+		# stop the notifiers which were removed, deactivated or changed, the busy ones once their calls are done
+		removed = []
+		with self.notify_lock:
+			for notifier_id, noti in self.notifiers.items():
+				if pool.get(notifier_id) is not noti:
+					if noti in self.notifier_calls:
+						self.retired_notifiers.add(noti)
+					else:
+						removed.append(noti)
+			self.notifiers = pool
+			self.notifier_hashes = hashes
+		
+		for noti in removed:
+			noti.cleanup()
+			logging.info("Removed notifier %s" % noti.id)
+
+	# timeout thread which sends the received data from workers, wakes up as soon as the last worker replied
+	def notify(self, alarm):
+		logging.debug("Waiting for data from %d workers" % alarm.num_of_workers)
+		if alarm.wait_for_data(self.data_timeout):
+			logging.debug("Received all data from workers, canceling the timeout")
+		else:
+			self.log_msg("TIMEOUT: Only %d out of %d workers replied with data for alarm %s"%(alarm.received_data_counter, alarm.num_of_workers, alarm.alarm_id), utils.LEVEL_INFO)
+
+		with self.alarms_lock:
+			self.alarms.pop(alarm.alarm_id, None)
+
+		# the notifiers get the exact files of this alarm, so they don't have to look for them
+		try:
+			alarm.info["files"] = self.alarm_index.files(alarm.alarm_id)
+		except (IOError, OSError) as e:
+			logging.error("Wasn't able to read the alarm index: %s" % e)
+
+		# let the notifiers do their work, all of them at the same time
+		logging.info("Alarm %s: alarm -> notify latency: %.3f seconds" % (alarm.alarm_id, time.time() - alarm.received_time))
+		start = time.time()
+		pending = []
+		with self.notify_lock:
+			notifiers = list(self.notifiers.values())
+			pool = self.get_notify_pool(notifiers)
+			for notifier in notifiers:
+				if notifier.id in self.notify_stuck: # a hanging notifier only ever blocks one thread
+					alarm.notify_results[notifier.id] = {"notifier": notifier.__class__.__name__, "status": "skipped", "attempts": 0, "duration": 0, "error": "previous notification is still running"}
+					continue
+				timeout = self.notifier_setting(notifier, "timeout", self.notify_timeout)
+				pending.append((notifier, timeout, pool, self.submit_notifier(pool, self.run_notifier, notifier, alarm.info)))
+		
+		for notifier, timeout, pool, result in pending:
 			try:
-				notifier.notify(info)
+				record = result.get(max(0, start + timeout - time.time()))
+			except multiprocessing.TimeoutError: # the notifier keeps running, but we don't wait for it any longer
+				record = {"notifier": notifier.__class__.__name__, "status": "timeout", "attempts": None, "duration": timeout, "error": None}
+				with self.notify_lock:
+					self.notify_stuck[notifier.id] = (pool, result)
+			alarm.notify_results[notifier.id] = record
+		
+		for notifier_id, record in alarm.notify_results.items():
+			if record["status"] not in ("success", "queued"):
+				self.log_msg("Alarm %s: notifier %s (%s) failed with status %s: %s" % (alarm.alarm_id, notifier_id, record["notifier"], record["status"], record["error"]), utils.LEVEL_WARN)
+		
+		logging.info("Alarm %s: notifiers finished %.3f seconds after the alarm was received: %s" % (alarm.alarm_id, time.time() - alarm.received_time, alarm.notify_results))
+		try:
+			self.alarm_index.add_alarm(alarm.alarm_id, notify_results=dict((str(notifier_id), record) for notifier_id, record in alarm.notify_results.items()))
+		except (IOError, OSError) as e:
+			logging.error("Wasn't able to store the notifier results of alarm %s: %s" % (alarm.alarm_id, e))
+	
+	# returns the pool for the given notifiers, must be called with the notify lock held. Calls which timed out keep
+	# their thread until the notifier returns, if too few threads are left the pool is replaced by a new one,
+	# the threads of the old one end once their calls are done.
+	def get_notify_pool(self, notifiers):
+		for notifier_id, (pool, result) in list(self.notify_stuck.items()):
+			if result.ready():
+				del self.notify_stuck[notifier_id]
+		
+		stuck = len([pool for pool, result in self.notify_stuck.values() if pool is self.notify_pool])
+		calls = len([notifier for notifier in notifiers if notifier.id not in self.notify_stuck])
+		if stuck and self.notify_threads - stuck < calls:
+			logging.warning("%d notifier threads are blocked by notifiers which timed out, starting new ones" % stuck)
+			self.notify_pool.close()
+			self.notify_pool = ThreadPool(self.notify_threads)
+		return self.notify_pool
+	
+	# runs func(notifier, *args) on the pool, the notifier isn't cleaned up while the call is running, must be called with the notify lock held
+	def submit_notifier(self, pool, func, notifier, *args):
+		self.notifier_calls[notifier] = self.notifier_calls.get(notifier, 0) + 1
+		return pool.apply_async(self.call_notifier, (func, notifier) + args)
+
+	def call_notifier(self, func, notifier, *args):
+		try:
+			return func(notifier, *args)
+		finally:
+			self.release_notifier(notifier)
+
+	# cleans up a notifier which was replaced while it was busy once its last call is done
+	def release_notifier(self, notifier):
+		with self.notify_lock:
+			self.notifier_calls[notifier] -= 1
+			if self.notifier_calls[notifier] > 0:
+				return
+			del self.notifier_calls[notifier]
+			if notifier not in self.retired_notifiers:
+				return
+			self.retired_notifiers.discard(notifier)
+		notifier.cleanup()
+		logging.info("Removed notifier %s after its last call" % notifier.id)
+
+	# executes a notifier and retries it if it fails, returns a record of the result
+	def run_notifier(self, notifier, info):
+		retries = self.notifier_setting(notifier, "retries", self.notify_retries)
+		start = time.time()
+		record = {"notifier": notifier.__class__.__name__, "status": "success", "attempts": 0, "duration": 0, "error": None}
+		if notifier.corrupted: # retrying won't help, it's recreated when the notifiers are set up again
+			record["status"] = "corrupted"
+			record["error"] = "initialization failed"
+			return record
+		
+		for attempt in range(0, retries + 1):
+			if attempt > 0:
+				time.sleep(2 ** attempt) # back off before retrying
+			record["attempts"] = attempt + 1
+			try:
+				status = notifier.notify(info)
 			except Exception as e:
-				self.log_err("Error notifying %u: %s" % (notifier.id, e))
+				logging.exception("Error notifying %s: %s" % (notifier.id, e))
+				record["status"] = "error"
+				record["error"] = str(e)
+			else:
+				record["status"] = status or "success"
+				record["error"] = None
+				break
+		
+		record["duration"] = round(time.time() - start, 3)
+		return record
+	
+	# reads an integer setting of a notifier from its params, e.g. a timeout for this notifier
+	def notifier_setting(self, notifier, key, default):
+		try:
+			return int(notifier.params.get(key, default))
+		except (TypeError, ValueError):
+			logging.error("Invalid value for %s of notifier %s: %s" % (key, notifier.id, notifier.params.get(key)))
+			return default
 			
+	# passes a file which arrived while the workers are still busy to the notifiers, they get it on the threads of the notifier pool
+	def forward_artifact(self, alarm, path):
+		logging.info("Alarm %s: forwarding %s %.3f seconds after the alarm was received" % (alarm.alarm_id, path, time.time() - alarm.received_time))
+		with self.notify_lock:
+			notifiers = [notifier for notifier in self.notifiers.values() if notifier.id not in self.notify_stuck]
+			pool = self.get_notify_pool(notifiers)
+			for notifier in notifiers:
+				self.submit_notifier(pool, self.forward_to_notifier, notifier, alarm, path)
+
+	def forward_to_notifier(self, notifier, alarm, path):
+		try:
+			notifier.notify_artifact(alarm.info, path)
+		except Exception as e:
+			self.log_err("Error forwarding %s to notifier %s: %s" % (path, notifier.id, e))
+
 	# go into holddown state, while in this state subsequent alarms are interpreted as one alarm
 	def holddown(self):
 		self.holddown_state = True
@@ -384,67 +816,17 @@ class Manager:
 
 	# cleanup the notifiers
 	def cleanup_notifiers(self):
-		for n in self.notifiers:
-			n.cleanup()
+		with self.notify_lock:
+			notifiers = list(self.notifiers.values())
+			self.notifiers = {}
+			self.notifier_hashes = {}
 
-		self.notifiers = [] 
+		for n in notifiers:
+			n.cleanup()
 
 	def prepare_config(self, pi_id):
-		logging.info("Preparing config for worker with id %s" % pi_id)
-		conf = {
-			"pi_id": pi_id,
-			"active": False, # default to false, will be overriden if should be true
-		}
-		
-		sensors = db.session.query(db.objects.Sensor).join(db.objects.Zone).join((db.objects.Setup, db.objects.Zone.setups)).filter(db.objects.Setup.active_state == True).filter(db.objects.Sensor.worker_id == pi_id).all()
-		
-		# if we have sensors we are active
-		if(len(sensors)>0):
-			conf['active'] = True
-		
-		
-		conf_sensors = []
-		for sen in sensors:
-			para = {}
-			# create params array
-			for p in sen.params:
-				para[p.key] = p.value
-			
-			conf_sen = {
-				"id": sen.id,
-				"name": sen.name,
-				"module": sen.module,
-				"class": sen.cl,
-				"params": para
-			}
-			conf_sensors.append(conf_sen)
-		
-		conf['sensors'] = conf_sensors
-		
-		actions = db.session.query(db.objects.Action).join((db.objects.Worker, db.objects.Action.workers)).filter(db.objects.Worker.id == pi_id).filter(db.objects.Action.active_state == True).all()
-		# if we have actions we are also active
-		if(len(actions)>0):
-			conf['active'] = True
-			
-		conf_actions = []
-		# iterate over all actions
-		for act in actions:
-			para = {}
-			# create params array
-			for p in act.params:
-				para[p.key] = p.value
-				
-			conf_act = {
-				"id": act.id,
-				"module": act.module,
-				"class": act.cl,
-				"params": para
-			}
-			conf_actions.append(conf_act)
-		
-		conf['actions'] = conf_actions
-
-		logging.info("Generated config: %s" % conf)
+		conf = self.worker_configs.get(pi_id)
+		logging.debug("Prepared config for worker with id %s (%s): %s" % (pi_id, self.worker_configs.get_hash(pi_id), conf))
 		return conf
 
 
@@ -457,6 +839,8 @@ if __name__ == '__main__':
 		# TODO: cleanup?
 		if(mg):
 			mg.cleanup_notifiers()
+			mg.log_buffer.flush()
+			logging.info("Log buffer: %s" % mg.log_buffer.stats())
 		try:
 			sys.exit(0)
 		except SystemExit:
@@ -54,13 +54,14 @@ class Sms(Notifier):
 				self.modem.waitForNetworkCoverage(self.network_timeout)
 			except gsmmodem.exceptions.TimeoutException: # when the modem is unable to connect to the cellular network
 				logging.exception("Sms: Timeout, wasn't able to get network connection")
-				return
+				raise
 			except Exception as e: # e.g. when unplugging the modem from the usb port
 				logging.exception("Sms: An unknown error occured while trying to get network coverage: %s" % e)
-				return
+				raise
 
 			# now we can try to send the message
 			info_str = "SecPi: Recieved alarm on sensor %s from worker %s." % (info['sensor'], info['worker'])
+			failed = []
 			for recipient in self.recipients:
 				try:
 					logging.debug("Sms: Sending message to %s" % recipient)
@@ -73,8 +74,12 @@ class Sms(Notifier):
 					logging.exception("Sms: An unknown error occured while sending a message to %s: %s" % (recipient, e))
 				else:
 					logging.info("Sms: Message to %s was sent successfully" % recipient)
+					continue
+				failed.append(recipient)
+			if failed:
+				raise Exception("Wasn't able to send message to %s" % ", ".join(failed))
 		else:
-			logging.error("Sms: Wasn't able to notify because there was an initialization error")
+			raise Exception("Sms: Wasn't able to notify because there was an initialization error")
 
 	def cleanup(self):
 		try:
@@ -42,8 +42,9 @@ class Twitter(Notifier):
 					logging.info("Twitter: Message to %s was sent successfully" % recipient)
 			except tweepy.error.TweepError as te:
 					logging.error("Twitter: Wasn't able to send message to %s: %s" % (recipient, te))
+					raise
 		else:
-			logging.error("Twitter: Wasn't able to notify because there was an initialization error")
+			raise Exception("Twitter: Wasn't able to notify because there was an initialization error")
 
 	def cleanup(self):
 		logging.debug("Twitter: No cleanup necessary at the moment")
\ No newline at end of file
@@ -0,0 +1,122 @@
+# Benchmark of the hot queries of the manager and the webinterface on a database with many log entries,
+# once without the indexes (like a database of an older version) and once after the migrations ran.
+#
+# usage: python stuff/db_benchmark.py [number of log entries]
+
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy import create_engine, or_, and_
+from sqlalchemy.orm import sessionmaker, subqueryload
+
+from tools.db import migrations
+from tools.db import objects
+
+
+def fill(engine, log_entries):
+	start = datetime.datetime(2016, 1, 1)
+	conn = engine.raw_connection()
+	cur = conn.cursor()
+
+	# most entries are acknowledged, only a few are still shown on the start page
+	batch = []
+	for i in range(0, log_entries):
+		batch.append((start + datetime.timedelta(seconds=i * 10), random.random() < 0.01, random.randint(0, 2), "Worker %d" % random.randint(1, 20), "Log message %d" % i))
+		if len(batch) >= 50000:
+			cur.executemany("INSERT INTO logs (logtime, ack, level, sender, message) VALUES (?, ?, ?, ?, ?)", [(t, not unacked, l, s, m) for t, unacked, l, s, m in batch])
+			batch = []
+	if batch:
+		cur.executemany("INSERT INTO logs (logtime, ack, level, sender, message) VALUES (?, ?, ?, ?, ?)", [(t, not unacked, l, s, m) for t, unacked, l, s, m in batch])
+
+	for i in range(0, log_entries // 100):
+		cur.execute("INSERT INTO alarms (alarmtime, ack, sensor_id, message) VALUES (?, ?, ?, ?)", (start + datetime.timedelta(seconds=i * 1000), random.random() > 0.01, random.randint(1, 1000), "Alarm %d" % i))
+
+	for w in range(1, 101):
+		cur.execute("INSERT INTO workers (id, name, address, active_state) VALUES (?, ?, ?, 1)", (w, "Worker %d" % w, "10.0.%d.%d" % (w // 250, w % 250)))
+	cur.execute("INSERT INTO setups (id, name, active_state) VALUES (1, 'Setup', 1)")
+	cur.execute("INSERT INTO zones (id, name) VALUES (1, 'Zone')")
+	cur.execute("INSERT INTO zones_setups (zone_id, setup_id) VALUES (1, 1)")
+	for s in range(1, 1001):
+		cur.execute("INSERT INTO sensors (id, name, cl, module, zone_id, worker_id) VALUES (?, ?, 'TestSensor', 'test_sensor', 1, ?)", (s, "Sensor %d" % s, (s % 100) + 1))
+		for p in range(0, 5):
+			cur.execute("INSERT INTO params (key, value, object_type, object_id) VALUES (?, ?, 'sensor', ?)", ("key%d" % p, "value", s))
+
+	conn.commit()
+	conn.close()
+
+
+def queries(session):
+	LogEntry = objects.LogEntry
+	Alarm = objects.Alarm
+	first_page = session.query(LogEntry).order_by(LogEntry.logtime.desc(), LogEntry.id.desc()).limit(50).all()
+	last = first_page[-1]
+
+	return [
+		("unacknowledged logs, newest 50", lambda: session.query(LogEntry).filter(LogEntry.ack == False).order_by(LogEntry.logtime.desc(), LogEntry.id.desc()).limit(50).all()),
+		("count of unacknowledged logs", lambda: session.query(LogEntry).filter(LogEntry.ack == False).count()),
+		("unacknowledged errors", lambda: session.query(LogEntry).filter(LogEntry.ack == False).filter(LogEntry.level == 2).order_by(LogEntry.logtime.desc()).limit(50).all()),
+		("all logs, 2nd page (keyset)", lambda: session.query(LogEntry).filter(or_(LogEntry.logtime < last.logtime, and_(LogEntry.logtime == last.logtime, LogEntry.id < last.id))).order_by(LogEntry.logtime.desc(), LogEntry.id.desc()).limit(50).all()),
+		("logs of the last day", lambda: session.query(LogEntry).filter(LogEntry.logtime >= last.logtime - datetime.timedelta(days=1)).count()),
+		("unacknowledged alarms", lambda: session.query(Alarm).filter(Alarm.ack == False).order_by(Alarm.alarmtime.desc()).limit(50).all()),
+		("worker by address", lambda: session.query(objects.Worker).filter(objects.Worker.address == "10.0.0.42").first()),
+		("sensors of a worker with params", lambda: session.query(objects.Sensor).filter(objects.Sensor.worker_id == 42).options(subqueryload(objects.Sensor.params)).all()),
+		("sensors of active setups with params", lambda: session.query(objects.Sensor).join(objects.Zone).join((objects.Setup, objects.Zone.setups)).filter(objects.Setup.active_state == True).options(subqueryload(objects.Sensor.params)).all())
+	]
+
+
+def measure(engine, runs=5):
+	session = sessionmaker(bind=engine)()
+	results = []
+	for name, query in queries(session):
+		durations = []
+		for i in range(0, runs):
+			start = time.time()
+			query()
+			durations.append(time.time() - start)
+			session.expire_all()
+		results.append((name, sorted(durations)[runs // 2])) # median
+	session.close()
+	return results
+
+
+def main():
+	log_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+	path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+	engine = create_engine("sqlite:///%s" % path)
+
+	# a database like the ones of older versions, without the indexes
+	objects.setup(engine)
+	with engine.begin() as conn:
+		for table in objects.Base.metadata.sorted_tables:
+			for index in table.indexes:
+				conn.execute("DROP INDEX %s" % index.name)
+
+	print("Inserting %d log entries into %s..." % (log_entries, path))
+	start = time.time()
+	fill(engine, log_entries)
+	print("Done in %.1fs" % (time.time() - start))
+
+	before = measure(engine)
+
+	start = time.time()
+	version = migrations.migrate(engine)
+	print("Migrated to version %d in %.1fs" % (version, time.time() - start))
+
+	after = measure(engine)
+
+	print("%-40s %12s %12s" % ("query", "before (ms)", "after (ms)"))
+	for (name, duration_before), (name, duration_after) in zip(before, after):
+		print("%-40s %12.2f %12.2f" % (name, duration_before * 1000, duration_after * 1000))
+
+	os.unlink(path)
+	os.rmdir(os.path.dirname(path))
+
+
+if __name__ == "__main__":
+	main()
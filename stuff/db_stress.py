@@ -0,0 +1,152 @@
+# Stress test of the database layer of the manager: concurrent alarms, log messages, config builds and a
+# second process-like engine (the webinterface) acknowledging alarms, all on the same SQLite file.
+# Every thread uses its own units of work with db.session_scope(), like the manager does.
+#
+# usage: python stuff/db_stress.py [alarm threads] [alarms per thread] [log threads] [logs per thread]
+
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy.orm import sessionmaker
+
+from tools import utils
+from tools.configcache import ConfigCache
+from tools.db import database as db
+from tools.logbuffer import LogBuffer
+
+errors = []
+
+def record_errors(func):
+	def wrapper(*args):
+		try:
+			func(*args)
+		except Exception as e:
+			logging.exception("Error in %s" % threading.current_thread().name)
+			errors.append(e)
+	return wrapper
+
+
+def populate():
+	with db.session_scope() as session:
+		setup = db.objects.Setup(name="Setup", active_state=True)
+		zone = db.objects.Zone(name="Zone")
+		setup.zones.append(zone)
+		session.add(setup)
+		for w in range(1, 11):
+			worker = db.objects.Worker(id=w, name="Worker %d" % w, address="10.0.0.%d" % w, active_state=True)
+			session.add(worker)
+			for s in range(0, 5):
+				session.add(db.objects.Sensor(name="Sensor %d.%d" % (w, s), cl="TestSensor", module="test_sensor", zone=zone, worker_id=w))
+
+
+# what got_alarm does with the database
+@record_errors
+def raise_alarms(count, log_buffer):
+	for i in range(0, count):
+		with db.session_scope() as session:
+			worker = session.query(db.objects.Worker).filter(db.objects.Worker.id == random.randint(1, 10)).first()
+			sensor = session.query(db.objects.Sensor).filter(db.objects.Sensor.worker_id == worker.id).first()
+			session.add(db.objects.Alarm(sensor_id=sensor.id, message="Alarm %d" % i))
+			log_buffer.add(utils.LEVEL_WARN, "New alarm from %s on sensor %s" % (worker.name, sensor.name), "Manager")
+
+
+# what got_log does
+@record_errors
+def send_logs(count, log_buffer):
+	sender = threading.current_thread().name
+	for i in range(0, count):
+		log_buffer.add(random.choice([utils.LEVEL_DEBUG, utils.LEVEL_INFO, utils.LEVEL_WARN]), "Log message %d" % i, sender)
+		if i % 100 == 0:
+			time.sleep(0.01)
+
+
+# what got_config_request and got_config_changed do
+@record_errors
+def build_configs(count, cache):
+	for i in range(0, count):
+		cache.invalidate()
+		conf = cache.get(random.randint(1, 10))
+		assert conf["active"], "worker config should be active"
+
+
+# what the webinterface does, it has its own engine
+@record_errors
+def acknowledge_alarms(stop):
+	engine = db.create_sqlite_engine(db.engine.url.database)
+	Session = sessionmaker(bind=engine)
+	while not stop.is_set():
+		session = Session()
+		try:
+			for alarm in session.query(db.objects.Alarm).filter(db.objects.Alarm.ack == False).limit(20):
+				alarm.ack = True
+			session.commit()
+		finally:
+			session.close()
+		time.sleep(0.05)
+	engine.dispose()
+
+
+def main():
+	alarm_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+	alarms = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+	log_threads = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+	logs = int(sys.argv[4]) if len(sys.argv) > 4 else 2000
+
+	logging.basicConfig(level=logging.WARNING)
+	path = tempfile.mkdtemp()
+	db.connect(path)
+	db.setup()
+	populate()
+
+	# no sampling, every log message has to arrive
+	log_buffer = LogBuffer(max_size=1000000, sender_limit=1000000)
+	log_buffer.start()
+	cache = ConfigCache()
+
+	stop = threading.Event()
+	webinterface = threading.Thread(name="webinterface", target=acknowledge_alarms, args=(stop,))
+	webinterface.start()
+
+	threads = []
+	for i in range(0, alarm_threads):
+		threads.append(threading.Thread(name="alarm-%d" % i, target=raise_alarms, args=(alarms, log_buffer)))
+	for i in range(0, log_threads):
+		threads.append(threading.Thread(name="log-%d" % i, target=send_logs, args=(logs, log_buffer)))
+	for i in range(0, 2):
+		threads.append(threading.Thread(name="config-%d" % i, target=build_configs, args=(50, cache)))
+
+	start = time.time()
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	log_buffer.flush()
+	duration = time.time() - start
+	stop.set()
+	webinterface.join()
+
+	with db.session_scope() as session:
+		alarm_count = session.query(db.objects.Alarm).count()
+		log_count = session.query(db.objects.LogEntry).count()
+
+	expected_logs = alarm_threads * alarms + log_threads * logs
+	print("%d alarms and %d log messages from %d threads in %.2fs" % (alarm_count, log_count, len(threads), duration))
+	print("log buffer: %s" % log_buffer.stats())
+	print("errors: %d" % len(errors))
+
+	shutil.rmtree(path)
+	ok = not errors and alarm_count == alarm_threads * alarms and log_count == expected_logs
+	print("OK" if ok else "FAILED (expected %d alarms and %d log messages)" % (alarm_threads * alarms, expected_logs))
+	sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+	main()
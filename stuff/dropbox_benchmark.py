@@ -0,0 +1,130 @@
+# Benchmark of the Dropbox notifier against a fake Dropbox in the same process.
+# Every API call sleeps for a latency plus the transfer time of its data at the given bandwidth,
+# some calls fail randomly to exercise the retries and the resuming of upload sessions.
+#
+# usage: python stuff/dropbox_benchmark.py [files] [file size in MB] [upload threads]
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "manager"))
+
+LATENCY = 0.05 # seconds per call
+BANDWIDTH = 20 * 1024 * 1024 # bytes per second and connection
+ERROR_RATE = 0.05
+
+
+class ApiError(Exception):
+	def __init__(self, error):
+		super(ApiError, self).__init__(error)
+		self.error = error
+
+class InternalServerError(Exception):
+	pass
+
+class IncorrectOffset(object):
+	def __init__(self, correct_offset):
+		self.correct_offset = correct_offset
+
+	def is_incorrect_offset(self):
+		return True
+
+	def get_incorrect_offset(self):
+		return self
+
+class Struct(object):
+	def __init__(self, **kwargs):
+		self.__dict__.update(kwargs)
+
+
+# the dropbox package isn't needed, only the parts used by the notifier are faked
+fake = types.ModuleType("dropbox")
+fake.exceptions = Struct(ApiError=ApiError, AuthError=type("AuthError", (Exception,), {}), BadInputError=type("BadInputError", (Exception,), {}))
+fake.files = Struct(UploadSessionCursor=Struct, CommitInfo=Struct, WriteMode=Struct(overwrite="overwrite"))
+fake.Dropbox = lambda token: FakeDropbox()
+sys.modules["dropbox"] = fake
+
+
+class FakeDropbox(object):
+
+	def __init__(self):
+		self.sessions = {}
+		self.files = {}
+		self.lock = threading.Lock()
+		self.calls = 0
+		self.errors = 0
+
+	def transfer(self, data):
+		with self.lock:
+			self.calls += 1
+		time.sleep(LATENCY + len(data) / float(BANDWIDTH))
+		if random.random() < ERROR_RATE:
+			with self.lock:
+				self.errors += 1
+			raise InternalServerError("fake server error")
+
+	def files_upload(self, data, path, mode=None):
+		self.transfer(data)
+		self.files[path] = len(data)
+
+	def files_upload_session_start(self, data):
+		self.transfer(data)
+		session_id = "%d" % random.getrandbits(64)
+		self.sessions[session_id] = len(data)
+		return Struct(session_id=session_id)
+
+	def files_upload_session_append_v2(self, data, cursor):
+		if cursor.offset != self.sessions[cursor.session_id]:
+			raise ApiError(IncorrectOffset(self.sessions[cursor.session_id]))
+		if random.random() < ERROR_RATE: # the chunk arrives, but the response gets lost
+			self.sessions[cursor.session_id] += len(data)
+		self.transfer(data)
+		self.sessions[cursor.session_id] = cursor.offset + len(data)
+
+	def files_upload_session_finish(self, data, cursor, commit):
+		if cursor.offset != self.sessions[cursor.session_id]:
+			raise ApiError(IncorrectOffset(self.sessions[cursor.session_id]))
+		self.transfer(data)
+		self.files[commit.path] = cursor.offset + len(data)
+		del self.sessions[cursor.session_id]
+
+
+def main():
+	files = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+	size = int(float(sys.argv[2]) * 1024 * 1024) if len(sys.argv) > 2 else 20 * 1024 * 1024
+	threads = sys.argv[3] if len(sys.argv) > 3 else "4"
+
+	import dropbox_dropper
+
+	data_dir = tempfile.mkdtemp()
+	alarm_dir = os.path.join(data_dir, "20160101_120000_benchmark")
+	os.mkdir(alarm_dir)
+	for i in range(0, files):
+		with open(os.path.join(alarm_dir, "file%d.zip" % i), "wb") as f:
+			f.write(os.urandom(size))
+
+	try:
+		for upload_threads in ("1", threads):
+			dropper = dropbox_dropper.Dropbox_Dropper(1, {"access_token": "fake", "data_dir": data_dir, "upload_threads": upload_threads, "chunk_size": str(4 * 1024 * 1024)})
+			start = time.time()
+			dropper.notify({"alarm_id": os.path.basename(alarm_dir)})
+			duration = time.time() - start
+			dropper.cleanup()
+
+			uploaded = sum(dropper.dbx.files.values())
+			assert uploaded == files * size, "uploaded %d of %d bytes" % (uploaded, files * size)
+			print("%s threads: %d files of %.1f MB in %.2fs (%.1f MB/s), %d calls, %d injected errors" % (upload_threads, files, size / 1048576.0,
+				duration, uploaded / 1048576.0 / duration, dropper.dbx.calls, dropper.dbx.errors))
+	finally:
+		shutil.rmtree(data_dir)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,141 @@
+# Throughput benchmark of the worker -> manager publishing with an in-process fake broker which confirms
+# messages after a round trip time, like RabbitMQ, consecutive acks are sent as one "multiple" ack.
+# Some messages are nacked or never confirmed to exercise the retries. Compares:
+#   - publishing without confirms (fast, but lost messages go unnoticed)
+#   - waiting for the confirmation of every message (what BlockingChannel.confirm_delivery does)
+#   - pipelined confirms with tools.publisher.ConfirmPublisher
+#
+# usage: python stuff/publish_benchmark.py [messages] [round trip time in ms] [nack rate] [loss rate]
+
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tools.publisher import ConfirmPublisher
+
+
+class Method(object):
+
+	def __init__(self, name, delivery_tag, multiple):
+		self.NAME = name
+		self.delivery_tag = delivery_tag
+		self.multiple = multiple
+
+
+class Frame(object):
+
+	def __init__(self, method):
+		self.method = method
+
+
+class FakeBroker(object):
+
+	def __init__(self, rtt, nack_rate=0.0, loss_rate=0.0):
+		self.rtt = rtt
+		self.nack_rate = nack_rate
+		self.loss_rate = loss_rate
+		self.received = []
+		self.pending = [] # (due, tag, ack)
+		self.confirm_callback = None
+		self.tag = 0
+		self.lost = 0
+
+	# channel interface
+	def confirm_delivery(self, callback=None, nowait=False):
+		self.confirm_callback = callback
+
+	def basic_publish(self, exchange, routing_key, body, properties=None):
+		self.tag += 1
+		if not self.confirm_callback:
+			self.received.append(body)
+			return
+		if random.random() < self.loss_rate: # neither routed nor confirmed
+			self.lost += 1
+			return
+		ack = random.random() >= self.nack_rate
+		if ack:
+			self.received.append(body)
+		self.pending.append((time.time() + self.rtt, self.tag, ack))
+
+	# connection interface
+	def process_data_events(self, time_limit=0):
+		if self.pending:
+			wait = self.pending[0][0] - time.time()
+			if wait > 0:
+				time.sleep(min(wait, time_limit))
+		elif time_limit:
+			time.sleep(time_limit)
+
+		now = time.time()
+		due = []
+		while self.pending and self.pending[0][0] <= now:
+			due.append(self.pending.pop(0))
+
+		# consecutive acks are confirmed with one multiple ack, unless that would confirm a lost message too
+		i = 0
+		while i < len(due):
+			j = i
+			while j + 1 < len(due) and due[j + 1][2] == due[i][2] and due[j + 1][1] == due[j][1] + 1:
+				j += 1
+			name = "Basic.Ack" if due[i][2] else "Basic.Nack"
+			if j > i and not self.lost:
+				self.confirm_callback(Frame(Method(name, due[j][1], True)))
+			else:
+				for k in range(i, j + 1):
+					self.confirm_callback(Frame(Method(name, due[k][1], False)))
+			i = j + 1
+
+
+def run(name, messages, rtt, nack_rate, loss_rate, max_in_flight=None):
+	broker = FakeBroker(rtt, nack_rate, loss_rate)
+	failed = []
+	bodies = ["message %d" % i for i in range(0, messages)]
+
+	start = time.time()
+	if max_in_flight is None:
+		for body in bodies:
+			broker.basic_publish("secpi", "secpi-data", body)
+			time.sleep(0) # a publish without confirms is only a socket write
+		publisher = None
+	else:
+		publisher = ConfirmPublisher(broker, broker, "secpi", max_in_flight=max_in_flight, retries=5, timeout=max(rtt * 5, 0.1),
+			on_failed=lambda rk, body, properties: failed.append(body))
+		for body in bodies:
+			publisher.publish("secpi-data", body)
+			if max_in_flight == 1:
+				publisher.flush()
+		publisher.flush(timeout=30)
+	duration = time.time() - start
+
+	received = set(broker.received)
+	missing = len([body for body in bodies if body not in received])
+	print("%-22s %8.0f msg/s %8.2fs  missing: %d  duplicates: %d  failed: %d" % (name, messages / duration, duration, missing,
+		len(broker.received) - len(received), len(failed)))
+	if publisher:
+		stats = publisher.stats()
+		print("%22s latency avg %.1fms p50 %.1fms p95 %.1fms max %.1fms, nacked %d, retried %d, in flight %d" % ("",
+			stats["latency_avg"] * 1000, stats["latency_p50"] * 1000, stats["latency_p95"] * 1000, stats["latency_max"] * 1000,
+			stats["nacked"], stats["retried"], stats["in_flight"]))
+
+
+def main():
+	messages = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+	rtt = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.002
+	nack_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.001
+	loss_rate = float(sys.argv[4]) if len(sys.argv) > 4 else 0.001
+
+	logging.basicConfig(level=logging.WARNING)
+	print("%d messages, round trip %.1fms, nack rate %.3f, loss rate %.3f" % (messages, rtt * 1000, nack_rate, loss_rate))
+	run("no confirms", messages, rtt, nack_rate, loss_rate)
+	# every message waits for its confirmation, only a part of the messages, it takes too long otherwise
+	run("confirm every message", min(messages, 500), rtt, nack_rate, loss_rate, max_in_flight=1)
+	for max_in_flight in (16, 256):
+		run("pipelined (%d)" % max_in_flight, messages, rtt, nack_rate, loss_rate, max_in_flight=max_in_flight)
+
+
+if __name__ == "__main__":
+	main()
@@ -6,6 +6,13 @@ class Action(object):
 		self.id = id
 		self.params = params
 		self.corrupted = False
+		self.artifact_callback = None # set by the worker while an alarm is being processed
+	
+	def publish_artifact(self, path):
+		"""Hand over a file which was created during execute.
+		The worker sends it to the manager right away, so the file shouldn't be touched afterwards."""
+		if self.artifact_callback:
+			self.artifact_callback(path)
 		
 	@abc.abstractmethod
 	def execute(self):
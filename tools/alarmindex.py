@@ -0,0 +1,220 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+# Index of the alarm directories and their files, stored as JSON next to the directories.
+# The manager adds alarms and files as they arrive, the web interface and the notifiers read it
+# instead of scanning the whole data directory. Changes are appended to a log instead of rewriting
+# the whole index, the readers only read the new lines of the log. After a number of changes the log
+# is merged into the index, which is written to a temporary file which then replaces it. Every index
+# has its own log, so a reader never applies the log of another index. The processes serialize their
+# changes with a lock file.
+#
+#   {"alarms": {"<alarm id>": {"created": <timestamp>, "files": {"<name>": <size>}, "size": <bytes>, "db_id": <id of the Alarm row>,
+#                              "notify_results": {"<notifier id>": <result record of the notifier>}}},
+#    "meta": {"<key>": <value>}, "generation": "<name of the log>"}
+#
+# every line of the log is one change: {"op": "alarm"|"file"|"remove"|"meta", ...}
+
+INDEX_NAME = "index.json"
+LOG_NAME = "index.%s.log"
+LOCK_NAME = "index.lock"
+COMPACT_AFTER = 500 # changes in the log until it is merged into the index
+
+
+class AlarmIndex(object):
+
+	def __init__(self, data_dir):
+		self.data_dir = data_dir
+		self.index_path = os.path.join(data_dir, INDEX_NAME)
+		self.lock_path = os.path.join(data_dir, LOCK_NAME)
+		self.alarms = {}
+		self.meta = {} # further information, e.g. the state of the retention
+		self.loaded_stat = None # inode, mtime and size of the index file when it was read, to notice changes of other processes
+		self.generation = None # the log which belongs to the loaded index
+		self.log_offset = 0 # how much of the log was read
+		self.log_entries = 0
+		self.log_broken = False # the log ends with an incomplete line, e.g. a process died while writing it
+		self.lock = threading.Lock()
+
+	# returns a copy of the entry of the given alarm, None if it isn't known
+	def get(self, alarm_id):
+		with self.lock:
+			self.reload()
+			entry = self.alarms.get(alarm_id)
+			return self.copy_entry(entry) if entry else None
+
+	# returns (alarm id, entry) of all alarms, the newest first
+	def list(self):
+		with self.lock:
+			self.reload()
+			return [(alarm_id, self.copy_entry(self.alarms[alarm_id])) for alarm_id in sorted(self.alarms, reverse=True)]
+
+	# returns the full paths of the files of an alarm
+	def files(self, alarm_id):
+		entry = self.get(alarm_id)
+		if not entry:
+			return []
+		alarm_dir = os.path.join(self.data_dir, alarm_id)
+		return [os.path.join(alarm_dir, name) for name in sorted(entry["files"])]
+
+	def add_alarm(self, alarm_id, **attributes):
+		self.update({"op": "alarm", "alarm_id": alarm_id, "attributes": attributes, "time": time.time()})
+
+	# adds a file of an alarm directory or updates its size
+	def add_file(self, alarm_id, path):
+		name = os.path.relpath(path, os.path.join(self.data_dir, alarm_id))
+		self.update({"op": "file", "alarm_id": alarm_id, "name": name, "size": os.path.getsize(path), "time": time.time()})
+
+	def remove_alarm(self, alarm_id):
+		self.update({"op": "remove", "alarm_id": alarm_id})
+
+	def total_size(self):
+		with self.lock:
+			self.reload()
+			return sum(entry["size"] for entry in self.alarms.values())
+
+	def get_meta(self, key, default=None):
+		with self.lock:
+			self.reload()
+			return self.meta.get(key, default)
+
+	def set_meta(self, key, value):
+		self.update({"op": "meta", "key": key, "value": value})
+
+	# applies a change to the index while holding the lock file, so changes of other processes aren't lost
+	def update(self, change):
+		with self.lock:
+			with open(self.lock_path, "a") as lock_file:
+				fcntl.flock(lock_file, fcntl.LOCK_EX)
+				try:
+					self.reload()
+					self.apply(change)
+					if self.generation is None or self.log_entries >= COMPACT_AFTER or self.log_broken: # no index yet or the log got long
+						self.write()
+					else:
+						self.append(change)
+				finally:
+					fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+	def apply(self, change):
+		op = change["op"]
+		if op == "remove":
+			self.alarms.pop(change["alarm_id"], None)
+		elif op == "meta":
+			self.meta[change["key"]] = change["value"]
+		else:
+			entry = self.alarms.setdefault(change["alarm_id"], {"created": change["time"], "files": {}, "size": 0})
+			if op == "alarm":
+				entry.update(change["attributes"])
+			elif op == "file":
+				entry["size"] += change["size"] - entry["files"].get(change["name"], 0)
+				entry["files"][change["name"]] = change["size"]
+
+	# reads the index if it was changed since it was last read and the new changes of its log, must be called with the lock held
+	def reload(self):
+		try:
+			st = os.stat(self.index_path)
+		except OSError: # no index yet, e.g. after an update, it is built once from the directories
+			if self.loaded_stat is None:
+				self.alarms = self.scan()
+				self.loaded_stat = (0, 0, 0)
+			return
+
+		stat = (st.st_ino, st.st_mtime, st.st_size)
+		if stat != self.loaded_stat:
+			try:
+				with open(self.index_path, "r") as f:
+					index = json.load(f)
+				self.alarms = index["alarms"]
+				self.meta = index.get("meta", {})
+				self.generation = index.get("generation")
+			except (ValueError, KeyError, IOError) as e:
+				logging.error("Alarm index %s is broken, rebuilding it: %s" % (self.index_path, e))
+				self.alarms = self.scan()
+				self.generation = None
+			self.loaded_stat = stat
+			self.log_offset = 0
+			self.log_entries = 0
+
+		self.read_log()
+
+	def log_path(self):
+		return os.path.join(self.data_dir, LOG_NAME % self.generation)
+
+	# applies the changes which were appended to the log since it was last read
+	def read_log(self):
+		if self.generation is None:
+			return
+		try:
+			with open(self.log_path(), "rb") as f:
+				f.seek(self.log_offset)
+				data = f.read()
+		except IOError: # nothing was changed since the index was written
+			return
+
+		end = data.rfind(b"\n") + 1 # a line which is still being written is read the next time
+		for line in data[:end].splitlines():
+			try:
+				self.apply(json.loads(line.decode("utf-8")))
+			except (ValueError, KeyError) as e:
+				logging.error("Skipping broken line of alarm index log %s: %s" % (self.log_path(), e))
+			self.log_entries += 1
+		self.log_offset += end
+		self.log_broken = end < len(data)
+
+	# appends a change to the log, must be called with the lock held
+	def append(self, change):
+		with open(self.log_path(), "ab") as f:
+			f.write((json.dumps(change) + "\n").encode("utf-8"))
+			self.log_offset = f.tell()
+		self.log_entries += 1
+
+	# writes the index atomically with a new, empty log, must be called with the lock held
+	def write(self):
+		old_log = self.log_path() if self.generation is not None else None
+		self.generation = uuid.uuid4().hex
+		tmp_path = "%s.%d.tmp" % (self.index_path, os.getpid())
+		with open(tmp_path, "w") as f:
+			json.dump({"alarms": self.alarms, "meta": self.meta, "generation": self.generation}, f)
+		os.rename(tmp_path, self.index_path)
+		st = os.stat(self.index_path)
+		self.loaded_stat = (st.st_ino, st.st_mtime, st.st_size)
+		self.log_offset = 0
+		self.log_entries = 0
+		self.log_broken = False
+
+		if old_log: # its changes are part of the index now
+			try:
+				os.unlink(old_log)
+			except OSError:
+				pass
+
+	# builds the index from the directories on disk
+	def scan(self):
+		alarms = {}
+		if not os.path.isdir(self.data_dir):
+			return alarms
+
+		for alarm_id in os.listdir(self.data_dir):
+			alarm_dir = os.path.join(self.data_dir, alarm_id)
+			if not os.path.isdir(alarm_dir):
+				continue
+			files = {}
+			for dirpath, dirnames, filenames in os.walk(alarm_dir): # extracted zips may contain folders
+				for name in filenames:
+					if not name.endswith(".part"): # unfinished transfer
+						path = os.path.join(dirpath, name)
+						files[os.path.relpath(path, alarm_dir)] = os.path.getsize(path)
+			alarms[alarm_id] = {"created": os.path.getmtime(alarm_dir), "files": files, "size": sum(files.values())}
+		logging.info("Built alarm index of %d alarms from %s" % (len(alarms), self.data_dir))
+		return alarms
+
+	def copy_entry(self, entry):
+		copy = dict(entry)
+		copy["files"] = dict(entry["files"])
+		return copy
@@ -0,0 +1,175 @@
+import logging
+import random
+import socket
+import time
+
+import pika
+
+from tools import config
+
+# Connection to the rabbitmq service which is shared by the manager, the workers and the webinterface.
+#   - failed connection attempts are retried with jittered exponential backoff instead of fixed sleeps
+#   - while the broker can't even be reached, only a cheap TCP probe is done, so we connect within
+#     seconds once it's back, without hammering it with TLS handshakes in the meantime
+#   - heartbeats detect a dead connection, they are sent while the connection processes its events
+#   - exchanges, queues, bindings and consumers are registered once in a Topology which is declared
+#     again after every reconnect, every entry is only declared once per connection
+
+PORT = 5671
+
+
+# delays between retries: initial, initial * factor, ... up to maximum, each one reduced by a random part
+# so many clients which lost their connection at the same time don't reconnect at the same time
+class Backoff(object):
+
+	def __init__(self, initial=0.5, maximum=30, factor=2, jitter=0.5):
+		self.initial = initial
+		self.maximum = maximum
+		self.factor = factor
+		self.jitter = jitter
+		self.attempts = 0
+
+	def next(self):
+		delay = min(self.maximum, self.initial * (self.factor ** self.attempts))
+		self.attempts += 1
+		return delay * random.uniform(1 - self.jitter, 1)
+
+	def reset(self):
+		self.attempts = 0
+
+
+class Topology(object):
+
+	def __init__(self, exchange):
+		self.exchange = exchange
+		self.queues = [] # (name, bind), in the order they were added
+		self.consumers = [] # (queue, callback)
+		self.declared = set() # what's declared on the current channel
+
+	def add_queue(self, name, bind=True):
+		if (name, bind) not in self.queues:
+			self.queues.append((name, bind))
+
+	def add_consumer(self, queue, callback):
+		self.consumers.append((queue, callback))
+
+	# declares everything which wasn't declared on this channel yet
+	def declare(self, channel):
+		if ("exchange", self.exchange) not in self.declared:
+			channel.exchange_declare(exchange=self.exchange, exchange_type='direct')
+			self.declared.add(("exchange", self.exchange))
+
+		for name, bind in self.queues:
+			if ("queue", name) not in self.declared:
+				channel.queue_declare(queue=name)
+				if bind:
+					channel.queue_bind(exchange=self.exchange, queue=name)
+				self.declared.add(("queue", name))
+
+		for queue, callback in self.consumers:
+			if ("consumer", queue) not in self.declared:
+				channel.basic_consume(callback, queue=queue, no_ack=True)
+				self.declared.add(("consumer", queue))
+
+	# a new connection knows nothing about the declarations of the old one
+	def reset(self):
+		self.declared = set()
+
+
+# parameters of the connection, taken from the rabbitmq section of the config
+def connection_parameters(project_path, heartbeat=None):
+	rabbitmq = config.get('rabbitmq')
+	if heartbeat is None:
+		heartbeat = int(rabbitmq.get('heartbeat', 15))
+	credentials = pika.PlainCredentials(rabbitmq['user'], rabbitmq['password'])
+	return pika.ConnectionParameters(credentials=credentials,
+		host=rabbitmq['master_ip'],
+		port=PORT,
+		ssl=True,
+		socket_timeout=10,
+		heartbeat_interval=heartbeat,
+		ssl_options = {
+			"ca_certs":project_path+"/certs/"+rabbitmq['cacert'],
+			"certfile":project_path+"/certs/"+rabbitmq['certfile'],
+			"keyfile":project_path+"/certs/"+rabbitmq['keyfile']
+		}
+	)
+
+
+# checks if something accepts connections on the port of the broker, much cheaper than a full connection attempt
+def reachable(host, port=PORT, timeout=1):
+	try:
+		sock = socket.create_connection((host, port), timeout)
+		sock.close()
+		return True
+	except (socket.error, socket.timeout):
+		return False
+
+
+class Connection(object):
+
+	def __init__(self, project_path, topology, heartbeat=None, backoff=None, probe_interval=1):
+		self.project_path = project_path
+		self.topology = topology
+		self.heartbeat = heartbeat
+		self.backoff = backoff or Backoff()
+		self.probe_interval = probe_interval
+		self.connection = None
+		self.channel = None
+		self.connected_at = None # set when the topology is declared
+
+	# connects and declares the topology, retries max_attempts times (0: until it works), returns True if connected
+	def connect(self, max_attempts=0):
+		self.close()
+		parameters = connection_parameters(self.project_path, self.heartbeat)
+		start = time.time()
+		attempts = 0
+
+		while True:
+			attempts += 1
+			if not reachable(parameters.host, parameters.port):
+				logging.error("Wasn't able to connect to rabbitmq service: %s:%d isn't reachable" % (parameters.host, parameters.port))
+				if max_attempts and attempts >= max_attempts:
+					return False
+				self.wait_reachable(parameters.host, parameters.port, self.backoff.next())
+				continue
+
+			try:
+				self.connection = pika.BlockingConnection(parameters=parameters)
+				self.channel = self.connection.channel()
+				self.topology.reset()
+				self.topology.declare(self.channel)
+				break
+			except (pika.exceptions.AMQPConnectionError, socket.error) as e: # socket.error includes ssl errors
+				logging.error("Wasn't able to connect to rabbitmq service: %s" % e)
+				self.close()
+				if max_attempts and attempts >= max_attempts:
+					return False
+				time.sleep(self.backoff.next())
+
+		self.backoff.reset()
+		self.connected_at = time.time()
+		logging.info("Connection to rabbitmq service established after %d attempts in %.1fs" % (attempts, self.connected_at - start))
+		return True
+
+	# waits for the given delay, but returns as soon as the broker accepts connections again
+	def wait_reachable(self, host, port, delay):
+		end = time.time() + delay
+		while time.time() < end:
+			time.sleep(min(self.probe_interval, max(0, end - time.time())))
+			if reachable(host, port):
+				return
+
+	# readiness probe: connected and the topology is declared
+	def is_ready(self):
+		return bool(self.connected_at and self.connection and self.connection.is_open and self.channel and self.channel.is_open)
+
+	def close(self):
+		if self.connection and self.connection.is_open:
+			try:
+				self.connection.close()
+			except pika.exceptions.AMQPError as e:
+				logging.debug("Wasn't able to close connection: %s" % e)
+		self.connection = None
+		self.channel = None
+		self.connected_at = None
@@ -0,0 +1,111 @@
+import copy
+import hashlib
+import json
+import logging
+import threading
+
+from sqlalchemy.orm import subqueryload
+
+from tools.db import database as db
+
+
+# Caches the configs of all workers. They are built together with a fixed number of queries (params are loaded eagerly)
+# and only rebuilt after invalidate() was called, which happens when sensors, actions, zones, setups or params change.
+class ConfigCache(object):
+
+	def __init__(self):
+		self.configs = {} # worker id -> config
+		self.hashes = {} # worker id -> md5 of the config content
+		self.valid = False
+		self.lock = threading.Lock()
+
+	def invalidate(self):
+		with self.lock:
+			self.valid = False
+		logging.debug("Worker config cache invalidated")
+
+	# returns a copy of the config of the given worker, so it can be changed by the caller
+	def get(self, pi_id):
+		with self.lock:
+			if not self.valid or pi_id not in self.configs: # a worker which was just added also needs a rebuild
+				self.build()
+			conf = self.configs.get(pi_id)
+
+		if conf is None:
+			return self.empty_config(pi_id)
+
+		return copy.deepcopy(conf)
+
+	def get_hash(self, pi_id):
+		with self.lock:
+			if not self.valid:
+				self.build()
+			return self.hashes.get(pi_id)
+
+	def empty_config(self, pi_id):
+		conf = {
+			"pi_id": pi_id,
+			"active": False, # default to false, will be overriden if should be true
+			"sensors": [],
+			"actions": []
+		}
+		conf['version'] = self.config_hash(conf)
+		return conf
+
+	# builds the configs of all workers, must be called with the lock held
+	def build(self):
+		with db.session_scope() as session:
+			configs = {}
+			for worker in session.query(db.objects.Worker).all():
+				configs[worker.id] = self.empty_config(worker.id)
+
+			# sensors which are in a zone of an active setup, a sensor in several active setups is only added once
+			sensors = session.query(db.objects.Sensor).join(db.objects.Zone).join((db.objects.Setup, db.objects.Zone.setups)).filter(db.objects.Setup.active_state == True).options(subqueryload(db.objects.Sensor.params)).all()
+			added_sensors = set()
+			for sen in sensors:
+				if sen.id in added_sensors or sen.worker_id not in configs:
+					continue
+				added_sensors.add(sen.id)
+
+				conf = configs[sen.worker_id]
+				conf['active'] = True # if we have sensors we are active
+				conf['sensors'].append({
+					"id": sen.id,
+					"name": sen.name,
+					"module": sen.module,
+					"class": sen.cl,
+					"params": self.params_dict(sen.params)
+				})
+
+			actions = session.query(db.objects.Action).filter(db.objects.Action.active_state == True).options(subqueryload(db.objects.Action.params), subqueryload(db.objects.Action.workers)).all()
+			for act in actions:
+				for worker in act.workers:
+					conf = configs.get(worker.id)
+					if conf is None:
+						continue
+					conf['active'] = True # if we have actions we are also active
+					conf['actions'].append({
+						"id": act.id,
+						"module": act.module,
+						"class": act.cl,
+						"params": self.params_dict(act.params)
+					})
+
+			for conf in configs.values():
+				conf['version'] = self.config_hash(conf)
+
+			self.configs = configs
+			self.hashes = dict((pi_id, conf['version']) for pi_id, conf in configs.items())
+			self.valid = True
+			logging.info("Built configs for %d workers" % len(configs))
+
+	def params_dict(self, params):
+		para = {}
+		for p in params:
+			para[p.key] = p.value
+		return para
+
+	# the hash of the content is used as version of the config, the version itself isn't part of it
+	def config_hash(self, conf):
+		content = dict((k, v) for k, v in conf.items() if k != 'version')
+		return hashlib.md5(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
@@ -1,23 +1,76 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 
 from tools import config
 import objects
+import migrations
 
 session = None
 engine = None
+scope_state = threading.local() # nesting depth of session_scope() per thread
+
+# the sessions of the manager are used by several threads one after another
+SQLITE_CONNECT_ARGS = {'check_same_thread': False, 'timeout': 10}
+
+# set on every new connection of the manager and the webinterface, both use the same database file
+SQLITE_PRAGMAS = [
+	"PRAGMA journal_mode=WAL", # readers don't block the writer and vice versa
+	"PRAGMA synchronous=NORMAL", # safe in WAL mode, only the last transactions may be lost on power loss
+	"PRAGMA busy_timeout=10000", # wait for locks instead of failing with "database is locked"
+	"PRAGMA mmap_size=67108864",
+	"PRAGMA cache_size=-8000" # in KiB
+]
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+	if not isinstance(dbapi_connection, sqlite3.Connection):
+		return
+	cursor = dbapi_connection.cursor()
+	for pragma in SQLITE_PRAGMAS:
+		cursor.execute(pragma)
+	cursor.close()
+
+# engine for the given database file, used by the manager and the webinterface
+def create_sqlite_engine(dbfile, **kwargs):
+	return create_engine("sqlite:///%s"%dbfile, connect_args=SQLITE_CONNECT_ARGS, **kwargs)
 
 def connect(path):
 	global session
 	global engine
 	
-	# TODO: think about check_same_thread=False
-	engine = create_engine("sqlite:///%s/data.db"%path, connect_args={'check_same_thread':False}, echo = False) # echo = true aktiviert debug logging
+	# sessions aren't shared between threads, the scoped session gives every thread its own
+	engine = create_sqlite_engine("%s/data.db"%path, echo = False) # echo = true aktiviert debug logging
+
+	# every thread gets its own session, call session.remove() when a unit of work is done
+	session = scoped_session(sessionmaker(bind=engine))
 
-	Session = sessionmaker(bind=engine)
-	session = Session()
+# a unit of work with the session of the current thread, which is committed at the end and rolled back on errors.
+# Afterwards the session is removed, so nothing leaks into the next unit of work of the thread. Nested scopes
+# join the outermost one.
+@contextmanager
+def session_scope():
+	depth = getattr(scope_state, 'depth', 0)
+	scope_state.depth = depth + 1
+	try:
+		yield session()
+		if depth == 0:
+			session.commit()
+	except:
+		if depth == 0:
+			session.rollback()
+		raise
+	finally:
+		scope_state.depth = depth
+		if depth == 0:
+			session.remove()
 
 def setup():
 	objects.setup(engine)
+	migrations.migrate(engine)
 
@@ -0,0 +1,50 @@
+import datetime
+import logging
+
+# Schema changes of existing databases. New tables and columns of new databases are created by
+# objects.setup(), the migrations bring databases which were created by older versions up to date.
+# The version of a database is stored in the schema_version table, every migration runs once.
+# Migrations have to work on databases which were just created by objects.setup() as well.
+
+
+def create_indexes_v1(conn):
+	conn.execute("CREATE INDEX IF NOT EXISTS ix_alarms_ack_alarmtime ON alarms (ack, alarmtime)")
+	conn.execute("CREATE INDEX IF NOT EXISTS ix_alarms_alarmtime ON alarms (alarmtime)")
+	conn.execute("CREATE INDEX IF NOT EXISTS ix_logs_ack_level_logtime ON logs (ack, level, logtime)")
+	conn.execute("CREATE INDEX IF NOT EXISTS ix_logs_ack_logtime ON logs (ack, logtime)")
+	conn.execute("CREATE INDEX IF NOT EXISTS ix_logs_logtime ON logs (logtime)")
+	conn.execute("CREATE INDEX IF NOT EXISTS ix_sensors_worker_id ON sensors (worker_id)")
+	conn.execute("CREATE INDEX IF NOT EXISTS ix_setups_active_state ON setups (active_state)")
+	conn.execute("CREATE INDEX IF NOT EXISTS ix_workers_address ON workers (address)")
+	conn.execute("CREATE INDEX IF NOT EXISTS ix_params_object_type_object_id ON params (object_type, object_id)")
+	conn.execute("ANALYZE") # statistics for the query planner
+
+
+# (version, description, function) in ascending order, only append new migrations
+MIGRATIONS = [
+	(1, "Indexes for alarms, logs, sensors, setups, workers and params", create_indexes_v1)
+]
+
+
+def get_version(conn):
+	return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").scalar()
+
+# brings the database up to date, returns the version of the schema
+def migrate(engine):
+	with engine.begin() as conn:
+		conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description VARCHAR, applied DATETIME)")
+		version = get_version(conn)
+
+	for migration_version, description, migration in MIGRATIONS:
+		if migration_version <= version:
+			continue
+
+		logging.info("Migrating database to version %d: %s" % (migration_version, description))
+		with engine.begin() as conn:
+			migration(conn)
+			# another process (manager or webinterface) might have run the migration at the same time
+			conn.execute("INSERT OR IGNORE INTO schema_version (version, description, applied) VALUES (?, ?, ?)",
+				(migration_version, description, datetime.datetime.now()))
+		version = migration_version
+
+	return version
@@ -1,5 +1,5 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Table
+from sqlalchemy import Column, Index, Table
 from sqlalchemy import Integer, String, DateTime, Boolean
 from sqlalchemy import ForeignKey
 from sqlalchemy.orm import relationship, backref
@@ -15,6 +15,9 @@ zone_setup_table = Table('zones_setups', Base.metadata,
 
 class Setup(Base):
 	__tablename__ = 'setups'
+	__table_args__ = (
+		Index('ix_setups_active_state', 'active_state'),
+	)
 	id = Column(Integer, primary_key=True)
 	name = Column(String, nullable=False)
 	description = Column(String)
@@ -42,6 +45,9 @@ class Zone(Base):
 
 class Sensor(Base):
 	__tablename__ = 'sensors'
+	__table_args__ = (
+		Index('ix_sensors_worker_id', 'worker_id'),
+	)
 	id = Column(Integer, primary_key=True)
 	name = Column(String, nullable=False)
 	description = Column(String)
@@ -62,6 +68,10 @@ class Sensor(Base):
 
 class Alarm(Base):
 	__tablename__ = 'alarms'
+	__table_args__ = (
+		Index('ix_alarms_ack_alarmtime', 'ack', 'alarmtime'),
+		Index('ix_alarms_alarmtime', 'alarmtime'),
+	)
 
 	id = Column(Integer, primary_key=True)
 	alarmtime = Column(DateTime, nullable=False, default=datetime.datetime.now)
@@ -75,6 +85,11 @@ class Alarm(Base):
 
 class LogEntry(Base):
 	__tablename__ = 'logs'
+	__table_args__ = (
+		Index('ix_logs_ack_level_logtime', 'ack', 'level', 'logtime'),
+		Index('ix_logs_ack_logtime', 'ack', 'logtime'),
+		Index('ix_logs_logtime', 'logtime'),
+	)
 
 	id = Column(Integer, primary_key=True)
 	logtime = Column(DateTime, nullable=False, default=datetime.datetime.now)
@@ -95,6 +110,9 @@ worker_action_table = Table('workers_actions', Base.metadata,
 
 class Worker(Base):
 	__tablename__ = 'workers'
+	__table_args__ = (
+		Index('ix_workers_address', 'address'),
+	)
 
 	id = Column(Integer, primary_key=True)
 	name = Column(String, nullable=False)
@@ -144,6 +162,9 @@ class Notifier(Base):
 
 class Param(Base):
 	__tablename__ = 'params'
+	__table_args__ = (
+		Index('ix_params_object_type_object_id', 'object_type', 'object_id'),
+	)
 	
 	id = Column(Integer, primary_key=True)
 	key = Column(String, nullable=False)
@@ -157,5 +178,9 @@ class Param(Base):
 	def __repr__(self):
 		return "Param %s:%s" % (self.key, self.value)	
 
+# classes which are part of the configuration of the workers and notifiers
+CONFIG_CLASSES = (Setup, Zone, Sensor, Worker, Action, Notifier, Param)
+
+# indexes are also created by migrations for databases which existed before, see migrations.py
 def setup(engine):
 	Base.metadata.create_all(engine)
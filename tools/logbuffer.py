@@ -0,0 +1,126 @@
+import collections
+import datetime
+import logging
+import threading
+import time
+
+from tools import utils
+from tools.db import database as db
+
+
+# Buffers log entries and writes them to the database in bulk, one transaction per flush instead of one per entry.
+# Senders which exceed their rate limit only get warnings and errors stored, everything else is dropped (sampling).
+# If the buffer is full, entries below error level are dropped and errors wait a short time for free space (backpressure).
+class LogBuffer(object):
+
+	def __init__(self, max_size=5000, flush_size=200, flush_interval=1.0, sender_limit=100, sender_window=10):
+		self.max_size = max_size
+		self.flush_size = flush_size
+		self.flush_interval = flush_interval
+		self.sender_limit = sender_limit # max number of entries per sender within the sender window
+		self.sender_window = sender_window
+
+		self.entries = collections.deque()
+		self.condition = threading.Condition()
+		self.sender_counts = {}
+		self.window_start = time.time()
+
+		self.queued = 0
+		self.flushed = 0
+		self.dropped = 0
+		self.sampled = 0
+		self.dropped_by_sender = collections.Counter()
+
+		self.flush_thread = threading.Thread(name="thread-logbuffer", target=self.run)
+		self.flush_thread.daemon = True
+
+	def start(self):
+		self.flush_thread.start()
+
+	# adds a log entry to the buffer, returns False if it was dropped
+	def add(self, level, message, sender, logtime=None):
+		entry = db.objects.LogEntry(level=level, message=message, sender=sender, logtime=(logtime or datetime.datetime.now()))
+
+		with self.condition:
+			if not self.within_sender_limit(sender) and level < utils.LEVEL_WARN:
+				self.sampled += 1
+				self.dropped_by_sender[sender] += 1
+				return False
+
+			if len(self.entries) >= self.max_size:
+				if level < utils.LEVEL_ERR:
+					self.dropped += 1
+					self.dropped_by_sender[sender] += 1
+					return False
+				# errors are important, wait for the next flush
+				self.condition.notify_all()
+				self.condition.wait(self.flush_interval)
+				if len(self.entries) >= self.max_size:
+					self.dropped += 1
+					self.dropped_by_sender[sender] += 1
+					return False
+
+			self.entries.append(entry)
+			self.queued += 1
+			if len(self.entries) >= self.flush_size:
+				self.condition.notify_all()
+
+		return True
+
+	# counts the entries per sender within the current window
+	def within_sender_limit(self, sender):
+		now = time.time()
+		if now - self.window_start > self.sender_window:
+			self.sender_counts = {}
+			self.window_start = now
+
+		self.sender_counts[sender] = self.sender_counts.get(sender, 0) + 1
+		return self.sender_counts[sender] <= self.sender_limit
+
+	def run(self):
+		last_stats = time.time()
+		while True:
+			with self.condition:
+				if len(self.entries) < self.flush_size:
+					self.condition.wait(self.flush_interval)
+
+			self.flush()
+
+			if time.time() - last_stats > 60:
+				logging.debug("Log buffer: %s" % self.stats())
+				last_stats = time.time()
+
+	# writes all buffered entries in one transaction
+	def flush(self):
+		with self.condition:
+			entries = list(self.entries)
+			self.entries.clear()
+			dropped_by_sender = self.dropped_by_sender
+			self.dropped_by_sender = collections.Counter()
+			self.condition.notify_all() # wake up senders waiting for free space
+
+		# add a note about the dropped entries so they don't go missing silently
+		for sender, count in dropped_by_sender.items():
+			entries.append(db.objects.LogEntry(level=utils.LEVEL_WARN, sender="Manager", logtime=datetime.datetime.now(),
+				message="Dropped %d log messages from %s because it sent too many" % (count, sender)))
+
+		if not entries:
+			return
+
+		try:
+			with db.session_scope() as session:
+				session.add_all(entries)
+			self.flushed += len(entries)
+		except Exception as e:
+			logging.exception("Wasn't able to write %d log entries: %s" % (len(entries), e))
+			self.dropped += len(entries)
+
+	def stats(self):
+		with self.condition:
+			return {
+				"buffered": len(self.entries),
+				"queued": self.queued,
+				"flushed": self.flushed,
+				"dropped": self.dropped,
+				"sampled": self.sampled
+			}
@@ -9,6 +9,13 @@ class Notifier(object):
 
 	@abc.abstractmethod
 	def notify(self, info):
+		"""Raises an exception if the notification failed. Returns None if it was sent, or a status
+		like "queued" if it will only be sent later."""
+		return
+
+	def notify_artifact(self, info, path):
+		"""Called for every file which arrives while the workers are still executing their actions.
+		Notifiers which are able to forward single files right away can override this."""
 		return
 
 	@abc.abstractmethod
@@ -0,0 +1,173 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+from tools import utils
+
+# Messages which couldn't be sent to the manager are stored on disk until the connection is back,
+# so they survive a restart of the worker. Every message gets a unique id when it's sent (the message_id
+# property), a message which is stored again, e.g. because it wasn't confirmed while replaying, is only stored once. Messages are replayed by priority and in the order they were added:
+# alarms first, then log messages, then data. If the outbox is full, the oldest messages with the lowest
+# priority are dropped to make room, but never for a message with an even lower priority.
+
+PRIORITY_ALARM = 0
+PRIORITY_LOG = 1
+PRIORITY_DATA = 2
+
+PRIORITIES = {
+	utils.QUEUE_ALARM: PRIORITY_ALARM,
+	utils.QUEUE_LOG: PRIORITY_LOG,
+	utils.QUEUE_DATA: PRIORITY_DATA
+}
+
+
+def to_bytes(value):
+	if isinstance(value, bytes):
+		return value
+	return value.encode("utf-8")
+
+
+# id of a message, messages without one are always stored as new messages
+def message_id(properties):
+	return properties.get("message_id") or uuid.uuid4().hex
+
+
+class Outbox(object):
+
+	def __init__(self, path, max_bytes=100 * 1024 * 1024):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+
+		self.conn = sqlite3.connect(path, check_same_thread=False)
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("PRAGMA synchronous=NORMAL")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS messages (seq INTEGER PRIMARY KEY AUTOINCREMENT, message_id TEXT UNIQUE NOT NULL, "
+			"priority INTEGER NOT NULL, created REAL NOT NULL, rk TEXT NOT NULL, body BLOB, properties TEXT, size INTEGER NOT NULL)")
+		self.conn.execute("CREATE INDEX IF NOT EXISTS ix_messages_priority_seq ON messages (priority, seq)")
+		self.conn.commit()
+
+		self.count, self.size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM messages").fetchone()
+		self.added = 0
+		self.duplicates = 0
+		self.dropped = 0
+		self.replayed = 0
+
+		if self.count:
+			logging.info("Outbox contains %d messages (%d bytes) which weren't sent yet" % (self.count, self.size))
+
+	def __len__(self):
+		return self.count
+
+	# stores a message, properties is a dict which can be serialized to JSON, returns False if it was dropped
+	def add(self, rk, body, properties=None):
+		properties = properties or {}
+		body = to_bytes(body)
+		priority = PRIORITIES.get(rk, PRIORITY_LOG)
+		size = len(body)
+
+		with self.lock:
+			if self.max_bytes and self.size + size > self.max_bytes and not self.make_room(size, priority):
+				self.dropped += 1
+				logging.error("Outbox is full, dropped message for %s (%d bytes)" % (rk, size))
+				return False
+
+			cursor = self.conn.execute("INSERT OR IGNORE INTO messages (message_id, priority, created, rk, body, properties, size) VALUES (?, ?, ?, ?, ?, ?, ?)",
+				(message_id(properties), priority, time.time(), rk, sqlite3.Binary(body), json.dumps(properties), size))
+			self.conn.commit()
+
+			if cursor.rowcount == 0: # could happen if we have another disconnect while replaying the outbox
+				self.duplicates += 1
+				logging.debug("Message already in outbox")
+				return True
+
+			self.count += 1
+			self.size += size
+			self.added += 1
+			return True
+
+	# drops the oldest messages with the lowest priority until the given size fits, the lock has to be held
+	def make_room(self, size, priority):
+		free = self.max_bytes - self.size
+		drop = []
+		for seq, message_size in self.conn.execute("SELECT seq, size FROM messages WHERE priority >= ? ORDER BY priority DESC, seq", (priority,)):
+			if free >= size:
+				break
+			drop.append(seq)
+			free += message_size
+
+		if free < size:
+			return False
+
+		for i in range(0, len(drop), 500): # sqlite only allows a limited number of parameters per query
+			batch = drop[i:i + 500]
+			self.conn.execute("DELETE FROM messages WHERE seq IN (%s)" % ",".join("?" * len(batch)), batch)
+		self.conn.commit()
+
+		logging.warning("Outbox is full, dropped %d old messages" % len(drop))
+		self.count -= len(drop)
+		self.size = self.max_bytes - free
+		self.dropped += len(drop)
+		return True
+
+	# hands the stored messages to send(rk, body, properties) in batches and removes the ones which were sent,
+	# stops at the first message which couldn't be sent, returns the number of sent messages
+	def replay(self, send, batch_size=100):
+		sent = 0
+		last = (-1, -1)
+		while True:
+			with self.lock:
+				rows = self.conn.execute("SELECT seq, priority, rk, body, properties, size FROM messages WHERE priority > ? OR (priority = ? AND seq > ?) ORDER BY priority, seq LIMIT ?",
+					(last[0], last[0], last[1], batch_size)).fetchall()
+			if not rows:
+				break
+
+			done = []
+			failed = False
+			for seq, priority, rk, body, properties, size in rows:
+				if not send(rk, bytes(body), json.loads(properties)):
+					failed = True
+					break
+				done.append((seq, size))
+				last = (priority, seq)
+
+			self.remove(done)
+			sent += len(done)
+			if failed:
+				break
+
+		self.replayed += sent
+		if sent:
+			logging.info("Replayed %d messages from outbox, %d left" % (sent, self.count))
+		return sent
+
+	def remove(self, messages):
+		if not messages:
+			return
+		with self.lock:
+			cursor = self.conn.executemany("DELETE FROM messages WHERE seq = ?", [(seq,) for seq, size in messages])
+			self.conn.commit()
+			# messages might have been dropped by make_room in the meantime
+			if cursor.rowcount == len(messages):
+				self.count -= len(messages)
+				self.size -= sum(size for seq, size in messages)
+			else:
+				self.count, self.size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM messages").fetchone()
+
+	def close(self):
+		with self.lock:
+			self.conn.close()
+
+	def stats(self):
+		with self.lock:
+			return {
+				"messages": self.count,
+				"bytes": self.size,
+				"added": self.added,
+				"duplicates": self.duplicates,
+				"dropped": self.dropped,
+				"replayed": self.replayed
+			}
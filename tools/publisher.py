@@ -0,0 +1,160 @@
+import collections
+import logging
+import time
+
+# Publishes messages in confirm mode without waiting for every single confirmation. The broker acknowledges
+# messages asynchronously, possibly many at once ("multiple"), by the delivery tag, which counts the messages
+# published on the channel starting with 1. Messages are kept until they are confirmed:
+#   - nacked messages and messages which weren't confirmed within the timeout are published again
+#   - after the given number of retries or when the connection is lost they are handed to on_failed
+# Confirmations are processed whenever the connection processes its events, e.g. while consuming.
+# If more than max_in_flight messages are unconfirmed, publish waits for confirmations (backpressure).
+# Like the connection, it isn't thread safe: it must only be used by the thread which runs the connection.
+
+
+class PublishedMessage(object):
+
+	def __init__(self, rk, body, properties):
+		self.rk = rk
+		self.body = body
+		self.properties = properties
+		self.attempts = 0
+		self.published = None
+		self.first_published = None
+
+
+class ConfirmPublisher(object):
+
+	def __init__(self, connection, channel, exchange, max_in_flight=256, retries=3, timeout=30, on_failed=None):
+		self.connection = connection
+		self.channel = channel
+		self.exchange = exchange
+		self.max_in_flight = max_in_flight
+		self.retries = retries
+		self.timeout = timeout
+		self.on_failed = on_failed or (lambda rk, body, properties: logging.error("Message for %s wasn't confirmed by the broker" % rk))
+
+		self.outstanding = collections.OrderedDict() # delivery tag -> message, in the order they were published
+		self.rejected = [] # nacked messages, they are published again outside of the callback
+		self.next_tag = 1
+		self.latencies = collections.deque(maxlen=1000)
+
+		self.published = 0
+		self.confirmed = 0
+		self.nacked = 0
+		self.retried = 0
+		self.failed = 0
+
+		# the blocking channel of pika only supports waiting for every single confirmation,
+		# the asynchronous channel it wraps calls us back instead
+		impl = getattr(channel, "_impl", channel)
+		impl.confirm_delivery(callback=self.on_confirm, nowait=True)
+
+	# publishes a message, raises the exceptions of the channel, e.g. if the connection was lost
+	def publish(self, rk, body, properties=None):
+		if len(self.outstanding) >= self.max_in_flight:
+			self.wait(lambda: len(self.outstanding) < self.max_in_flight)
+		self.send(PublishedMessage(rk, body, properties))
+		self.check_retries()
+
+	def send(self, message):
+		self.channel.basic_publish(exchange=self.exchange, routing_key=message.rk, body=message.body, properties=message.properties)
+		message.attempts += 1
+		message.published = time.time()
+		if message.first_published is None:
+			message.first_published = message.published
+		self.outstanding[self.next_tag] = message
+		self.next_tag += 1
+		self.published += 1
+
+	# callback of the channel for Basic.Ack and Basic.Nack
+	def on_confirm(self, frame):
+		method = frame.method
+		if method.multiple:
+			tags = []
+			for tag in self.outstanding:
+				if tag > method.delivery_tag:
+					break
+				tags.append(tag)
+		else:
+			tags = [method.delivery_tag] if method.delivery_tag in self.outstanding else []
+
+		now = time.time()
+		nack = method.NAME == "Basic.Nack"
+		for tag in tags:
+			message = self.outstanding.pop(tag)
+			if nack:
+				self.nacked += 1
+				self.rejected.append(message)
+			else:
+				self.confirmed += 1
+				self.latencies.append(now - message.first_published)
+
+	def retry(self, message):
+		if message.attempts > self.retries:
+			self.failed += 1
+			self.on_failed(message.rk, message.body, message.properties)
+			return
+		logging.debug("Publishing message for %s again (attempt %d)" % (message.rk, message.attempts + 1))
+		self.retried += 1
+		self.send(message)
+
+	# publishes the messages again which were nacked or weren't confirmed in time, the oldest ones are first
+	def check_retries(self):
+		rejected = self.rejected
+		self.rejected = []
+		for message in rejected:
+			self.retry(message)
+
+		now = time.time()
+		expired = []
+		for tag, message in self.outstanding.items():
+			if now - message.published < self.timeout:
+				break
+			expired.append(tag)
+		for tag in expired:
+			self.retry(self.outstanding.pop(tag))
+
+	# processes the events of the connection until done() returns True or the timeout is over
+	def wait(self, done, timeout=None):
+		end = time.time() + (timeout if timeout is not None else self.timeout)
+		while not done():
+			remaining = end - time.time()
+			if remaining <= 0:
+				return False
+			self.connection.process_data_events(time_limit=min(remaining, 0.1))
+			self.check_retries()
+		return True
+
+	# waits until all messages are confirmed, returns False if some are still outstanding
+	def flush(self, timeout=None):
+		return self.wait(lambda: not self.outstanding and not self.rejected, timeout)
+
+	# hands all unconfirmed messages to on_failed, has to be called when the connection was lost
+	def reset(self):
+		messages = self.rejected + list(self.outstanding.values())
+		self.outstanding.clear()
+		self.rejected = []
+		self.next_tag = 1
+		for message in messages:
+			self.failed += 1
+			self.on_failed(message.rk, message.body, message.properties)
+		return len(messages)
+
+	def in_flight(self):
+		return len(self.outstanding) + len(self.rejected)
+
+	def stats(self):
+		latencies = sorted(self.latencies)
+		return {
+			"published": self.published,
+			"confirmed": self.confirmed,
+			"nacked": self.nacked,
+			"retried": self.retried,
+			"failed": self.failed,
+			"in_flight": len(self.outstanding) + len(self.rejected),
+			"latency_avg": sum(latencies) / len(latencies) if latencies else 0,
+			"latency_p50": latencies[len(latencies) // 2] if latencies else 0,
+			"latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else 0,
+			"latency_max": latencies[-1] if latencies else 0
+		}
@@ -0,0 +1,118 @@
+import logging
+import os
+import shutil
+import threading
+import time
+
+from tools.db import database as db
+
+# Deletes the data of old alarms so the disk of the manager doesn't fill up. The sizes are taken
+# from the alarm index, so the data directory never has to be walked. The oldest alarms are deleted first:
+#   - alarms older than max_age days
+#   - further alarms as long as all alarms together are bigger than max_bytes
+# The keep_last newest alarms, alarms which still receive data and (if pin_acked is set) acknowledged
+# alarms are never deleted. A limit of 0 disables it.
+class Retention(object):
+
+	def __init__(self, index, max_bytes=0, max_age=0, keep_last=10, pin_acked=True, interval=300, is_active=None):
+		self.index = index
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self.keep_last = keep_last
+		self.pin_acked = pin_acked
+		self.interval = interval
+		self.is_active = is_active or (lambda alarm_id: False) # alarms which are still running mustn't be deleted
+
+		self.deleted_alarms = 0
+		self.deleted_bytes = 0
+		self.wakeup = threading.Event()
+
+		self.thread = threading.Thread(name="thread-retention", target=self.run)
+		self.thread.daemon = True
+
+	def start(self):
+		self.thread.start()
+
+	# runs the retention right away, e.g. after a lot of data was received
+	def trigger(self):
+		self.wakeup.set()
+
+	def run(self):
+		while True:
+			try:
+				self.enforce()
+			except Exception as e:
+				logging.exception("Retention: Error while deleting old alarm data: %s" % e)
+			self.wakeup.wait(self.interval)
+			self.wakeup.clear()
+
+	# deletes the alarms which violate the policy, returns their ids
+	def enforce(self):
+		alarms = self.index.list() # newest first
+		pinned = self.pinned_alarms(alarms)
+		total = sum(entry["size"] for alarm_id, entry in alarms)
+		now = time.time()
+
+		deleted = []
+		for alarm_id, entry in reversed(alarms[self.keep_last:]): # oldest first
+			too_old = self.max_age > 0 and now - entry["created"] > self.max_age * 86400
+			too_big = self.max_bytes > 0 and total > self.max_bytes
+			if not too_old and not too_big:
+				continue
+			if alarm_id in pinned or self.is_active(alarm_id):
+				continue
+
+			if self.delete(alarm_id):
+				total -= entry["size"]
+				self.deleted_alarms += 1
+				self.deleted_bytes += entry["size"]
+				deleted.append(alarm_id)
+
+		if self.max_bytes > 0 and total > self.max_bytes:
+			logging.warning("Retention: Alarm data uses %d bytes, but only the kept alarms are left (limit: %d bytes)" % (total, self.max_bytes))
+		if deleted:
+			logging.info("Retention: Deleted data of %d alarms: %s" % (len(deleted), deleted))
+
+		self.index.set_meta("retention", self.state(total, len(alarms) - len(deleted), len(pinned)))
+		return deleted
+
+	# alarms which were acknowledged in the webinterface are kept
+	def pinned_alarms(self, alarms):
+		if not self.pin_acked:
+			return set()
+
+		db_ids = dict((entry["db_id"], alarm_id) for alarm_id, entry in alarms if entry.get("db_id") is not None)
+		if not db_ids:
+			return set()
+		pinned = set()
+		ids = list(db_ids)
+		with db.session_scope() as session:
+			for i in range(0, len(ids), 500): # sqlite only allows a limited number of parameters per query
+				acked = session.query(db.objects.Alarm.id).filter(db.objects.Alarm.ack == True).filter(db.objects.Alarm.id.in_(ids[i:i + 500])).all()
+				pinned.update(db_ids[row.id] for row in acked)
+		return pinned
+
+	def delete(self, alarm_id):
+		alarm_dir = os.path.join(self.index.data_dir, alarm_id)
+		try:
+			if os.path.isdir(alarm_dir):
+				shutil.rmtree(alarm_dir)
+			self.index.remove_alarm(alarm_id)
+			return True
+		except (IOError, OSError) as e:
+			logging.error("Retention: Wasn't able to delete %s: %s" % (alarm_dir, e))
+			return False
+
+	def state(self, total, alarms, pinned):
+		return {
+			"last_run": time.time(),
+			"total_bytes": total,
+			"alarms": alarms,
+			"pinned": pinned,
+			"deleted_alarms": self.deleted_alarms,
+			"deleted_bytes": self.deleted_bytes,
+			"max_bytes": self.max_bytes,
+			"max_age": self.max_age,
+			"keep_last": self.keep_last,
+			"pin_acked": self.pin_acked
+		}
@@ -0,0 +1,172 @@
+import collections
+import hashlib
+import logging
+import os
+import time
+import uuid
+
+# Alarm data is sent from the workers to the manager in chunks, every chunk is a
+# separate message on the data queue. The AMQP headers of a chunk describe where it belongs:
+#   transfer_id: unique id of the file transfer
+#   name: file name on the sender side
+#   seq: sequence number of the chunk, starting with 0
+#   total: total number of chunks of the file
+#   chunk_size: nominal size of a chunk, used to compute the offset of the chunk in the file
+#   chunk_md5: checksum of the chunk
+#   md5: checksum of the whole file
+
+CHUNK_SIZE = 256 * 1024
+MAX_FINISHED = 1000 # ids of finished transfers which are remembered to drop chunks which are sent again
+
+
+class TransferError(Exception):
+	pass
+
+
+# calculates the md5 checksum of a file without reading it into memory completely
+def file_md5(path, chunk_size=CHUNK_SIZE):
+	md5 = hashlib.md5()
+	with open(path, "rb") as f:
+		for data in iter(lambda: f.read(chunk_size), b""):
+			md5.update(data)
+	return md5.hexdigest()
+
+
+# generator which yields the headers and the data of every chunk of the given file
+def read_chunks(path, chunk_size=CHUNK_SIZE):
+	size = os.path.getsize(path)
+	total = max(1, (size + chunk_size - 1) // chunk_size)
+	headers = {
+		"transfer_id": uuid.uuid4().hex,
+		"name": os.path.basename(path),
+		"total": total,
+		"chunk_size": chunk_size,
+		"md5": file_md5(path, chunk_size)
+	}
+
+	with open(path, "rb") as f:
+		for seq in range(0, total):
+			data = f.read(chunk_size)
+			chunk_headers = dict(headers)
+			chunk_headers["seq"] = seq
+			chunk_headers["chunk_md5"] = hashlib.md5(data).hexdigest()
+			yield chunk_headers, data
+
+
+# state of a single file which is being received
+class IncomingTransfer(object):
+
+	def __init__(self, directory, headers):
+		try:
+			self.transfer_id = headers["transfer_id"]
+			self.name = os.path.basename(headers["name"])
+			self.total = int(headers["total"])
+			self.chunk_size = int(headers["chunk_size"])
+			self.md5 = headers["md5"]
+		except (KeyError, TypeError, ValueError) as e:
+			raise TransferError("Invalid transfer headers: %s" % e)
+
+		if self.total < 1 or self.chunk_size < 1:
+			raise TransferError("Invalid transfer headers of %s: total %d, chunk_size %d" % (self.name, self.total, self.chunk_size))
+
+		self.directory = directory
+		self.part_path = os.path.join(directory, "%s.part" % self.transfer_id)
+		self.received = set()
+		self.corrupted = []
+		self.last_activity = time.time()
+		self.file = open(self.part_path, "wb")
+
+	# writes a chunk at its position in the file, returns True if the transfer is complete
+	def write(self, seq, data, chunk_md5):
+		if not 0 <= seq < self.total:
+			raise TransferError("Invalid chunk %d of %s, it only has %d chunks" % (seq, self.name, self.total))
+		if len(data) > self.chunk_size:
+			raise TransferError("Chunk %d of %s is bigger than the chunk size" % (seq, self.name))
+
+		self.last_activity = time.time()
+		if seq in self.received: # duplicate, e.g. resent after a reconnect
+			return False
+
+		if hashlib.md5(data).hexdigest() != chunk_md5:
+			self.corrupted.append(seq)
+		else:
+			self.file.seek(seq * self.chunk_size)
+			self.file.write(data)
+
+		self.received.add(seq)
+		return len(self.received) >= self.total
+
+	# closes the file and moves it to its final name, named after its checksum
+	def finish(self):
+		self.file.close()
+		if self.corrupted:
+			os.unlink(self.part_path)
+			raise TransferError("Chunks %s of %s had a wrong checksum" % (self.corrupted, self.name))
+
+		if file_md5(self.part_path, self.chunk_size) != self.md5:
+			os.unlink(self.part_path)
+			raise TransferError("Checksum of %s doesn't match" % self.name)
+
+		extension = os.path.splitext(self.name)[1]
+		path = os.path.join(self.directory, "%s%s" % (self.md5, extension))
+		os.rename(self.part_path, path)
+		return path
+
+	def abort(self):
+		self.file.close()
+		try:
+			os.unlink(self.part_path)
+		except OSError:
+			pass
+
+
+# reassembles the chunks of the incoming transfers on disk
+class TransferAssembler(object):
+
+	def __init__(self, timeout):
+		self.timeout = timeout
+		self.transfers = {}
+		self.finished = collections.OrderedDict() # transfer id -> None, the oldest first
+
+	# writes a chunk into the given directory, returns the path of the file once all chunks arrived,
+	# None if the transfer isn't complete yet or is already finished. Raises a TransferError if the file is corrupted or the headers are invalid.
+	def add_chunk(self, directory, headers, data):
+		self.remove_stale()
+
+		if headers.get("transfer_id") in self.finished: # resent, e.g. from the outbox of the worker after a missed confirm
+			logging.debug("Dropping chunk of finished transfer %s" % headers.get("transfer_id"))
+			return None
+
+		transfer = self.transfers.get(headers.get("transfer_id"))
+		if transfer is None:
+			transfer = IncomingTransfer(directory, headers)
+			self.transfers[transfer.transfer_id] = transfer
+			logging.debug("Started receiving %s (%d chunks)" % (transfer.name, transfer.total))
+
+		try:
+			seq = int(headers["seq"])
+			chunk_md5 = headers["chunk_md5"]
+		except (KeyError, TypeError, ValueError) as e:
+			raise TransferError("Invalid chunk headers of %s: %s" % (transfer.name, e))
+
+		if not transfer.write(seq, data, chunk_md5):
+			return None
+
+		self.finish(transfer.transfer_id)
+		return transfer.finish()
+
+	# forgets a transfer and remembers that it's finished
+	def finish(self, transfer_id):
+		del self.transfers[transfer_id]
+		self.finished[transfer_id] = None
+		while len(self.finished) > MAX_FINISHED:
+			self.finished.popitem(last=False)
+
+	# drops transfers which didn't receive any chunk within the timeout, e.g. because the worker died
+	def remove_stale(self):
+		now = time.time()
+		for transfer_id, transfer in list(self.transfers.items()):
+			if now - transfer.last_activity > self.timeout:
+				logging.error("Transfer of %s timed out after %d out of %d chunks" % (transfer.name, len(transfer.received), transfer.total))
+				transfer.abort()
+				self.finish(transfer_id)
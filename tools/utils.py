@@ -5,6 +5,8 @@ import pytz
 
 import json
 import datetime
+import re
+import uuid
 
 import cherrypy
 
@@ -22,6 +24,7 @@ QUEUE_ON_OFF="secpi-on_off"
 QUEUE_ACTION="secpi-action-"
 QUEUE_CONFIG="secpi-config-"
 QUEUE_INIT_CONFIG="secpi-init_config"
+QUEUE_CONFIG_CHANGED="secpi-config_changed"
 
 def filter_fields(fields, filter):
 	filtered_data = OrderedDict()
@@ -61,6 +64,15 @@ def check_late_arrival(date_message):
 		else:
 			return True
 
+# alarm ids are used as correlation id in messages and as name of the alarm data directory
+ALARM_ID_PATTERN = re.compile(r"^\d{8}_\d{6}_[0-9a-f]{8}$")
+
+def create_alarm_id():
+	return "%s_%s" % (datetime.datetime.now().strftime("%Y%m%d_%H%M%S"), uuid.uuid4().hex[:8])
+
+def is_alarm_id(alarm_id):
+	return bool(alarm_id) and ALARM_ID_PATTERN.match(alarm_id) is not None
+
 class SpecialJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, datetime.date):
@@ -6,16 +6,44 @@ from mako.lookup import TemplateLookup
 from collections import OrderedDict
 
 # db stuff
-from sqlalchemy import text
+from sqlalchemy import and_, or_
+import datetime
+import dateutil.parser
 
 from tools import utils
 
 import urllib
 
 
+class ListError(Exception):
+	"""Invalid parameters for a list request."""
+	pass
+
+
+def escapeLike(value):
+	return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+# operators of the filter conditions of list requests
+FILTER_OPS = {
+	'==': lambda column, value: column == value,
+	'!=': lambda column, value: column != value,
+	'<': lambda column, value: column < value,
+	'<=': lambda column, value: column <= value,
+	'>': lambda column, value: column > value,
+	'>=': lambda column, value: column >= value,
+	'in': lambda column, value: column.in_(value),
+	'contains': lambda column, value: column.like(u"%%%s%%"%escapeLike(value), escape="\\")
+}
+
+
 class BaseWebPage(object):
 	"""A baseclass for a CherryPy web page."""
 	
+	max_limit = 1000 # maximum number of objects per page
+	max_conditions = 10 # maximum number of filter conditions of a list request
+	max_in_values = 100 # maximum number of values of an 'in' condition
+	
 	def __init__(self, baseclass):
 		self.baseclass = baseclass
 		self.fields = OrderedDict()
@@ -52,25 +80,155 @@ class BaseWebPage(object):
 		return {'status': 'success', 'data': self.fields}
 		
 	
+	def column(self, field):
+		"""Returns the column of the given field, only fields of the page can be used."""
+		if(field not in self.fields or field not in self.baseclass.__table__.columns):
+			raise ListError("Invalid field: %s"%field)
+		return getattr(self.baseclass, field)
+	
+	def coerceValue(self, column, value):
+		"""Converts a value of a JSON request to the type of the column."""
+		if value is None:
+			return None
+		
+		try:
+			python_type = column.type.python_type
+		except NotImplementedError:
+			return value
+		
+		try:
+			if python_type is bool:
+				return value if isinstance(value, bool) else utils.str_to_value(unicode(value)) in (True, 1)
+			if python_type is datetime.datetime:
+				return value if isinstance(value, datetime.datetime) else dateutil.parser.parse(value).replace(tzinfo=None)
+			if python_type in (int, long, float):
+				return python_type(value)
+		except (ValueError, TypeError, OverflowError):
+			raise ListError("Invalid value for %s: %s"%(column.key, value))
+		
+		return value
+	
+	def filterExpression(self, condition):
+		"""Compiles a filter condition {field, op, value} to an expression with bound parameters."""
+		if(not isinstance(condition, dict)):
+			raise ListError("Invalid filter condition: %s"%condition)
+		
+		column = self.column(condition.get('field'))
+		op = condition.get('op', '==')
+		value = condition.get('value')
+		if(op not in FILTER_OPS):
+			raise ListError("Invalid filter operator: %s"%op)
+		
+		if(op == 'in'):
+			if(not isinstance(value, list) or len(value) > self.max_in_values):
+				raise ListError("Value of an 'in' condition has to be a list of at most %d values!"%self.max_in_values)
+			value = [self.coerceValue(column, v) for v in value]
+		elif(op == 'contains'):
+			if(not isinstance(value, basestring)):
+				raise ListError("Value of a 'contains' condition has to be a string!")
+		elif(value is None):
+			if(op == '=='):
+				return column.is_(None)
+			if(op == '!='):
+				return column.isnot(None)
+			raise ListError("Invalid filter value for %s: None"%column.key)
+		else:
+			value = self.coerceValue(column, value)
+		
+		return FILTER_OPS[op](column, value)
+	
+	def projection(self):
+		"""Columns which are loaded for the list, None if the page shows fields which aren't columns."""
+		columns = self.baseclass.__table__.columns
+		if all(k in columns for k in self.fields):
+			return [getattr(self.baseclass, k) for k in self.fields]
+		return None
+	
 	@cherrypy.expose
 	@cherrypy.tools.json_in()
 	@cherrypy.tools.json_out(handler=utils.json_handler)
 	def list(self):
-		if(hasattr(cherrypy.request, 'json')):
+		"""
+		Lists the objects of the page. Optional parameters of the request:
+		  filter: list of conditions {field, op, value} which all have to match, op is one of FILTER_OPS
+		  where: {field: value} only objects with these values, the values are converted to the type of the field
+		  order: field to sort by, desc: sort descending
+		  limit, offset: size and start of the page
+		  after: cursor of the previous page (keyset pagination, needs order), returned as 'next'
+		  count: return the total number of objects (default: true if a limit is given)
+		"""
+		params = getattr(cherrypy.request, 'json', None) or {}
+		try:
+			return self.listPage(params)
+		except ListError as le:
+			return {'status': 'error', 'message': "%s"%le}
+	
+	def listPage(self, params):
+		columns = self.projection()
+		if columns:
+			qry = self.db.query(*columns)
+		else:
 			qry = self.db.query(self.baseclass)
+		
+		conditions = params.get('filter') or []
+		if(not isinstance(conditions, list) or len(conditions) > self.max_conditions):
+			raise ListError("Filter has to be a list of at most %d conditions!"%self.max_conditions)
+		conditions = list(conditions)
+		for field, value in (params.get('where') or {}).iteritems():
+			conditions.append({'field': field, 'op': '==', 'value': value})
+		
+		for condition in conditions:
+			qry = qry.filter(self.filterExpression(condition))
+		
+		limit = params.get('limit')
+		if limit is not None:
+			try:
+				limit = max(min(int(limit), self.max_limit), 0)
+				offset = max(int(params.get('offset', 0)), 0)
+			except (ValueError, TypeError):
+				raise ListError("Invalid limit or offset!")
+		else:
+			offset = 0
+		
+		total = None
+		if params.get('count', limit is not None):
+			total = qry.order_by(None).count()
+		
+		order = params.get('order')
+		if order:
+			column = self.column(order)
+			desc = bool(params.get('desc', False))
+			# the id makes the order unique, so the cursor of a page points to exactly one object
+			if desc:
+				qry = qry.order_by(column.desc(), self.baseclass.id.desc())
+			else:
+				qry = qry.order_by(column, self.baseclass.id)
 			
-			if('filter' in cherrypy.request.json and cherrypy.request.json['filter']!=''):
-				qry = qry.filter(text(cherrypy.request.json['filter']))
-			
-			if('sort' in cherrypy.request.json and cherrypy.request.json['sort']!=''):
-				qry = qry.order_by(text(cherrypy.request.json['sort']))
-			
-			objects = qry.all()
-			
-		else:	
-			objects = self.db.query(self.baseclass).all()
+			after = params.get('after')
+			if after:
+				try:
+					value, last_id = self.coerceValue(column, after[0]), int(after[1])
+				except (IndexError, KeyError, TypeError, ValueError):
+					raise ListError("Invalid cursor!")
+				if desc:
+					qry = qry.filter(or_(column < value, and_(column == value, self.baseclass.id < last_id)))
+				else:
+					qry = qry.filter(or_(column > value, and_(column == value, self.baseclass.id > last_id)))
+				offset = 0
+		
+		if limit is not None:
+			qry = qry.limit(limit).offset(offset)
+		
+		if columns:
+			data = [row._asdict() for row in qry]
+		else:
+			data = self.objectsToList(qry.all())
+		
+		next_cursor = None
+		if order and limit is not None and len(data) == limit and 'id' in data[-1]:
+			next_cursor = [data[-1][order], data[-1]['id']]
 		
-		return {'status': 'success', 'data': self.objectsToList(objects)}
+		return {'status': 'success', 'data': data, 'total': total, 'offset': offset, 'limit': limit, 'next': next_cursor}
 	
 	
 	@cherrypy.expose
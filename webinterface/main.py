@@ -14,8 +14,10 @@ import json
 import traceback
 import logging
 import logging.config
+import itertools
 import subprocess
 import time
+import threading
 
 
 # web framework
@@ -26,6 +28,8 @@ from cherrypy import _cperror
 # db connection
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from sqlalchemy.types import String, Integer
 
 # web <--> db
@@ -39,7 +43,10 @@ from mako.lookup import TemplateLookup
 import pika
 
 # our stuff
+from tools.db import database
+from tools.db import migrations
 from tools.db import objects
+from tools import amqp
 from tools import config
 from tools import utils
 
@@ -90,53 +97,54 @@ class Root(object):
 		
 		self.alarmdata = AlarmDataPage()
 		
+		self.setup_amqp()
 		self.connect()
 		cherrypy.log("Finished initialization")
 			
-	def connect(self, num_tries=3):
-		credentials = pika.PlainCredentials(config.get('rabbitmq')['user'], config.get('rabbitmq')['password'])
-		parameters = pika.ConnectionParameters(credentials=credentials,
-			host=config.get('rabbitmq')['master_ip'],
-			port=5671,
-			ssl=True,
-			socket_timeout=10,
-			ssl_options = {
-				"ca_certs":PROJECT_PATH+"/certs/"+config.get('rabbitmq')['cacert'],
-				"certfile":PROJECT_PATH+"/certs/"+config.get('rabbitmq')['certfile'],
-				"keyfile":PROJECT_PATH+"/certs/"+config.get('rabbitmq')['keyfile']
-			}
-		)
-
-		connected = False
-		while not connected and num_tries > 0:
-			try:
-				cherrypy.log("Trying to connect to rabbitmq service...")
-				self.connection = pika.BlockingConnection(parameters=parameters)
-				self.channel = self.connection.channel()
-				connected = True
-				cherrypy.log("Connection to rabbitmq service established")
-			#except pika.exceptions.AMQPConnectionError as pe:
-			except Exception as e:
-				cherrypy.log("Error connecting to Queue! %s" % e, traceback=True)
-				num_tries-=1
-				time.sleep(30)
+	def setup_amqp(self):
+		topology = amqp.Topology(utils.EXCHANGE)
+		topology.add_queue(utils.QUEUE_ON_OFF)
+		topology.add_queue(utils.QUEUE_CONFIG_CHANGED)
+		# the connection is only used while handling requests, nobody would send heartbeats in between,
+		# a lost connection is noticed when publishing; the retries are short, a request is waiting
+		self.amqp = amqp.Connection(PROJECT_PATH, topology, heartbeat=0, backoff=amqp.Backoff(initial=0.5, maximum=5))
+		# the requests are handled by several threads but pika isn't thread safe, only one of them may use the connection at a time;
+		# reentrant because committing inside activate/deactivate publishes the config change in the same thread
+		self.amqp_lock = threading.RLock()
 
-		if not connected:
+	def connect(self, num_tries=3):
+		cherrypy.log("Trying to connect to rabbitmq service...")
+		if not self.amqp.connect(max_attempts=num_tries):
+			cherrypy.log("Error connecting to Queue!")
 			return False
-		# define exchange
-		self.channel.exchange_declare(exchange=utils.EXCHANGE, exchange_type='direct')
 
-		# define queues
-		self.channel.queue_declare(queue=utils.QUEUE_ON_OFF)
-		self.channel.queue_bind(exchange=utils.EXCHANGE, queue=utils.QUEUE_ON_OFF)
+		self.connection = self.amqp.connection
+		self.channel = self.amqp.channel
+		cherrypy.log("Connection to rabbitmq service established")
 		return True
 
+	# connects again if the connection isn't ready, e.g. because the rabbitmq service wasn't running when we started
+	def ensure_connection(self):
+		return self.amqp.is_ready() or self.connect(1)
+
+	# tells the manager that it has to rebuild the configs of the workers
+	def config_changed(self):
+		with self.amqp_lock:
+			if not self.ensure_connection():
+				cherrypy.log("Can't notify manager about config change, no connection to queue server!")
+				return
+
+			try:
+				self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=utils.QUEUE_CONFIG_CHANGED, body="")
+			except pika.exceptions.ConnectionClosed:
+				cherrypy.log("Reconnecting to RabbitMQ Server!")
+				if self.connect(1):
+					self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=utils.QUEUE_CONFIG_CHANGED, body="")
+				else:
+					cherrypy.log("Can't notify manager about config change, wasn't able to reconnect!")
+
 	def connection_cleanup(self):
-		try:
-			self.channel.close()
-			self.connection.close()
-		except pika.exceptions.ConnectionClosed:
-			cherrypy.log("Wasn't able to cleanup connection")
+		self.amqp.close()
 
 	def log_msg(self, msg, level):
 		log_entry = db.objects.LogEntry(level=level, message=str(msg), sender="Webinterface")
@@ -195,35 +203,36 @@ class Root(object):
 			
 			if(id and id > 0):
 				su = self.db.query(objects.Setup).get(int(id))
-				try:
-					if(hasattr(self, "channel")):
-						su.active_state = True
-						self.db.commit()
-						ooff = { 'active_state': True , 'setup_name': su.name }
-						self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=utils.QUEUE_ON_OFF, body=json.dumps(ooff))
-					else:
-						return {'status':'error', 'message': "Error activating %s! No connection to queue server!" % su.name }
+				with self.amqp_lock:
+					try:
+						if(self.ensure_connection()):
+							su.active_state = True
+							self.db.commit()
+							ooff = { 'active_state': True , 'setup_name': su.name }
+							self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=utils.QUEUE_ON_OFF, body=json.dumps(ooff))
+						else:
+							return {'status':'error', 'message': "Error activating %s! No connection to queue server!" % su.name }
 				
-				except pika.exceptions.ConnectionClosed:
-					cherrypy.log("Reconnecting to RabbitMQ Server!")
-					reconnected = self.connect(5)
-					if reconnected:
-						cherrypy.log("Reconnect finished!")
-						su.active_state = True
+					except pika.exceptions.ConnectionClosed:
+						cherrypy.log("Reconnecting to RabbitMQ Server!")
+						reconnected = self.connect(5)
+						if reconnected:
+							cherrypy.log("Reconnect finished!")
+							su.active_state = True
+							self.db.commit()
+							ooff = { 'active_state': True, 'setup_name': su.name }
+							self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=utils.QUEUE_ON_OFF, body=json.dumps(ooff))
+							return {'status': 'success', 'message': "Activated setup %s!" % su.name}
+						else:
+							return {'status':'error', 'message': "Error activating %s! Wasn't able to reconnect!" % su.name }
+
+					except Exception as e:
+						su.active_state = False
 						self.db.commit()
-						ooff = { 'active_state': True, 'setup_name': su.name }
-						self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=utils.QUEUE_ON_OFF, body=json.dumps(ooff))
-						return {'status': 'success', 'message': "Activated setup %s!" % su.name}
+						cherrypy.log("Error activating! %s"%str(e), traceback=True)
+						return {'status':'error', 'message': "Error activating! %s" % e }
 					else:
-						return {'status':'error', 'message': "Error activating %s! Wasn't able to reconnect!" % su.name }
-
-				except Exception as e:
-					su.active_state = False
-					self.db.commit()
-					cherrypy.log("Error activating! %s"%str(e), traceback=True)
-					return {'status':'error', 'message': "Error activating! %s" % e }
-				else:
-					return {'status': 'success', 'message': "Activated setup %s!" % su.name}
+						return {'status': 'success', 'message': "Activated setup %s!" % su.name}
 			else:
 				return {'status':'error', 'message': "Invalid ID!" }
 		
@@ -238,35 +247,36 @@ class Root(object):
 			
 			if(id and id > 0):
 				su = self.db.query(objects.Setup).get(int(id))
-				try:
-					if(hasattr(self, "channel")):
-						su.active_state = False
-						self.db.commit()
-						ooff = { 'active_state': False, 'setup_name': su.name }
-						self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=utils.QUEUE_ON_OFF, body=json.dumps(ooff))
-					else:
-						return {'status':'error', 'message': "Error deactivating %s! No connection to queue server!"%su.name }
+				with self.amqp_lock:
+					try:
+						if(self.ensure_connection()):
+							su.active_state = False
+							self.db.commit()
+							ooff = { 'active_state': False, 'setup_name': su.name }
+							self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=utils.QUEUE_ON_OFF, body=json.dumps(ooff))
+						else:
+							return {'status':'error', 'message': "Error deactivating %s! No connection to queue server!"%su.name }
 						
-				except pika.exceptions.ConnectionClosed:
-					cherrypy.log("Reconnecting to RabbitMQ Server!")
-					reconnected = self.connect(5)
-					if reconnected:
-						cherrypy.log("Reconnect finished!")
-						su.active_state = False
+					except pika.exceptions.ConnectionClosed:
+						cherrypy.log("Reconnecting to RabbitMQ Server!")
+						reconnected = self.connect(5)
+						if reconnected:
+							cherrypy.log("Reconnect finished!")
+							su.active_state = False
+							self.db.commit()
+							ooff = { 'active_state': False, 'setup_name': su.name }
+							self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=utils.QUEUE_ON_OFF, body=json.dumps(ooff))
+							return {'status': 'success', 'message': "Deactivated setup %s!" % su.name}
+						else:
+							return {'status':'error', 'message': "Error deactivating %s! Wasn't able to reconnect!" % su.name }
+
+					except Exception as e:
+						su.active_state = True;
 						self.db.commit()
-						ooff = { 'active_state': False, 'setup_name': su.name }
-						self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=utils.QUEUE_ON_OFF, body=json.dumps(ooff))
-						return {'status': 'success', 'message': "Deactivated setup %s!" % su.name}
+						cherrypy.log("Error deactivating! %s"%str(e), traceback=True)
+						return {'status':'error', 'message': "Error deactivating! %s" % e }
 					else:
-						return {'status':'error', 'message': "Error deactivating %s! Wasn't able to reconnect!" % su.name }
-
-				except Exception as e:
-					su.active_state = True;
-					self.db.commit()
-					cherrypy.log("Error deactivating! %s"%str(e), traceback=True)
-					return {'status':'error', 'message': "Error deactivating! %s" % e }
-				else:
-					return {'status': 'success', 'message': "Deactivated setup %s!" % su.name}
+						return {'status': 'success', 'message': "Deactivated setup %s!" % su.name}
 			
 			return {'status':'error', 'message': "Invalid ID!" }
 		
@@ -335,18 +345,35 @@ def run():
 		  "tools.staticfile.filename": PROJECT_PATH+"/webinterface/favicon.ico"
 		}
 	}
-	cherrypy.tree.mount(Root(), '/', app_config)
+	root = Root()
+	cherrypy.tree.mount(root, '/', app_config)
+
+	# notify the manager after changes which affect the worker configs were committed
+	def track_config_changes(session, flush_context):
+		for obj in itertools.chain(session.new, session.dirty, session.deleted):
+			if isinstance(obj, objects.CONFIG_CLASSES):
+				session.info['config_changed'] = True
+				return
+
+	def publish_config_changes(session):
+		if session.info.pop('config_changed', False):
+			root.config_changed()
+
+	event.listen(Session, 'after_flush', track_config_changes)
+	event.listen(Session, 'after_commit', publish_config_changes)
 	dbfile = "%s/data.db"%PROJECT_PATH
 
 	if not os.path.exists(dbfile):
 		open(dbfile, 'w+').close()
 
+	# the pragmas of the database layer (WAL etc.) are set for these connections as well
 	sqlalchemy_plugin = SQLAlchemyPlugin(
 		cherrypy.engine, objects.Base, 'sqlite:///%s' % (dbfile),
-		echo=False
+		connect_args=database.SQLITE_CONNECT_ARGS, echo=False
 	)
 	sqlalchemy_plugin.subscribe()
 	sqlalchemy_plugin.create()
+	migrations.migrate(sqlalchemy_plugin.sa_engine)
 
 	cherrypy.engine.start()
 	cherrypy.engine.block()
@@ -14,6 +14,7 @@ import zipfile
 from tools.db import objects
 from tools import config
 from tools import utils
+from tools.alarmindex import AlarmIndex
 
 
 
@@ -22,6 +23,7 @@ class AlarmDataPage():
 	
 	def __init__(self):
 		self.datapath = "/var/tmp/secpi/alarms"
+		self.alarm_index = AlarmIndex(self.datapath)
 		self.suffixes = ['B', 'KB', 'MB', 'GB', 'TB', 'PB']
 		
 	@property
@@ -44,6 +46,8 @@ class AlarmDataPage():
 
 
 	def human_size(self, nbytes):
+		if nbytes <= 0:
+			return '0 B'
 		rank = int((math.log10(nbytes)) / 3)
 		rank = min(rank, len(self.suffixes) - 1)
 		human = nbytes / (1024.0 ** rank)
@@ -56,31 +60,56 @@ class AlarmDataPage():
 	@cherrypy.tools.json_out(handler=utils.json_handler)
 	def list(self):
 		dirs = []
-		# TODO: error management
-		for d in listdir(self.datapath):
-			dp = path.join(self.datapath, d)
-			if path.isdir(dp):
-				dirs.append({
-					"name": d,
-					"path": dp,
-					"mtime": datetime.datetime.fromtimestamp(path.getmtime(dp)).strftime('%d.%m.%Y %H:%M:%S')
-					# "size": path.getsize(dp),
-					# "hsize": self.human_size(self.get_size(dp))
-				})
+		try:
+			alarms = self.alarm_index.list() # newest first
+		except Exception as e:
+			return {'status': 'error', 'message': "Couldn't read alarm index! %s"%e}
 		
-		dirs.sort(key=lambda dir: dir['name'], reverse=True)
+		for d, entry in alarms:
+			dirs.append({
+				"name": d,
+				"path": path.join(self.datapath, d),
+				"mtime": datetime.datetime.fromtimestamp(entry['created']).strftime('%d.%m.%Y %H:%M:%S'),
+				"size": entry['size'],
+				"hsize": self.human_size(entry['size'])
+			})
 		
 		return {'status': 'success', 'data': dirs}
 		
+	# state of the retention of the manager, which deletes the data of old alarms
+	@cherrypy.expose
+	@cherrypy.tools.json_in()
+	@cherrypy.tools.json_out(handler=utils.json_handler)
+	def retention(self):
+		try:
+			state = self.alarm_index.get_meta("retention")
+			total = self.alarm_index.total_size()
+		except Exception as e:
+			return {'status': 'error', 'message': "Couldn't read alarm index! %s"%e}
+		
+		if state is None:
+			return {'status': 'success', 'data': {'active': False, 'total_bytes': total, 'htotal': self.human_size(total)}}
+		
+		state['active'] = True
+		state['total_bytes'] = total # the index is more recent than the last run of the retention
+		state['htotal'] = self.human_size(total)
+		state['hmax_bytes'] = self.human_size(state['max_bytes']) if state['max_bytes'] > 0 else None
+		state['hdeleted_bytes'] = self.human_size(state['deleted_bytes'])
+		state['last_run'] = datetime.datetime.fromtimestamp(state['last_run']).strftime('%d.%m.%Y %H:%M:%S')
+		return {'status': 'success', 'data': state}
+	
 	@cherrypy.expose
 	@cherrypy.tools.json_in()
 	@cherrypy.tools.json_out(handler=utils.json_handler)
 	def listFiles(self):
 		if(hasattr(cherrypy.request, 'json')):
 			if('folder' in cherrypy.request.json and cherrypy.request.json['folder']!=''):
-				fp = path.join(self.datapath, cherrypy.request.json['folder'])
+				folder = cherrypy.request.json['folder']
 				try:
-					files = [f for f in listdir(fp) if path.isfile(path.join(fp, f))]
+					entry = self.alarm_index.get(folder)
+					if entry is None:
+						return {'status': 'error', 'message': "Unknown folder!"}
+					files = sorted(entry['files'])
 					return {'status': 'success', 'data': files}
 				except Exception as e:
 					return {'status': 'error', 'message': "Couldn't list files! %s"%e}
@@ -127,6 +156,10 @@ class AlarmDataPage():
 				if(path.exists(fp)):
 					with zipfile.ZipFile(fp, "r") as z:
 						z.extractall(fdir)
+						# extracted files count towards the size of the alarm
+						for member in z.namelist():
+							if path.isfile(path.join(fdir, member)):
+								self.alarm_index.add_file(dir, path.join(fdir, member))
 						return {'status': 'success', 'message': "File %s/%s extracted!"%(dir, name)}
 				else:
 					return {'status': 'error', 'message': "File doesn't exist!"}
@@ -52,7 +52,8 @@ app.service('HTTPService', ['$http', 'FlashService', function($http, FlashServic
 				// success
 				if(response.data['status'] == 'success'){
 					if(typeof success_func !== 'undefined'){
-						success_func(response.data['data'], response.data['message']);
+						// the whole response is passed as well, e.g. for the total of a paginated list
+						success_func(response.data['data'], response.data['message'], response.data);
 					}
 				}
 				else{
@@ -99,6 +100,12 @@ app.controller('FlashController', ['FlashService', '$timeout', function(FlashSer
 	}
 }])
 
+// converts a sort attribute like "logtime desc" to the parameters of a list request
+function sortParams(sort){
+	var parts = sort.split(" ");
+	return {"order": parts[0], "desc": (parts.length > 1 && parts[1].toLowerCase() == "desc")};
+}
+
 function DataModalController($uibModalInstance, dataCtrl){
 	var self = this;
 	self.dataCtrl = dataCtrl;
@@ -114,10 +121,10 @@ app.controller('DataController', ['$uibModal', '$http', '$log', '$scope', '$time
 	self.basetitle = $attrs.basetitle;
 	
 	if ($attrs.queryfilter){
-		self.query_filter = $attrs.queryfilter;
+		self.query_filter = angular.fromJson($attrs.queryfilter); // list of conditions {field, op, value}
 	}
 	if ($attrs.querysort){
-		self.query_sort = $attrs.querysort;
+		self.query_sort = $attrs.querysort; // "<field> [asc|desc]"
 	}
 	
 	self.dialogTitle = "Edit";
@@ -132,9 +139,14 @@ app.controller('DataController', ['$uibModal', '$http', '$log', '$scope', '$time
 	
 	self.loading = true;
 	
+	// the list is loaded page by page
+	self.page_size = 50;
+	self.offset = 0;
+	self.total = 0;
+	
 	
 	self.edit_active = true;
-	HTTPService.post('/setups/list', {"filter":"active_state==1"},
+	HTTPService.post('/setups/list', {"filter":[{"field":"active_state", "op":"==", "value":true}], "limit":1},
 		function(data, msg){
 			// FlashService.flash("got data: "+ angular.toJson(data), FlashService.TYPE_INFO);
 			if(data.length > 0){ // we got an active setup, disable edit
@@ -171,20 +183,28 @@ app.controller('DataController', ['$uibModal', '$http', '$log', '$scope', '$time
 	}
 	
 	
-	self.getList = function(){
-		self.loading = true;
-		$log.log('fetching list')
+	self.listParams = function(){
 		var list_data = {}
 		if(self.query_filter){
 			list_data["filter"] = self.query_filter
 		}
 		if(self.query_sort){
-			list_data["sort"] = self.query_sort
+			angular.extend(list_data, sortParams(self.query_sort));
 		}
+		return list_data;
+	}
+	
+	self.getList = function(){
+		self.loading = true;
+		$log.log('fetching list')
+		var list_data = self.listParams();
+		list_data["limit"] = self.page_size;
+		list_data["offset"] = self.offset;
 		
 		HTTPService.post('/'+self.baseclass+'/list', list_data,
-			function(data, msg){
+			function(data, msg, response){
 				self.data = data;
+				self.total = response['total'];
 				self.loading = false;
 			},
 			function(){
@@ -193,6 +213,28 @@ app.controller('DataController', ['$uibModal', '$http', '$log', '$scope', '$time
 		);
 	};
 	
+	self.nextPage = function(){
+		if(self.hasNextPage()){
+			self.offset += self.page_size;
+			self.getList();
+		}
+	}
+	
+	self.prevPage = function(){
+		if(self.offset > 0){
+			self.offset = Math.max(0, self.offset - self.page_size);
+			self.getList();
+		}
+	}
+	
+	self.hasNextPage = function(){
+		return self.offset + self.page_size < self.total;
+	}
+	
+	self.pageEnd = function(){
+		return Math.min(self.offset + self.data.length, self.total);
+	}
+	
 	self.showEdit = function(id){
 		self.dialogTitle = "Edit";
 		self.form_fields = self.getFields('update')
@@ -296,6 +338,7 @@ app.controller('DataController', ['$uibModal', '$http', '$log', '$scope', '$time
 			function(data, msg){
 				FlashService.flash(msg, FlashService.TYPE_INFO)
 				self.data.splice(self.delNo, 1);
+				self.total--;
 				self.dialog.close("Canceled delete!")
 				self.loading = false;
 			},
@@ -353,16 +396,23 @@ app.controller('DataController', ['$uibModal', '$http', '$log', '$scope', '$time
 	}
 	
 	self.exportTable = function(){
+		// the table only holds the current page, so all objects are fetched for the export
+		HTTPService.post('/'+self.baseclass+'/list', self.listParams(),
+			function(data, msg){
+				self.showExport(data);
+			}
+		);
+	}
+	
+	self.showExport = function(objects){
 		expdata = []
-		for(var i=0;i<self.data.length;i++){
+		for(var i=0;i<objects.length;i++){
 			expdata.push({
 				type: self.baseclass,
-				data: self.data[i]
+				data: objects[i]
 			})
 		}
 		
-			
-		
 		self.export_data = angular.toJson(expdata, true);
 		self.dialog = $uibModal.open({
 			templateUrl: '/static/html/export.html',
@@ -453,10 +503,17 @@ app.controller('AckController', ['$http', '$log', '$interval', '$attrs', 'FlashS
 	
 	
 	self.entries = [];
+	self.limit = 50; // only the newest entries are shown
+	self.total = 0;
 	
 	self.fetchData = function(){
-		HTTPService.post('/' +self.ackclass +'s/list', {"filter":"ack==0", "sort": self.sort},
-			function(data, msg){
+		var list_data = {"filter":[{"field":"ack", "op":"==", "value":false}], "limit": self.limit};
+		if(self.sort){
+			angular.extend(list_data, sortParams(self.sort));
+		}
+		HTTPService.post('/' +self.ackclass +'s/list', list_data,
+			function(data, msg, response){
+				self.total = response['total'];
 				if(angular.toJson(data) != angular.toJson(self.entries)){
 					self.entries = data;
 				}
@@ -469,6 +526,7 @@ app.controller('AckController', ['$http', '$log', '$interval', '$attrs', 'FlashS
 			function(data, msg){
 				FlashService.flash(msg, FlashService.TYPE_INFO);
 				self.entries.splice(ent_id, 1);
+				self.total--;
 			}
 		);
 	}
@@ -527,11 +585,11 @@ app.controller('ActivateController', ['$http', '$log', '$interval', 'FlashServic
 	self.active_setups = [];
 	
 	self.fetch_active = function(){
-		HTTPService.post('/setups/list', {"filter":"active_state==1"}, function(data, msg){self.active_setups = data})
+		HTTPService.post('/setups/list', {"filter":[{"field":"active_state", "op":"==", "value":true}]}, function(data, msg){self.active_setups = data})
 	}
 	
 	self.fetch_inactive = function(){
-		HTTPService.post('/setups/list', {"filter":"active_state==0"}, function(data, msg){self.inactive_setups = data})
+		HTTPService.post('/setups/list', {"filter":[{"field":"active_state", "op":"==", "value":false}]}, function(data, msg){self.inactive_setups = data})
 	}
 	
 	self.activate = function(){
@@ -596,7 +654,7 @@ app.controller('RelationshipController', ['$log', '$timeout', '$attrs', '$uibMod
 	
 	
 	self.edit_active = true;
-	HTTPService.post('/setups/list', {"filter":"active_state==1"},
+	HTTPService.post('/setups/list', {"filter":[{"field":"active_state", "op":"==", "value":true}], "limit":1},
 		function(data, msg){
 			// FlashService.flash("got data: "+ angular.toJson(data), FlashService.TYPE_INFO);
 			if(data.length > 0){ // we got an active setup, disable edit
@@ -742,6 +800,7 @@ app.controller('AlarmDataController', ['$log', '$timeout', '$uibModal', 'FlashSe
 	self.cur_folder = null;
 	self.files = null;
 	self.img = null;
+	self.retention = null;
 	
 	self.showFolder = function(id){
 		self.cur_folder = self.folders[id]
@@ -770,6 +829,15 @@ app.controller('AlarmDataController', ['$log', '$timeout', '$uibModal', 'FlashSe
 				self.folders = data;
 			}
 		);
+		self.fetchRetention();
+	}
+	
+	self.fetchRetention = function(){
+		HTTPService.post('/alarmdata/retention', {},
+			function(data,msg){
+				self.retention = data;
+			}
+		);
 	}
 	
 	self.fetchFiles = function(folder){
@@ -811,14 +879,15 @@ app.controller('NavController', ['$uibModal', '$log', '$scope', '$interval', 'Fl
 	
 	self.fetchCount = function(){
 		self.unread_count = 0;
-		HTTPService.post('/alarms/list', {"filter":"ack==0"},
-			function(data, msg){
-				self.unread_count += data.length;
+		// only the number of entries is needed
+		HTTPService.post('/alarms/list', {"filter":[{"field":"ack", "op":"==", "value":false}], "limit":0},
+			function(data, msg, response){
+				self.unread_count += response['total'];
 			}
 		);
-		HTTPService.post('/logs/list', {"filter":"ack==0"},
-			function(data, msg){
-				self.unread_count += data.length;
+		HTTPService.post('/logs/list', {"filter":[{"field":"ack", "op":"==", "value":false}], "limit":0},
+			function(data, msg, response){
+				self.unread_count += response['total'];
 			}
 		);
 	}
@@ -4,17 +4,28 @@
 
 <div ng-controller="AlarmDataController as dataCtrl">
 	<input type="button" value="fetch" class="btn btn-success" ng-click="dataCtrl.fetchFolders()" />
+	<div id="retention" ng-show="dataCtrl.retention">
+		<span>Used: {{dataCtrl.retention.htotal}}<span ng-show="dataCtrl.retention.hmax_bytes"> of {{dataCtrl.retention.hmax_bytes}}</span></span>
+		<span ng-show="dataCtrl.retention.active">
+			| Keeping the last {{dataCtrl.retention.keep_last}} alarms<span ng-show="dataCtrl.retention.max_age"> and alarms of the last {{dataCtrl.retention.max_age}} days</span><span ng-show="dataCtrl.retention.pin_acked">, {{dataCtrl.retention.pinned}} acknowledged alarms pinned</span>
+			| Deleted {{dataCtrl.retention.deleted_alarms}} alarms ({{dataCtrl.retention.hdeleted_bytes}}) since the manager started
+			| Last run: {{dataCtrl.retention.last_run}}
+		</span>
+		<span ng-hide="dataCtrl.retention.active">| Retention hasn't run yet</span>
+	</div>
 	<table id="alarmdata" class="table table-striped">
 		<thead>
 			<tr>
 				<th>Name</th>
 				<th>Time</th>
+				<th>Size</th>
 			</tr>
 		</thead>
 		<tbody>
 			<tr ng-repeat="f in dataCtrl.folders">
 				<td class="data_click" ng-click="dataCtrl.showFolder($index)">{{f.name}}</td>
 				<td>{{f.mtime}}</td>
+				<td>{{f.hsize}}</td>
 			</tr>
 		</tbody>
 	</table>
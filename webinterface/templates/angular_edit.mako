@@ -1,7 +1,8 @@
-<%page args="baseclass,basetitle,query_filter='',query_sort=''" />
+<%page args="baseclass,basetitle,query_filter=None,query_sort=''" />
+<%! import json %>
 
 
-<div ng-controller="DataController as dataCtrl" baseclass="${baseclass}" basetitle="${basetitle}" queryfilter="${query_filter}", querysort="${query_sort}">
+<div ng-controller="DataController as dataCtrl" baseclass="${baseclass}" basetitle="${basetitle}" queryfilter="${(json.dumps(query_filter) if query_filter else '') | h}", querysort="${query_sort}">
 	
 	## <pre>
 	## {{dataCtrl.baseclass}}
@@ -33,4 +34,9 @@
 			</tr>
 		</tbody>
 	</table>
+	<div class="pager" ng-show="dataCtrl.total > dataCtrl.page_size">
+		<input type="button" value="&lt;" class="btn btn-default" ng-click="dataCtrl.prevPage()" ng-disabled="dataCtrl.offset == 0" />
+		{{dataCtrl.offset + 1}} - {{dataCtrl.pageEnd()}} of {{dataCtrl.total}}
+		<input type="button" value="&gt;" class="btn btn-default" ng-click="dataCtrl.nextPage()" ng-disabled="!dataCtrl.hasNextPage()" />
+	</div>
 </div>
@@ -25,6 +25,7 @@
 	<div ng-controller="AckController as alarmCtrl" ackclass="alarm" sort="alarmtime desc">
 		<input type="button" value="stop refresh" class="btn btn-success" id="refresh_toggle_alarm" name="refresh_toggle_alarm" ng-click="alarmCtrl.toggleRefresh()" />
 		<input type="button" value="acknowledge all" class="btn btn-success" id="ack_alarm" name="ack_alarm" ng-click="alarmCtrl.ackAll()" />
+		<span ng-show="alarmCtrl.total > alarmCtrl.entries.length">Showing the newest {{alarmCtrl.entries.length}} of {{alarmCtrl.total}} unacknowledged alarms</span>
 		<div class="alarm_entry" ng-repeat="alarm in alarmCtrl.entries" ng-show="alarm.message != null">
 			<b>{{alarm.alarmtime | date:'dd. MMM. yyyy, HH:mm:ss'}} <i>{{alarm.sensor_id}}:</i></b> {{alarm.message}}
 			<span class="alarm_ack"><img src="/static/img/icons/ack.png" title="acknowledge" ng-click="alarmCtrl.ack($index)" /></span>
@@ -37,6 +38,7 @@
 	<div ng-controller="AckController as logCtrl" ackclass="log" sort="logtime desc">
 		<input type="button" value="stop refresh" class="btn btn-success" id="refresh_toggle_log" name="refresh_toggle_log" ng-click="logCtrl.toggleRefresh()" />
 		<input type="button" value="acknowledge all" class="btn btn-success" id="ack_log" name="ack_log" ng-click="logCtrl.ackAll()" />
+		<span ng-show="logCtrl.total > logCtrl.entries.length">Showing the newest {{logCtrl.entries.length}} of {{logCtrl.total}} unacknowledged log messages</span>
 		<div class="log_entry" ng-repeat="log in logCtrl.entries" ng-show="log.message != null" ng-class="'lvl'+log.level">
 			<b>{{log.logtime | date:'dd. MMM. yyyy, HH:mm:ss'}} <i>{{log.sender}}:</i></b> {{log.message}}
 			<span class="log_ack"><img src="/static/img/icons/ack.png" title="acknowledge" ng-click="logCtrl.ack($index)" /></span>
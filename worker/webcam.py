@@ -42,7 +42,9 @@ class Webcam(Action):
 		try:
 			for i in range(0,num_of_pic):
 				img = self.cam.get_image()
-				pygame.image.save(img, "%s/%s_%d.jpg" % (self.data_path, time.strftime("%Y%m%d_%H%M%S"), i))
+				img_path = "%s/%s_%d.jpg" % (self.data_path, time.strftime("%Y%m%d_%H%M%S"), i)
+				pygame.image.save(img, img_path)
+				self.publish_artifact(img_path)
 				time.sleep(seconds_between)
 		except Exception as e:
 			logging.error("Webcam: Wasn't able to take pictures: %s" % e)
@@ -23,7 +23,18 @@ import threading
 import time
 import uuid
 
+from multiprocessing.pool import ThreadPool
+
+try:
+	import queue
+except ImportError: # python 2
+	import Queue as queue
+
+from tools import amqp
 from tools import config
+from tools import outbox
+from tools import publisher
+from tools import transfer
 from tools import utils
 
 class Worker:
@@ -34,7 +45,18 @@ class Worker:
 		self.active = False
 		self.data_directory = "/var/tmp/secpi/worker_data"
 		self.zip_directory = "/var/tmp/secpi"
-		self.message_queue = [] # stores messages which couldn't be sent
+		self.spool_directory = "/var/tmp/secpi/worker_spool" # data of offline alarms which wasn't sent yet
+		self.action_lock = threading.Lock() # the actions share the data directory, only one alarm at a time
+		self.offline_lock = threading.Lock()
+		self.offline_alarm_id = None # offline alarm whose actions are running
+		self.publisher = None # only used if confirm_delivery is enabled in the config
+		self.amqp = None
+		self.connection = None
+		self.outgoing = queue.Queue() # messages which are published by the event loop, pika isn't thread safe
+		self.spool_checked = 0 # when the spool directory was checked for data of offline alarms
+		self.config_lock = threading.Lock()
+		self.pending_config = None # latest config from the manager which wasn't applied yet
+		self.startup_timings = [] # (phase, duration)
 		
 		try:
 			logging.config.fileConfig(os.path.join(PROJECT_PATH, 'logging.conf'), defaults={'logfilename': 'worker.log'})
@@ -42,6 +64,8 @@ class Worker:
 			print("Error while trying to load config file for logging")
 
 		logging.info("Initializing worker")
+		start = time.time()
+		phase = start
 
 		try:
 			config.load(PROJECT_PATH +"/worker/config.json")
@@ -49,72 +73,93 @@ class Worker:
 		except ValueError: # Config file can't be loaded, e.g. no valid JSON
 			logging.error("Wasn't able to load config file, exiting...")
 			quit()
-		
-		time.sleep(60) # TEMPORARY FIX for #83
+		phase = self.startup_phase("config", phase)
 
 		self.prepare_data_directory(self.data_directory)
-		self.connect()
+		self.prepare_data_directory(self.spool_directory)
+		self.setup_outbox()
+		phase = self.startup_phase("outbox", phase)
 		
 		# if we don't have a pi id we need to request the initial config, afterwards we have to reconnect
 		# to the queues which are specific to the pi id -> hence, call connect again
 		if not config.get('pi_id'):
+			self.connect()
+			phase = self.startup_phase("connect", phase)
 			logging.debug("No Pi ID found, will request initial configuration...")
 			self.fetch_init_config()
 		else:
+			# arm with the cached config before connecting, alarms are stored in the outbox until we're connected
 			logging.info("Setting up sensors and actions")
 			self.active = config.get('active')
+			self.setup_actions() # before the sensors, an alarm right after arming executes them
+			phase = self.startup_phase("actions", phase)
 			self.setup_sensors()
-			self.setup_actions()
+			phase = self.startup_phase("sensors", phase)
 			logging.info("Setup done!")
+
+			self.connect()
+			phase = self.startup_phase("connect", phase)
+			self.clear_message_queue() # alarms since the start and messages which couldn't be sent before the last shutdown
+			phase = self.startup_phase("replay", phase)
+
+		logging.info("Startup took %.2fs: %s" % (time.time() - start, ", ".join("%s %.2fs" % timing for timing in self.startup_timings)))
+	
+	# records how long a phase of the startup took, returns the start of the next phase
+	def startup_phase(self, name, start):
+		now = time.time()
+		self.startup_timings.append((name, now - start))
+		return now
+
+	# runs func for every item in parallel, e.g. to initialize plugins which wait for hardware, keeps the order
+	def run_parallel(self, func, items):
+		if len(items) < 2:
+			return [func(item) for item in items]
+		pool = ThreadPool(min(len(items), 8))
+		try:
+			return pool.map(func, items)
+		finally:
+			pool.close()
 	
+	# the queues depend on the mode: without a pi id we only wait for the initial config
+	def setup_topology(self):
+		self.topology = amqp.Topology(utils.EXCHANGE)
+		self.topology_pi_id = config.get('pi_id')
+
+		if not self.topology_pi_id: # INIT CONFIG MODE
+			self.topology.add_queue(utils.QUEUE_INIT_CONFIG, bind=False)
+		else: # OPERATIVE MODE
+			#declare all the queues
+			self.topology.add_queue(utils.QUEUE_ACTION+str(self.topology_pi_id), bind=False)
+			self.topology.add_queue(utils.QUEUE_CONFIG+str(self.topology_pi_id), bind=False)
+			self.topology.add_queue(utils.QUEUE_DATA, bind=False)
+			self.topology.add_queue(utils.QUEUE_ALARM, bind=False)
+			self.topology.add_queue(utils.QUEUE_LOG, bind=False)
+
+			#specify the queues we want to listen to, including the callback
+			self.topology.add_consumer(utils.QUEUE_ACTION+str(self.topology_pi_id), self.got_action)
+			self.topology.add_consumer(utils.QUEUE_CONFIG+str(self.topology_pi_id), self.got_config)
+
+		self.amqp = amqp.Connection(PROJECT_PATH, self.topology)
+
 	def connect(self):
 		logging.debug("Initalizing network connection")
-		credentials = pika.PlainCredentials(config.get('rabbitmq')['user'], config.get('rabbitmq')['password'])
-		parameters = pika.ConnectionParameters(credentials=credentials,
-			host=config.get('rabbitmq')['master_ip'],
-			port=5671,
-			ssl=True,
-			socket_timeout=10,
-			ssl_options = { 
-				"ca_certs":PROJECT_PATH+"/certs/"+config.get('rabbitmq')['cacert'],
-				"certfile":PROJECT_PATH+"/certs/"+config.get('rabbitmq')['certfile'],
-				"keyfile":PROJECT_PATH+"/certs/"+config.get('rabbitmq')['keyfile']
-			}
-		)
-
-		connected = False
-		while not connected: #retry if establishing a connection fails
-			try:
-				logging.info("Trying to establish a connection to the manager")
-				self.connection = pika.BlockingConnection(parameters=parameters) 
-				self.channel = self.connection.channel()
-				connected = True
-				logging.info("Connection to manager established")
-			except pika.exceptions.AMQPConnectionError as pe: # if connection can't be established
-				logging.error("Wasn't able to open a connection to the manager: %s" % pe)
-				time.sleep(30)
-
-		self.channel.exchange_declare(exchange=utils.EXCHANGE, exchange_type='direct')
-
-		# INIT CONFIG MODE
-		if not config.get('pi_id'): # when we have no pi id we only have to define the initial config setup
-			# init config queue
+		if self.amqp is None or self.topology_pi_id != config.get('pi_id'):
+			self.setup_topology()
+
+		logging.info("Trying to establish a connection to the manager")
+		self.amqp.connect()
+		self.connection = self.amqp.connection
+		self.channel = self.amqp.channel
+		logging.info("Connection to manager established")
+
+		# INIT CONFIG MODE, the callback queue gets a new name on every connection
+		if not config.get('pi_id'):
 			result = self.channel.queue_declare(exclusive=True)
 			self.callback_queue = result.method.queue
 			self.channel.queue_bind(exchange=utils.EXCHANGE, queue=self.callback_queue)
-			self.channel.queue_declare(queue=utils.QUEUE_INIT_CONFIG)
 			self.channel.basic_consume(self.got_init_config, queue=self.callback_queue, no_ack=True)
-		else: # only connect to the other queues when we got the initial configuration, OPERATIVE MODE
-			#declare all the queues
-			self.channel.queue_declare(queue=utils.QUEUE_ACTION+str(config.get('pi_id')))
-			self.channel.queue_declare(queue=utils.QUEUE_CONFIG+str(config.get('pi_id')))
-			self.channel.queue_declare(queue=utils.QUEUE_DATA)
-			self.channel.queue_declare(queue=utils.QUEUE_ALARM)
-			self.channel.queue_declare(queue=utils.QUEUE_LOG)
 
-			#specify the queues we want to listen to, including the callback
-			self.channel.basic_consume(self.got_action, queue=utils.QUEUE_ACTION+str(config.get('pi_id')), no_ack=True)
-			self.channel.basic_consume(self.got_config, queue=utils.QUEUE_CONFIG+str(config.get('pi_id')), no_ack=True)
+		self.setup_publisher()
 
 	
 	def start(self):
@@ -122,88 +167,153 @@ class Worker:
 		while disconnected:
 			try:
 				disconnected = False
-				self.channel.start_consuming() # blocking call
-			except pika.exceptions.ConnectionClosed: # when connection is lost, e.g. rabbitmq not running
+				# event loop, the only place where the connection is serviced: receive deliveries, publish the
+				# queued messages, send the data of offline alarms
+				while True:
+					self.connection.process_data_events(time_limit=0.05)
+					self.publish_outgoing()
+					self.check_spool()
+			except (pika.exceptions.ConnectionClosed, pika.exceptions.ChannelClosed): # when connection is lost, e.g. rabbitmq not running
 				logging.error("Lost connection to rabbitmq service on manager")
 				disconnected = True
-				time.sleep(10) # reconnect timer
+				self.publish_outgoing() # the queued messages go to the outbox, so they survive a restart while reconnecting
 				logging.info("Trying to reconnect...")
 				self.connect()
 				self.clear_message_queue() #could this make problems if the manager replies too fast?
 	
+	# with publisher confirms a message only counts as sent when the broker confirmed it,
+	# messages which weren't confirmed are stored in the outbox
+	def setup_publisher(self):
+		if self.publisher:
+			unconfirmed = self.publisher.reset()
+			if unconfirmed:
+				logging.warning("%d messages weren't confirmed before the connection was lost, added them to outbox" % unconfirmed)
+			self.publisher = None
+
+		if not config.get('confirm_delivery'):
+			return
+
+		try:
+			max_in_flight = int(config.get('confirm_max_in_flight', 256))
+		except ValueError:
+			max_in_flight = 256
+			logging.error("Invalid confirm_max_in_flight in config, using %d" % max_in_flight)
+
+		try:
+			self.publisher = publisher.ConfirmPublisher(self.connection, self.channel, utils.EXCHANGE, max_in_flight=max_in_flight, on_failed=self.store_unconfirmed_msg)
+			self.connection.add_timeout(5, self.check_publisher)
+			logging.info("Publisher confirms enabled")
+		except pika.exceptions.AMQPError as e:
+			logging.error("Wasn't able to enable publisher confirms, sending without: %s" % e)
+			self.publisher = None
+
+	# publishes nacked and timed out messages again while we're only consuming
+	def check_publisher(self):
+		if not self.publisher:
+			return
+		self.publisher.check_retries()
+		if self.publisher.in_flight():
+			logging.debug("Publisher: %s" % self.publisher.stats())
+		self.connection.add_timeout(5, self.check_publisher)
+
+	def store_unconfirmed_msg(self, rk, body, properties):
+		self.outbox.add(rk, body, self.properties_to_dict(properties))
+
 	def __del__(self):
 		try:
 			self.connection.close()
 		except AttributeError: #If there is no connection object closing won't work
 			logging.info("No connection cleanup possible")
 
-	# sends a message to the manager
+	# sends a message to the manager, if that's not possible it's stored in the outbox and sent after reconnecting,
+	# it is safe to call it from any thread, also from the callbacks of the connection, the event loop publishes it
 	def send_msg(self, rk, body, **kwargs):
-		if self.connection.is_open:
+		properties = kwargs.get("properties") or pika.BasicProperties()
+		if properties.message_id is None: # the outbox recognizes the message by it if it has to store it again
+			properties.message_id = uuid.uuid4().hex
+		kwargs["properties"] = properties
+
+		if self.connection and self.connection.is_open:
+			self.outgoing.put((rk, body, kwargs))
+			logging.debug("Queued message for %s" % rk)
+			return True
+		return self.publish_msg(rk, body, **kwargs)
+
+	# publishes a message or stores it in the outbox if that's not possible, must only be called by the event loop
+	def publish_msg(self, rk, body, **kwargs):
+		if self.connection and self.connection.is_open:
 			try:
 				logging.debug("Sending message to manager")
-				self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=rk, body=body, **kwargs)
+				if self.publisher:
+					self.publisher.publish(rk, body, kwargs.get("properties"))
+				else:
+					self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=rk, body=body, **kwargs)
 				return True
 			except Exception as e:
 				logging.exception("Error while sending data to queue:\n%s" % e)
-				return False
 		else:
 			logging.error("Can't send message to manager")
-			message = {"rk":rk, "body": body, "kwargs": kwargs, "json": False}
-			if message not in self.message_queue: # could happen if we have another disconnect when we try to clear the message queue
-				self.message_queue.append(message)
-				logging.info("Added message to message queue")
-			else:
-				logging.debug("Message already in queue")
 
-			return False
+		if self.outbox.add(rk, body, self.properties_to_dict(kwargs.get("properties"))):
+			logging.info("Added message to outbox")
+		return False
 	
+	# publishes the queued messages, must only be called by the event loop
+	def publish_outgoing(self):
+		while True:
+			try:
+				rk, body, kwargs = self.outgoing.get_nowait()
+			except queue.Empty:
+				return
+			self.publish_msg(rk, body, **kwargs)
+
 	# sends a message to the manager
 	def send_json_msg(self, rk, body, **kwargs):
-		if self.connection.is_open:
-			try:
-				logging.debug("Sending message to manager")
-				properties = pika.BasicProperties(content_type='application/json')
-				self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=rk, body=json.dumps(body), properties=properties, **kwargs)
-				return True
-			except Exception as e:
-				logging.exception("Error while sending data to queue:\n%s" % e)
-				return False
-		else:
-			logging.error("Can't send message to manager")
-			message = {"rk":rk, "body": body, "kwargs": kwargs, "json": True}
-			if message not in self.message_queue: # could happen if we have another disconnect when we try to clear the message queue
-				self.message_queue.append(message)
-				logging.info("Added message to message queue")
+		properties = pika.BasicProperties(content_type='application/json')
+		return self.send_msg(rk, json.dumps(body), properties=properties, **kwargs)
+	
+	# only these properties are stored in the outbox, they have to be serializable to JSON
+	def properties_to_dict(self, properties):
+		if properties is None:
+			return {}
+		result = {}
+		for name in ("content_type", "correlation_id", "reply_to", "headers", "message_id"):
+			value = getattr(properties, name)
+			if value is not None:
+				result[name] = value
+		return result
+	
+	# sends a message from the outbox or the spool directory, it mustn't be added to the outbox again if it fails
+	def send_stored_msg(self, rk, body, properties):
+		if not (self.connection and self.connection.is_open):
+			return False
+		try:
+			if self.publisher:
+				self.publisher.publish(rk, body, pika.BasicProperties(**properties))
 			else:
-				logging.debug("Message already in queue")
-
+				self.channel.basic_publish(exchange=utils.EXCHANGE, routing_key=rk, body=body, properties=pika.BasicProperties(**properties))
+			return True
+		except Exception as e:
+			logging.exception("Error while sending stored message:\n%s" % e)
 			return False
 	
-	# Try to resend the messages which couldn't be sent before
+	# Try to resend the messages which couldn't be sent before, alarms first
 	def clear_message_queue(self):
-		logging.info("Trying to clear message queue")
+		logging.info("Trying to clear outbox")
 
-		if not self.message_queue: # queue is already empty
-			logging.info("Message queue was empty, nothing to clear")
-			return
+		if not len(self.outbox): # outbox is already empty
+			logging.info("Outbox was empty, nothing to clear")
+		else:
+			self.outbox.replay(self.send_stored_msg)
+			if self.publisher and not self.publisher.flush():
+				logging.warning("Not all messages from outbox were confirmed yet: %s" % self.publisher.stats())
 
-		for message in self.message_queue:
-			if(message["json"]):
-				if self.send_json_msg(message["rk"], message["body"], **message["kwargs"]): # if message was sent successfully
-					self.message_queue.remove(message)
-				else:
-					logging.info("Message from queue couldn't be sent")
+			if not len(self.outbox):
+				logging.info("Outbox cleared")
 			else:
-				if self.send_msg(message["rk"], message["body"], **message["kwargs"]): # if message was sent successfully
-					self.message_queue.remove(message)
-				else:
-					logging.info("Message from queue couldn't be sent")
+				logging.error("Outbox couldn't be cleared completely, %d messages left" % len(self.outbox))
 
-		if not self.message_queue: # message queue is empty
-			logging.info("Message queue cleared")
-		else:
-			logging.error("Message queue couldn't be cleared completely")
+		self.upload_spool() # the data of offline alarms after their alarm messages
 	
 					
 	def post_err(self, msg):
@@ -290,80 +400,136 @@ class Worker:
 			logging.info("This config isn't meant for us")
 	
 	# Create a zip of all the files which were collected while actions were executed
-	def prepare_data(self):
+	def prepare_data(self, alarm_id, zip_directory=None):
 		try:
 			if os.listdir(self.data_directory): # check if there are any files available
-				shutil.make_archive("%s/%s" % (self.zip_directory, config.get('pi_id')), "zip", self.data_directory)
-				logging.info("Created ZIP file")
+				shutil.make_archive("%s/%s" % (zip_directory or self.zip_directory, config.get('pi_id')), "zip", self.data_directory)
+				logging.info("Created ZIP file for alarm %s" % alarm_id)
 				return True
 			else:
-				logging.info("No data to zip")
+				logging.info("No data to zip for alarm %s" % alarm_id)
 				return False
 		except OSError as oe:
-			self.post_err("Pi with id '%s' wasn't able to prepare data for manager:\n%s" % (config.get('pi_id'), oe))
+			self.post_err("Pi with id '%s' wasn't able to prepare data of alarm %s for manager:\n%s" % (config.get('pi_id'), alarm_id, oe))
 			logging.error("Wasn't able to prepare data for manager: %s" % oe)
 
 	# Remove all the data that was created during the alarm, unlink == remove
-	def cleanup_data(self):
+	def cleanup_data(self, alarm_id, remove_zip=True):
 		try:
-			os.unlink("%s/%s.zip" % (self.zip_directory, config.get('pi_id')))
+			if remove_zip:
+				os.unlink("%s/%s.zip" % (self.zip_directory, config.get('pi_id')))
 			for the_file in os.listdir(self.data_directory):
 				file_path = os.path.join(self.data_directory, the_file)
 				if os.path.isfile(file_path):
 					os.unlink(file_path)
 				elif os.path.isdir(file_path):
 					shutil.rmtree(file_path)
-			logging.info("Cleaned up files")
+			logging.info("Cleaned up files of alarm %s" % alarm_id)
 		except OSError as oe:
-			self.post_err("Pi with id '%s' wasn't able to execute cleanup:\n%s" % (config.get('pi_id'), oe))
+			self.post_err("Pi with id '%s' wasn't able to execute cleanup of alarm %s:\n%s" % (config.get('pi_id'), alarm_id, oe))
 			logging.error("Wasn't able to clean up data directory: %s" % oe)
 
 	# callback method which processes the actions which originate from the manager
 	def got_action(self, ch, method, properties, body):
 		if(self.active):
 			msg = json.loads(body)
+			alarm_id = msg.get("alarm_id")
 			late_arrival = utils.check_late_arrival(datetime.datetime.strptime(msg["datetime"], "%Y-%m-%d %H:%M:%S"))
 			
 			if late_arrival:
 				logging.info("Received old action from manager:%s" % body)
 				return # we don't have to send a message to the data queue since the timeout will be over anyway
 			
-			# http://stackoverflow.com/questions/15085348/what-is-the-use-of-join-in-python-threading
 			logging.info("Received action from manager:%s" % body)
-			threads = []
+			# the actions run on their own thread, so the event loop keeps servicing the connection
+			t = threading.Thread(name="thread-alarm-actions", target=self.run_actions, args=[alarm_id, msg.get("incremental")])
+			t.start()
+		else:
+			logging.debug("Received action but wasn't active")
+
+	# executes the actions for an alarm of the manager and sends their data
+	def run_actions(self, alarm_id, incremental):
+		# the actions might still be busy with an alarm which we handled on our own while we were offline
+		with self.offline_lock:
+			offline_alarm_id = self.offline_alarm_id
+		if offline_alarm_id:
+			logging.warning("Actions are still busy with offline alarm %s, can't execute them for alarm %s" % (offline_alarm_id, alarm_id))
+			self.send_msg(utils.QUEUE_DATA, "", properties=pika.BasicProperties(correlation_id=alarm_id))
+			return
+
+		with self.action_lock:
+			self.execute_actions(incremental, lambda path: self.send_artifact(path, alarm_id))
 			
-			for act in self.actions:
-				t = threading.Thread(name='thread-%s'%(act.id), target=act.execute)
-				threads.append(t)
-				t.start()
-		
-			# wait for threads to finish
-			for t in threads:
-				t.join()
-		
-			if self.prepare_data(): #check if there is any data to send
-				zip_file = open("%s/%s.zip" % (self.zip_directory, config.get('pi_id')), "rb")
-				byte_stream = zip_file.read()
-				self.send_msg(utils.QUEUE_DATA, byte_stream)
-				logging.info("Sent data to manager")
-				self.cleanup_data()
+				# the alarm id is used as correlation id so the manager knows which alarm the data belongs to
+			properties = pika.BasicProperties(correlation_id=alarm_id)
+			if self.prepare_data(alarm_id): #check if there is any data to send
+				self.send_file("%s/%s.zip" % (self.zip_directory, config.get('pi_id')), alarm_id)
+				logging.info("Sent data of alarm %s to manager" % alarm_id)
+				self.cleanup_data(alarm_id)
 			else:
-				logging.info("No data to send")
+				logging.info("No data to send for alarm %s" % alarm_id)
 				# Send empty message which acts like a finished
-				self.send_msg(utils.QUEUE_DATA, "")
-		else:
-			logging.debug("Received action but wasn't active")
+				self.send_msg(utils.QUEUE_DATA, "", properties=properties)
+
+	# executes all actions at the same time and hands the files they publish to handle_artifact, the action lock has to be held
+	def execute_actions(self, incremental, handle_artifact):
+		# http://stackoverflow.com/questions/15085348/what-is-the-use-of-join-in-python-threading
+		threads = []
+		artifacts = queue.Queue()
+		
+		for act in self.actions:
+			if incremental: # actions hand over their files while they are still running
+				act.artifact_callback = artifacts.put
+			t = threading.Thread(name='thread-%s'%(act.id), target=act.execute)
+			threads.append(t)
+			t.start()
+	
+		# wait for threads to finish, meanwhile handle the files they publish
+		while any(t.is_alive() for t in threads) or not artifacts.empty():
+			try:
+				artifact = artifacts.get(timeout=0.1)
+			except queue.Empty:
+				continue
+			handle_artifact(artifact)
+	
+		for act in self.actions:
+			act.artifact_callback = None
+
+	# sends a file which was published by an action during an alarm and removes it, so it won't be zipped again
+	def send_artifact(self, path, alarm_id):
+		try:
+			self.send_file(path, alarm_id, artifact=True)
+			os.unlink(path)
+			logging.info("Sent %s of alarm %s to manager" % (path, alarm_id))
+		except (IOError, OSError) as e:
+			self.post_err("Pi with id '%s' wasn't able to send %s of alarm %s:\n%s" % (config.get('pi_id'), path, alarm_id, e))
+
+	# sends a file chunk by chunk to the data queue, so it never has to be loaded into memory completely,
+	# artifacts are files which are sent while the actions are still running. Chunks which can't be sent
+	# go to the outbox, except for offline alarms: their files stay in the spool directory and are sent
+	# again completely, returns False in that case
+	def send_file(self, path, alarm_id, artifact=False, offline=False):
+		for headers, data in transfer.read_chunks(path):
+			if artifact:
+				headers["artifact"] = True
+			if offline: # data of an alarm the manager didn't know about when the actions were executed
+				headers["offline"] = True
+				if not self.send_stored_msg(utils.QUEUE_DATA, data, {"correlation_id": alarm_id, "headers": headers}):
+					return False
+				continue
+			properties = pika.BasicProperties(correlation_id=alarm_id, headers=headers)
+			self.send_msg(utils.QUEUE_DATA, data, properties=properties)
+
+		if offline and self.publisher and not self.publisher.flush(): # the chunks which aren't confirmed go to the outbox
+			return False
+		logging.debug("Sent %s in %d chunks" % (path, headers["total"]))
+		return True
 
 	def apply_config(self, new_config):
+		old_config = config.getDict()
 		# check if new config changed
-		if(new_config != config.getDict()):
-			# disable while loading config
-			self.active = False
-			
-			# TODO: deactivate queues
-			logging.info("Cleaning up actions and sensors")
-			self.cleanup_sensors()
-			self.cleanup_actions()
+		if(new_config != old_config):
+			logging.info("Applying config version %s (was %s)" % (new_config.get('version'), old_config.get('version')))
 			
 			# TODO: check valid config file?!
 			# write config to file
@@ -378,11 +544,16 @@ class Worker:
 			config.load(PROJECT_PATH +"/worker/config.json")
 			
 			if(config.get('active')):
-				logging.info("Activating actions and sensors")
-				self.setup_sensors()
-				self.setup_actions()
-				# TODO: activate queues
+				# only rebuild the sensors and actions which changed, the others stay armed
+				logging.info("Updating actions and sensors")
+				self.update_sensors(old_config.get('sensors') or [], config.get('sensors') or [])
+				self.update_actions(old_config.get('actions') or [], config.get('actions') or [])
 				self.active = True
+			else:
+				self.active = False
+				logging.info("Cleaning up actions and sensors")
+				self.cleanup_sensors()
+				self.cleanup_actions()
 			
 			logging.info("Config saved successfully...")
 		else:
@@ -395,29 +566,49 @@ class Worker:
 			new_conf = json.loads(body)
 		except Exception as e:
 			logging.exception("Wasn't able to read JSON config from manager:\n%s" % e) 
+			return
 		
 		# we don't get the rabbitmq config sent to us, so add the current one
 		new_conf["rabbitmq"] = config.get("rabbitmq")
 		
-		self.apply_config(new_conf)
+		# the actions might be running, so the config is applied on its own thread once they're done
+		self.pending_config = new_conf
+		t = threading.Thread(name="thread-config", target=self.apply_pending_config)
+		t.start()
+
+	# applies the latest config which was received, the older ones are skipped
+	def apply_pending_config(self):
+		with self.config_lock:
+			new_conf = self.pending_config
+			self.pending_config = None
+			if new_conf is None: # already applied by another thread
+				return
+			with self.action_lock:
+				self.apply_config(new_conf)
 		
 	# Initialize all the sensors for operation and add callback method
 	# TODO: check for duplicated sensors
-	def setup_sensors(self):
-		if not config.get("sensors"):
+	def setup_sensors(self, sensors=None):
+		if sensors is None:
+			sensors = config.get("sensors")
+		if not sensors:
 			logging.info("No sensors configured")
 			return
-		for sensor in config.get("sensors"):
-			try:
-				logging.info("Trying to register sensor: %s" % sensor["id"])
-				s = self.class_for_name(sensor["module"], sensor["class"])
-				sen = s(sensor["id"], sensor["params"], self)
-				sen.activate()
-			except Exception as e:
-				self.post_err("Pi with id '%s' wasn't able to register sensor '%s':\n%s" % (config.get('pi_id'), sensor["class"],e))
-			else:
+		for sen in self.run_parallel(self.create_sensor, sensors):
+			if sen:
 				self.sensors.append(sen)
-				logging.info("Registered!")
+	
+	def create_sensor(self, sensor):
+		try:
+			logging.info("Trying to register sensor: %s" % sensor["id"])
+			s = self.class_for_name(sensor["module"], sensor["class"])
+			sen = s(sensor["id"], sensor["params"], self)
+			sen.activate()
+		except Exception as e:
+			self.post_err("Pi with id '%s' wasn't able to register sensor '%s':\n%s" % (config.get('pi_id'), sensor["class"],e))
+			return None
+		logging.info("Registered sensor %s!" % sensor["id"])
+		return sen
 	
 	def cleanup_sensors(self):
 		# remove the callbacks
@@ -428,21 +619,45 @@ class Worker:
 		
 		self.sensors = []
 	
+	# deactivates sensors which were removed or changed and registers the changed and new ones
+	def update_sensors(self, old_sensors, new_sensors):
+		old = dict((sensor["id"], sensor) for sensor in old_sensors)
+		new = dict((sensor["id"], sensor) for sensor in new_sensors)
+		
+		unchanged = []
+		for sensor in self.sensors:
+			if sensor.id in new and old.get(sensor.id) == new[sensor.id]:
+				unchanged.append(sensor)
+			else:
+				sensor.deactivate()
+				logging.debug("Removed sensor: %d" % int(sensor.id))
+		
+		self.sensors = unchanged
+		unchanged_ids = set(sensor.id for sensor in unchanged)
+		self.setup_sensors([sensor for sensor in new_sensors if sensor["id"] not in unchanged_ids])
+		logging.info("Kept %d unchanged sensors armed" % len(unchanged))
+	
 	# Initialize all the actions
-	def setup_actions(self):
-		if not config.get("actions"):
+	def setup_actions(self, actions=None):
+		if actions is None:
+			actions = config.get("actions")
+		if not actions:
 			logging.info("No actions configured")
 			return
-		for action in config.get("actions"):
-			try:
-				logging.info("Trying to register action: %s" % action["id"])
-				a = self.class_for_name(action["module"], action["class"])
-				act = a(action["id"], action["params"])
-			except Exception as e: #AttributeError, KeyError
-				self.post_err("Pi with id '%s' wasn't able to register action '%s':\n%s" % (config.get('pi_id'), action["class"],e))
-			else:
+		for act in self.run_parallel(self.create_action, actions):
+			if act:
 				self.actions.append(act)
-				logging.info("Registered!")
+	
+	def create_action(self, action):
+		try:
+			logging.info("Trying to register action: %s" % action["id"])
+			a = self.class_for_name(action["module"], action["class"])
+			act = a(action["id"], action["params"])
+		except Exception as e: #AttributeError, KeyError
+			self.post_err("Pi with id '%s' wasn't able to register action '%s':\n%s" % (config.get('pi_id'), action["class"],e))
+			return None
+		logging.info("Registered action %s!" % action["id"])
+		return act
 	
 	def cleanup_actions(self):
 		for a in self.actions:
@@ -450,6 +665,23 @@ class Worker:
 			
 		self.actions = []					
 
+	# cleans up actions which were removed or changed and initializes the changed and new ones
+	def update_actions(self, old_actions, new_actions):
+		old = dict((action["id"], action) for action in old_actions)
+		new = dict((action["id"], action) for action in new_actions)
+		
+		unchanged = []
+		for action in self.actions:
+			if action.id in new and old.get(action.id) == new[action.id]:
+				unchanged.append(action)
+			else:
+				action.cleanup()
+		
+		self.actions = unchanged
+		unchanged_ids = set(action.id for action in unchanged)
+		self.setup_actions([action for action in new_actions if action["id"] not in unchanged_ids])
+		logging.info("Kept %d unchanged actions" % len(unchanged))
+
 	# callback for the sensors, sends a message with info to the manager
 	def alarm(self, sensor_id, message):
 		if(self.active):
@@ -460,8 +692,96 @@ class Worker:
 					"message": message,
 					"datetime": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 			
+			# without a connection the manager can't tell us to execute the actions, so we do it ourselves,
+			# the alarm and its data are sent after reconnecting
+			if not (self.connection and self.connection.is_open):
+				msg["alarm_id"] = self.execute_offline()
+				msg["offline"] = True
+			
 			# send a message to the alarmQ and tell which sensor signaled
 			self.send_json_msg(utils.QUEUE_ALARM, msg)
+
+	# starts the actions for an offline alarm, returns its id, further alarms while they run belong to the same alarm
+	def execute_offline(self):
+		with self.offline_lock:
+			if self.offline_alarm_id:
+				return self.offline_alarm_id
+			self.offline_alarm_id = utils.create_alarm_id()
+			t = threading.Thread(name="thread-offline-alarm", target=self.run_offline_actions, args=[self.offline_alarm_id])
+			t.start()
+			return self.offline_alarm_id
+
+	# executes the actions and stores their files in the spool directory until they can be sent
+	def run_offline_actions(self, alarm_id):
+		spool_dir = os.path.join(self.spool_directory, alarm_id)
+		try:
+			with self.action_lock:
+				logging.info("Executing actions for offline alarm %s" % alarm_id)
+				os.makedirs(spool_dir)
+				self.execute_actions(True, lambda path: self.spool_artifact(path, spool_dir))
+				if self.prepare_data(alarm_id, spool_dir):
+					self.cleanup_data(alarm_id, remove_zip=False)
+				logging.info("Stored data of offline alarm %s" % alarm_id)
+		except (IOError, OSError) as e:
+			self.post_err("Pi with id '%s' wasn't able to store data of offline alarm %s:\n%s" % (config.get('pi_id'), alarm_id, e))
+		finally:
+			with self.offline_lock:
+				self.offline_alarm_id = None
+
+	def spool_artifact(self, path, spool_dir):
+		target = os.path.join(spool_dir, os.path.basename(path))
+		if os.path.exists(target):
+			target = os.path.join(spool_dir, "%s_%s" % (uuid.uuid4().hex[:8], os.path.basename(path)))
+		try:
+			shutil.move(path, target)
+		except (IOError, OSError) as e:
+			self.post_err("Pi with id '%s' wasn't able to store %s:\n%s" % (config.get('pi_id'), path, e))
+
+	# sends the data of the offline alarms, the oldest first, must only be called by the event loop
+	# after the alarm messages were sent
+	def upload_spool(self):
+		try:
+			alarm_ids = sorted(os.listdir(self.spool_directory))
+		except OSError as oe:
+			logging.error("Wasn't able to read spool directory: %s" % oe)
+			return
+
+		for alarm_id in alarm_ids:
+			with self.offline_lock:
+				if alarm_id == self.offline_alarm_id: # actions are still running
+					continue
+
+			spool_dir = os.path.join(self.spool_directory, alarm_id)
+			final = os.path.join(spool_dir, "%s.zip" % config.get('pi_id'))
+			try:
+				for name in sorted(os.listdir(spool_dir)):
+					path = os.path.join(spool_dir, name)
+					if path == final:
+						continue
+					if not self.send_file(path, alarm_id, artifact=True, offline=True): # try again after the next reconnect
+						logging.info("Wasn't able to send %s of offline alarm %s, keeping it" % (name, alarm_id))
+						return
+					os.unlink(path)
+
+				if os.path.exists(final):
+					if not self.send_file(final, alarm_id, offline=True):
+						logging.info("Wasn't able to send data of offline alarm %s, keeping it" % alarm_id)
+						return
+					os.unlink(final)
+				else: # Send empty message which acts like a finished
+					self.send_msg(utils.QUEUE_DATA, "", properties=pika.BasicProperties(correlation_id=alarm_id, headers={"offline": True}))
+				os.rmdir(spool_dir)
+				logging.info("Sent data of offline alarm %s to manager" % alarm_id)
+			except (IOError, OSError) as e:
+				self.post_err("Pi with id '%s' wasn't able to send data of offline alarm %s:\n%s" % (config.get('pi_id'), alarm_id, e))
+
+	# offline alarms which finished while we were connected, called by the event loop, checks every 10 seconds
+	def check_spool(self):
+		if time.time() - self.spool_checked < 10:
+			return
+		self.spool_checked = time.time()
+		if os.listdir(self.spool_directory):
+			self.upload_spool()
 		
 	def prepare_data_directory(self, data_path):
 		try:
@@ -471,9 +791,17 @@ class Worker:
 		except OSError as oe:
 			self.post_err("Pi with id '%s' wasn't able to create data directory:\n%s" % (config.get('pi_id'), oe))
 
+	# messages which couldn't be sent are stored here, it survives restarts
+	def setup_outbox(self):
+		try:
+			max_bytes = int(config.get('outbox_max_bytes', 100 * 1024 * 1024))
+		except ValueError:
+			max_bytes = 100 * 1024 * 1024
+			logging.error("Invalid outbox size in config, using %d bytes" % max_bytes)
+		self.outbox = outbox.Outbox(os.path.join(self.zip_directory, "outbox.db"), max_bytes=max_bytes)
+
 	def connection_cleanup(self):
-		self.channel.close()
-		self.connection.close()
+		self.amqp.close()
 
 	
 